@@ -0,0 +1,146 @@
+"""Module containing the computer opponent: an expectimax search over die rolls.
+
+States are the compact counts of rules.py, so they can be hashed into the
+transposition table and sent to worker processes, seated in turn order
+starting with the player to move. The searching player always sits in
+seat 0.
+"""
+
+from collections import OrderedDict
+from time import monotonic
+
+from backend import FINISH
+from rules import move_counts, movable_squares, next_seat
+
+AI_USER_ID_PREFIX = 'ai-'
+WIN_SCORE = 1000.0
+
+
+class SearchTimeout(Exception):
+    """Raised inside the search when the time budget runs out."""
+
+
+class TranspositionTable():
+    """Class caching search values, evicting the least recently used past maxsize."""
+
+    def __init__(self, maxsize: int = 200000) -> None:
+        self.maxsize = maxsize
+        self._values = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._values)
+
+    def get(self, key):
+        """Returns the cached value for key, or None."""
+        value = self._values.get(key)
+        if value is not None:
+            self._values.move_to_end(key)
+        return value
+
+    def put(self, key, value: float):
+        """Caches a value, evicting the least recently used entry if full."""
+        self._values[key] = value
+        self._values.move_to_end(key)
+        if len(self._values) > self.maxsize:
+            self._values.popitem(last=False)
+
+
+def is_ai(user_id: str) -> bool:
+    """Returns if a user id belongs to a computer player."""
+    return str(user_id).startswith(AI_USER_ID_PREFIX)
+
+
+def evaluate(counts: tuple, counters_per_player: int) -> float:
+    """Heuristic value for seat 0: its progress less the best opponent's progress."""
+    def progress(squares):
+        return sum(i * count for i, count in enumerate(squares)) / (FINISH * counters_per_player)
+
+    own = progress(counts[0])
+    if len(counts) == 1:
+        return own
+
+    return own - max(progress(squares) for squares in counts[1:])
+
+
+class Searcher():
+    """Class running time-limited expectimax searches from seat 0's point of view.
+
+    Seat 0 picks the move maximising its value and, treating the table
+    as a coalition, every other seat picks the move minimising it.
+    """
+
+    def __init__(self, table: TranspositionTable = None) -> None:
+        self.table = table if table is not None else TranspositionTable()
+        self.deadline = None
+
+    def _chance(self, counts: tuple, seat: int, depth: int, counters_per_player: int) -> float:
+        """Expected value over the die roll for the seat about to roll."""
+        if depth == 0:
+            return evaluate(counts, counters_per_player)
+
+        key = (counts, seat, depth)
+        value = self.table.get(key)
+        if value is not None:
+            return value
+
+        if monotonic() > self.deadline:
+            raise SearchTimeout
+
+        value = sum(self._decision(counts, seat, die_roll, depth, counters_per_player)
+                    for die_roll in range(1, 7)) / 6
+        self.table.put(key, value)
+        return value
+
+    def _decision(self, counts: tuple, seat: int, die_roll: int, depth: int,
+                  counters_per_player: int) -> float:
+        """Value of the best move for the seat with a given roll."""
+        moves = movable_squares(counts, seat, die_roll)
+        if not moves:
+            return self._chance(counts, next_seat(counts, seat, counters_per_player),
+                                depth - 1, counters_per_player)
+
+        values = [self._move_value(counts, seat, index, die_roll, depth, counters_per_player)
+                  for index in moves]
+        return max(values) if seat == 0 else min(values)
+
+    def _move_value(self, counts: tuple, seat: int, index: int, die_roll: int, depth: int,
+                    counters_per_player: int) -> float:
+        """Value of the position after the seat moves from index."""
+        child = move_counts(counts, seat, index, die_roll)
+        if child[seat][FINISH] == counters_per_player:
+            return WIN_SCORE if seat == 0 else -WIN_SCORE
+
+        return self._chance(child, next_seat(child, seat, counters_per_player),
+                            depth - 1, counters_per_player)
+
+    def choose_move(self, counts: tuple, die_roll: int, counters_per_player: int,
+                    time_budget_s: float = 1.0, max_depth: int = 8) -> int:
+        """Returns the square seat 0 should move from, or None if it has no move.
+
+        Deepens the search one turn at a time until the budget runs out,
+        keeping the choice of the deepest search that completed.
+        """
+        moves = movable_squares(counts, 0, die_roll)
+        if len(moves) <= 1:
+            return moves[0] if moves else None
+
+        self.deadline = monotonic() + time_budget_s
+        best = moves[0]
+        for depth in range(1, max_depth + 1):
+            try:
+                values = {index: self._move_value(counts, 0, index, die_roll, depth, counters_per_player)
+                          for index in moves}
+            except SearchTimeout:
+                break
+            best = max(moves, key=lambda index: (values[index], index))
+
+        return best
+
+
+_searcher = Searcher()
+
+
+def search_move(counts: tuple, die_roll: int, counters_per_player: int,
+                time_budget_s: float = 1.0) -> int:
+    """Chooses a move with this process's searcher; the entry point for worker processes."""
+    return _searcher.choose_move(counts, die_roll, counters_per_player, time_budget_s)
@@ -0,0 +1,150 @@
+"""Module containing the die roll animation scheduler."""
+
+import heapq
+import logging
+from itertools import count
+from threading import Condition, Thread
+from time import monotonic
+
+from dice import DiceStream
+
+TIME_THRESHOLD_S = 0.5
+# The power slider's range; rolls outside it are rejected.
+MIN_POWER = 1
+MAX_POWER = 99
+# More than a roll of MAX_POWER takes, so no power can make the loop below run on.
+MAX_FRAMES = 256
+
+logger = logging.getLogger(__name__)
+
+
+def frame_delays(power: int) -> list[float]:
+    """Returns the delays (in seconds) before each random frame of a roll with given power, at most MAX_FRAMES."""
+    delays = []
+    time_s = TIME_THRESHOLD_S/(1.2**power)
+    time_factor = 1.3 - 0.002*power
+    while time_s < TIME_THRESHOLD_S and len(delays) < MAX_FRAMES:
+        delays.append(time_s)
+        time_s *= time_factor
+
+    return delays
+
+
+class DieAnimation():
+    """Class for a single in-flight roll animation.
+
+    faces are the random faces shown before the result, one per delay;
+    without them, they are drawn from a fresh DiceStream.
+    """
+
+    __slots__ = ('send', 'delays', 'faces', 'result', 'on_done', 'key', 'cancelled')
+
+    def __init__(self, send, power: int, result: int, on_done=None, faces: list[int] = None,
+                 key=None) -> None:
+        delays = frame_delays(power)
+        self.send = send
+        self.delays = iter(delays)
+        self.faces = iter(DiceStream().frames(0, len(delays)) if faces is None else faces)
+        self.result = result
+        self.on_done = on_done
+        self.key = key
+        self.cancelled = False
+
+    def next_delay(self):
+        """Returns the delay before the next random frame, or None if there are no more."""
+        return next(self.delays, None)
+
+    def finish(self):
+        """Sends the result frame."""
+        self.send(self.result)
+        if self.on_done:
+            self.on_done()
+
+    def step(self):
+        """Sends a random frame; returns the delay before the next one, or None if finished."""
+        self.send(next(self.faces))
+        delay = self.next_delay()
+        if delay is None:
+            self.finish()
+
+        return delay
+
+
+class DieAnimator():
+    """Class driving every in-flight roll animation from one background thread.
+
+    Each animation sends a random face after each delay in frame_delays,
+    then the result, without holding up the request that started it.
+    Animations started with a key, e.g. a room id, run side by side and
+    can all be cancelled by it, e.g. when the room's game is reset.
+    """
+
+    def __init__(self) -> None:
+        self._queue = []
+        self._animations = {}
+        self._sequence = count()
+        self._condition = Condition()
+        self._thread = None
+
+    def __len__(self) -> int:
+        return len(self._queue)
+
+    def start(self, send, power: int, result: int, on_done=None, faces: list[int] = None, key=None):
+        """Schedules an animation; send(die_number) is called for every frame."""
+        animation = DieAnimation(send, power, result, on_done, faces, key)
+        first_delay = animation.next_delay()
+        if first_delay is None:
+            animation.finish()
+            return
+
+        with self._condition:
+            if self._thread is None:
+                self._thread = Thread(target=self._run, name='die-animator', daemon=True)
+                self._thread.start()
+            if key is not None:
+                self._animations.setdefault(key, set()).add(animation)
+            heapq.heappush(self._queue, (monotonic() + first_delay, next(self._sequence), animation))
+            self._condition.notify()
+
+    def cancel(self, key):
+        """Stops the animations running under key without sending their results."""
+        with self._condition:
+            for animation in self._animations.pop(key, ()):
+                animation.cancelled = True
+
+    def _finished(self, animation: DieAnimation):
+        """Forgets the key of an animation that has ended."""
+        with self._condition:
+            animations = self._animations.get(animation.key)
+            if animations is not None:
+                animations.discard(animation)
+                if not animations:
+                    del self._animations[animation.key]
+
+    def _run(self):
+        """Sends frames as they fall due, sleeping until the next one."""
+        while True:
+            with self._condition:
+                while not self._queue:
+                    self._condition.wait()
+                due, _, animation = self._queue[0]
+                wait_s = due - monotonic()
+                if wait_s > 0:
+                    self._condition.wait(wait_s)
+                    continue
+                heapq.heappop(self._queue)
+                if animation.cancelled:
+                    continue
+
+            try:
+                delay = animation.step()
+            except Exception:
+                logger.exception("Die animation frame failed.")
+                self._finished(animation)
+                continue
+
+            if delay is None:
+                self._finished(animation)
+            else:
+                with self._condition:
+                    heapq.heappush(self._queue, (monotonic() + delay, next(self._sequence), animation))
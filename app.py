@@ -1,62 +1,43 @@
 """Module to contain and run the endpoints for the Deloton staff API"""
 
+from contextlib import nullcontext
+from functools import wraps
+from hmac import compare_digest
 from math import ceil, sqrt
-from os import environ
-from random import randint
-from time import sleep
+from os import environ, makedirs
+from threading import Event, Lock, Thread
+from time import perf_counter
+from typing import TYPE_CHECKING
+from uuid import uuid4
 
 from dotenv import load_dotenv
-from flask import (Flask, render_template, request, Response, redirect, url_for)
+from flask import (Flask, render_template, request, Response, redirect, url_for, jsonify,
+                   g, has_app_context, has_request_context, json, send_from_directory)
 from flask_login import (LoginManager, login_user, current_user, login_required)
+from flask_sock import ConnectionClosed
+from jinja2 import FileSystemBytecodeCache
 from turbo_flask import Turbo
 
+import ai
+import animation
+import assets
 import backend
+import eventlog
+import fragments
+import metrics
+import pages
+import profiler
+import pushes
+import rooms
+import rules
+import shared
+import sync
+from users import MemoryUserStore, SqliteUserStore, User
+
+if TYPE_CHECKING:
+    from concurrent.futures import ProcessPoolExecutor
 
 
-class User():
-    """Class for users for use by flask_login library."""
-
-    def __init__(self, users: list) -> None:
-        user_ids = [int(user.get_id()) for user in users]
-        self._user_id = self.get_new_user_id(user_ids)
-        self._authenticated = False
-
-    def get_id(self):
-        """Returns id of user."""
-        return self._user_id
-
-    @property
-    def is_active(self):
-        """Returns if the user is active."""
-        return True
-
-    @property
-    def is_authenticated(self):
-        """Returns if the user is authenticated."""
-        return self._authenticated
-
-    @property
-    def is_anonymous(self):
-        """Returns if the user is anonymous."""
-        return False
-
-    @staticmethod
-    def get_new_user_id(user_ids: list[int]) -> int:
-        """Gets a unique user id."""
-        user_id = randint(1, 100000)
-        while user_id in user_ids:
-            user_id = randint(1, 100000)
-
-        return str(user_id)
-
-    def authenticate_user(self):
-        """Sets user _authenticate attribute to true."""
-        self._authenticated = True
-
-    def unauthenticate_user(self):
-        """Sets user _authenticate attribute to false."""
-        self._authenticated = False
-
 load_dotenv()
 
 app = Flask(__name__, template_folder='templates')
@@ -65,12 +46,92 @@ app.secret_key = environ['SECRET_KEY']
 
 login_manager = LoginManager()
 login_manager.init_app(app)
-users = []
+STATE_BACKEND = environ.get('STATE_BACKEND', 'memory')
+STATE_DB = environ.get('STATE_DB', 'trs_state.sqlite3')
+if STATE_BACKEND == 'sqlite':
+    # The database is shared by every worker and replaces the per-process event logs.
+    room_registry = rooms.RoomRegistry(
+        max_rooms=int(environ.get('MAX_ROOMS', 5000)),
+        idle_timeout_s=float(environ.get('ROOM_IDLE_TIMEOUT_S', 3600)),
+        state=shared.SqliteState(STATE_DB)
+    )
+    users = SqliteUserStore(
+        STATE_DB,
+        ttl_s=float(environ.get('USER_TTL_S', 1800)),
+        on_expire=lambda user: room_registry.leave(user.room_id, user.get_id()),
+        keep=lambda user: room_registry.is_seated(user.room_id, user.get_id())
+    )
+    push_channel = shared.SqlitePubSub(STATE_DB)
+else:
+    room_registry = rooms.RoomRegistry(
+        max_rooms=int(environ.get('MAX_ROOMS', 5000)),
+        idle_timeout_s=float(environ.get('ROOM_IDLE_TIMEOUT_S', 3600)),
+        event_log_dir=environ.get('EVENT_LOG_DIR', 'event_logs') or None
+    )
+    users = MemoryUserStore(
+        ttl_s=float(environ.get('USER_TTL_S', 1800)),
+        on_expire=lambda user: room_registry.leave(user.room_id, user.get_id()),
+        keep=lambda user: room_registry.is_seated(user.room_id, user.get_id())
+    )
+    push_channel = shared.LocalPubSub()
 
 turbo = Turbo(app)
+# With a gateway (see gateway.py), it holds the turbo websockets and takes every turbo push.
+PUSH_GATEWAY = environ.get('PUSH_GATEWAY')
+push_gateway = None
+if PUSH_GATEWAY:
+    from gateway import GatewayClient
+    push_gateway = GatewayClient(PUSH_GATEWAY)
+# sync.js holds a /board-sync websocket in the app, so pages leave it out when the gateway holds the turbo ones.
+app.jinja_env.globals['board_sync'] = not push_gateway
+push_stats = pushes.PushStats()
+JINJA_CACHE_DIR = environ.get('JINJA_CACHE_DIR', '.jinja_cache')
+if JINJA_CACHE_DIR:
+    # Must be set before app.jinja_env is first used, which creates the environment.
+    makedirs(JINJA_CACHE_DIR, exist_ok=True)
+    app.jinja_options = {**app.jinja_options, 'bytecode_cache': FileSystemBytecodeCache(JINJA_CACHE_DIR)}
+board_fragments = fragments.BoardFragments(app.jinja_env, rendering=environ.get('BOARD_RENDERING', 'html'))
+app.jinja_env.globals['board'] = board_fragments.board
+app.jinja_env.globals['off_board'] = board_fragments.off_board
+die_animator = animation.DieAnimator()
+page_cache = pages.PageCache(maxsize=int(environ.get('PAGE_CACHE_SIZE', 1024)))
+# Built by assets.py; without a build, static files are served from static/ under their own names.
+static_assets = assets.StaticAssets(environ.get('STATIC_BUILD_DIR', 'static_build'))
+STATIC_MAX_AGE_S = 365 * 24 * 3600
+metrics_recorder = metrics.Metrics(enabled=environ.get('METRICS') == 'on')
+# Profiling is only available with a PROFILE_TOKEN, which admins send in the X-Profile-Token header.
+PROFILE_TOKEN = environ.get('PROFILE_TOKEN')
+MAX_PROFILE_WINDOW_S = 300
+sampling_profiler = profiler.SamplingProfiler(output_dir=environ.get('PROFILE_DIR', 'profiles'),
+                                              interval_s=float(environ.get('PROFILE_INTERVAL_S', 0.002)))
+
+DIE_ANIMATION = environ.get('DIE_ANIMATION', 'server')
+
+AI_WORKERS = int(environ.get('AI_WORKERS', 1))
+AI_TIME_BUDGET_S = float(environ.get('AI_TIME_BUDGET_S', 1.0))
+AI_ROLL_POWER = 50
+
+REPLAY_CHUNK_EVENTS = 256
+ai_executor = None
+
+# Event log recovery and template compilation run off the import path; see start_up.
+STARTUP_EXEMPT_ENDPOINTS = ('readiness', 'get_metrics', 'static', 'start_profile_window', 'get_profile')
+rooms_recovered = Event()
+app_ready = Event()
+startup_lock = Lock()
+startup_thread = None
+startup_error = None
+STARTUP_TIMEOUT_S = float(environ.get('STARTUP_TIMEOUT_S', 60))
 
 COLOURS_AVAILABLE = ['red', 'orange', 'yellow', 'green', 'blue', 'indigo',
                      'violet', 'teal', 'maroon', 'black']
+# Offered by the first player's popup and checked on login, keeping every square's count in a byte.
+MAX_PLAYERS = len(COLOURS_AVAILABLE)
+MAX_COUNTERS_PER_PLAYER = 8
+
+board_sync = sync.BoardSync(COLOURS_AVAILABLE, max_behind=int(environ.get('SYNC_MAX_BEHIND', 16)))
+app.jinja_env.globals.update(max_players=MAX_PLAYERS, max_counters_per_player=MAX_COUNTERS_PER_PLAYER,
+                             min_power=animation.MIN_POWER, max_power=animation.MAX_POWER)
 
 
 @turbo.user_id
@@ -79,19 +140,481 @@ def get_user_id():
     return current_user.get_id()
 
 
+def send_pushes(stream: str, recipients: list[str]):
+    """Publishes a turbo stream to every worker, for those connected to it to deliver.
+
+    With a push gateway, turbo streams go straight to it instead.
+    """
+    if push_gateway and not stream.startswith(sync.SYNC_PREFIX):
+        push_gateway.publish(stream, recipients)
+    else:
+        push_channel.publish(stream, recipients)
+
+
+def deliver_pushes(stream: str, recipients: list[str]):
+    """Sends a turbo stream, or board update for sync.js, to those recipients connected to this worker."""
+    update = sync.decode_update(stream)
+    if update:
+        board_sync.deliver(*update, recipients)
+        return
+
+    recipients = [user_id for user_id in recipients if turbo.can_push(user_id)]
+    if recipients:
+        turbo.push(stream, to=recipients)
+
+
+push_channel.subscribe(deliver_pushes)
+
+
+def push(stream, room: rooms.Room, to=None):
+    """Pushes a turbo stream to the users of a room (or a subset of them).
+
+    Within a request, pushes are buffered and sent when the request ends.
+    """
+    if to is None:
+        to = list(room.user_ids)
+    elif isinstance(to, str):
+        to = [to]
+
+    if has_request_context():
+        if 'push_buffer' not in g:
+            g.push_buffer = pushes.PushBuffer(send_pushes, push_stats)
+        g.push_buffer.add(stream, to)
+    else:
+        buffer = pushes.PushBuffer(send_pushes, push_stats)
+        buffer.add(stream, to)
+        buffer.flush()
+
+
+@app.teardown_request
+def stop_profiling(exception=None):
+    """Writes the request's profile, if it was profiled; registered first so it runs after the pushes flush."""
+    profile = g.pop('profile', None)
+    if profile:
+        sampling_profiler.stop(profile)
+    if PROFILE_TOKEN:
+        sampling_profiler.untag()
+
+
+@app.teardown_request
+def flush_pushes(exception=None):
+    """Sends the pushes buffered during the request."""
+    push_buffer = g.pop('push_buffer', None)
+    if push_buffer:
+        push_buffer.flush()
+
+
+def push_die_face(room: rooms.Room, die_number: int):
+    """Pushes a die face to a room; called from the die animation thread."""
+    if sampling_profiler.active:
+        sampling_profiler.tag('die-animator', room.room_id)
+    try:
+        with app.app_context():
+            push(
+                turbo.replace(
+                    render_template('die_image.html', die_number=die_number),
+                    'die_image'
+                ),
+                room
+            )
+    finally:
+        # Between frames the thread works for no room, so its samples must not keep this room's tags.
+        sampling_profiler.untag()
+
+
+@app.errorhandler(rooms.RoomsFull)
+def rooms_full(error: rooms.RoomsFull) -> Response:
+    """Answers 503 wherever a room was needed but the registry is at capacity."""
+    return Response("No rooms available.", status=503)
+
+
+def current_room() -> rooms.Room:
+    """Returns the current user's room, creating it if needed."""
+    room_id = getattr(current_user, 'room_id', rooms.DEFAULT_ROOM_ID)
+    return room_registry.get_or_create(room_id)
+
+
+def with_room(view):
+    """Decorator passing the current user's room to a view, holding the room lock."""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        room = current_room()
+        with room_registry.locked(room):
+            if current_user.get_id():
+                room.add_user(current_user.get_id())
+            return view(room, *args, **kwargs)
+    return wrapper
+
+
+def checks_version(view):
+    """Decorator rejecting actions submitted against an older version of the room's game.
+
+    Duplicate submissions carry the version the first one changed, so are
+    rejected too. Requests without a version are not checked.
+    """
+    @wraps(view)
+    def wrapper(room: rooms.Room, *args, **kwargs):
+        version = request.form.get('version')
+        if version is not None and version != str(room.version):
+            return Response("The game has changed since this action was made.", status=409)
+        return view(room, *args, **kwargs)
+    return wrapper
+
+
+def record_event(room: rooms.Room, event_type: int, payload: bytes = b''):
+    """Records an event in the room and pushes the game's new version to its users."""
+    room.record(event_type, payload)
+    push_version(room)
+
+
+def push_version(room: rooms.Room):
+    """Pushes the version of the room's game, which clients send back with their actions.
+
+    Users running sync.js are sent the board at that version straight away.
+    """
+    push(
+        turbo.replace(render_template('game_version.html', version=room.version), 'game_version'),
+        room
+    )
+    if room.sync_user_ids:
+        send_pushes(
+            sync.encode_update(room.version, sync.snapshot(room.game, COLOURS_AVAILABLE)),
+            list(room.sync_user_ids)
+        )
+
+
+def page_response(page: pages.Page) -> Response:
+    """Returns a cached page, or 304 Not Modified if the browser sent its ETag."""
+    response = Response(page.body, mimetype='text/html')
+    response.set_etag(page.etag)
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+
+@app.url_defaults
+def fingerprint_static_urls(endpoint: str, values: dict):
+    """Makes url_for('static', ...) link to the fingerprinted build of a file, if there is one."""
+    if endpoint == 'static' and 'filename' in values:
+        values['filename'] = static_assets.url_name(values['filename'])
+
+
+def send_static(filename: str) -> Response:
+    """Sends a static file: fingerprinted ones precompressed if possible and cacheable for a year."""
+    variant = static_assets.variant(filename, request.accept_encodings)
+    if variant is None:
+        return app.send_static_file(filename)
+
+    from mimetypes import guess_type
+
+    name, encoding = variant
+    response = send_from_directory(static_assets.build_dir, name, max_age=STATIC_MAX_AGE_S,
+                                   mimetype=guess_type(filename)[0])
+    response.cache_control.immutable = True
+    response.vary.add('Accept-Encoding')
+    if encoding:
+        response.content_encoding = encoding
+    return response
+
+
+app.view_functions['static'] = send_static
+
+
 @login_manager.user_loader
 def load_user(user_id: str) -> User:
-    """Gets the User object with user_id matching that given from users list."""
-    matches = [user for user in users if user.get_id() == user_id]
-    if len(matches) == 0:
-        return None
+    """Gets the User object with user_id from the user store."""
+    return users.get(user_id)
+
+
+def add_player_to_game(room: rooms.Room, colour: str, user_id: str,
+                       number_of_players: int = 0, counters_per_player: int = 0):
+    """Adds a player to the room's game and pushes the updated game to the room.
+
+    The first player also sets the number of players and counters per player;
+    later players' settings are ignored, as they would clear the board. The
+    event is packed first, so a ValueError for a field that does not fit in
+    the event log is raised before the game changes.
+    """
+    game = room.game
+    if game.number_of_players:
+        number_of_players = counters_per_player = 0
+    payload = eventlog.join_payload(colour, user_id, number_of_players, counters_per_player)
+    if number_of_players and counters_per_player:
+        game.set_num_players_and_counters(number_of_players, counters_per_player)
+    game.add_player(backend.Player(colour, user_id))
+    record_event(room, eventlog.JOIN, payload)
+
+    push(
+        turbo.update(
+            render_template(
+                'head.html',
+                counters_per_square = max(ceil(sqrt(game.total_number_of_counters)), 3)
+            ),
+            'head'
+        ),
+        room
+    )
+
+    if len(game.players) < game.number_of_players:
+        non_player_ids = room.spectator_ids
+        player_colours = [player.colour for player in game.players]
+        available_colours_remaining = list(set(COLOURS_AVAILABLE).difference(set(player_colours)))
+        if non_player_ids:
+            push(
+                turbo.replace(
+                    render_template(
+                        'game.html',
+                        counters = game.counters,
+                        finished_tokens = game.finished_tokens,
+                        die_number = 0,
+                        player_turn = "",
+                        message={
+                            'players': player_colours,
+                            'colours_available': available_colours_remaining
+                        }
+                    ),
+                    'game'
+                ),
+                room,
+                to=non_player_ids
+            )
+
+        push(
+            turbo.replace(
+                render_template(
+                    'game.html',
+                    counters = game.counters,
+                    finished_tokens = game.finished_tokens,
+                    die_number = 0,
+                    player_turn = "",
+                    message={
+                        'title': "Please Wait",
+                        'text': f"Please wait for the rest of the players to join ({len(game.players)}/{game.number_of_players}).",
+                        'type': 'waiting'
+                    }
+                ),
+                'game'
+            ),
+            room,
+            to=game.player_ids
+        )
+    else:
+        board_fragments.changed(room.fragment_keys, game.counters, game.finished_tokens)
+        push(
+            turbo.replace(
+                render_template(
+                    'game.html',
+                    counters = game.counters,
+                    finished_tokens = game.finished_tokens,
+                    die_number = game.players[0].die_roll,
+                    player_turn = game.players[0].colour, message={}
+                ),
+                'game'
+            ),
+            room
+        )
+
+
+def move_piece_for_player(room: rooms.Room, square_num: int, colour: str, user_id: str) -> bool:
+    """Moves a counter for a player and pushes the changed squares to the room."""
+    game = room.game
+    player_colour = game.players[0].colour
+    # Squares highlighted for the mover must be redrawn even if unchanged.
+    room.fragment_keys.pop('board_state', None)
+    for index in game.legal_moves():
+        room.fragment_keys.pop(f'square_{index}', None)
+
+    moved = game.move_piece(square_num, colour, user_id)
+    if moved:
+        record_event(room, eventlog.MOVE, eventlog.move_payload(square_num, colour))
+
+    changed = board_fragments.changed(room.fragment_keys, game.counters, game.finished_tokens)
+    streams = [
+        *[turbo.replace(fragment, target) for target, fragment in changed],
+        turbo.replace(
+            render_template(
+                'player_turn_label.html',
+                player_turn = game.players[0].colour
+            ),
+            'player_turn_label'
+        )
+    ]
+    if room.sync_user_ids:
+        # Users running sync.js were sent the squares by push_version.
+        push(streams, room, to=[user_id for user_id in room.user_ids if user_id not in room.sync_user_ids])
+        push([stream for (target, _), stream in zip(changed, streams) if target == 'off_board'] + streams[-1:],
+             room, to=list(room.sync_user_ids))
+    else:
+        push(streams, room)
+
+    if game.check_win(player_colour):
+        push(
+            turbo.replace(
+                render_template(
+                    'popup.html',
+                    message={
+                        'title': "Winner",
+                        'text': f"Congratulations {player_colour} player, you have won!"
+                    }
+                ),
+                'popup_box'
+            ),
+            room
+        )
+
+    return moved
+
+
+def roll_die_for_player(room: rooms.Room, user_id: str, power: int) -> bool:
+    """Rolls the die for the current player, if not already rolled, and starts its animation.
+
+    If no moves are available, the turn passes on; returns if moves exist.
+    """
+    game = room.game
+    dice = game.dice
+    rolled = game.players[0].die_roll == 0
+    if rolled:
+        game.players[0].roll_die(dice)
+    die_roll = game.players[0].die_roll
+    roll_index = dice.index - 1
+
+    on_done = None
+    moves_exist = game.check_if_moves_exist()
+    if not moves_exist:
+        message = {
+            'title': "No Moves Available",
+            'text': f"Sorry {game.players[0].colour}, you have no moves available!"
+        }
+        popup = turbo.replace(
+            render_template('popup.html', message=message),
+            "popup_box"
+        )
+        on_done = lambda: push(popup, room, to=user_id)
+        game.players[0].reset_die()
+        game.next_player()
+        push(
+            turbo.replace(
+                render_template(
+                    'player_turn_label.html',
+                    player_turn = game.players[0].colour
+                ),
+                'player_turn_label'
+            ),
+            room
+        )
+
+    if rolled:
+        record_event(room, eventlog.ROLL, eventlog.roll_payload(die_roll, dice.seed, roll_index))
+    elif not moves_exist:
+        record_event(room, eventlog.ROLL, eventlog.roll_payload(die_roll))
+
+    if rolled and DIE_ANIMATION == 'server':
+        die_animator.start(
+            lambda die_number: push_die_face(room, die_number),
+            power,
+            die_roll,
+            on_done,
+            dice.frames(roll_index, len(animation.frame_delays(power))),
+            key=room.room_id
+        )
+    else:
+        if rolled:
+            push(
+                turbo.replace(
+                    render_template(
+                        'die_image.html',
+                        die_number=die_roll,
+                        power=power
+                    ),
+                    'die_image'
+                ),
+                room
+            )
+        if on_done:
+            on_done()
+
+    return moves_exist
+
+
+def get_ai_executor() -> 'ProcessPoolExecutor':
+    """Returns the process pool computer players search in, starting it on first use.
+
+    multiprocessing is only imported here, keeping it out of startup.
+    """
+    global ai_executor
+    if ai_executor is None:
+        from concurrent.futures import ProcessPoolExecutor
+        from multiprocessing import get_context
+        ai_executor = ProcessPoolExecutor(max_workers=AI_WORKERS, mp_context=get_context('spawn'))
+
+    return ai_executor
+
+
+def ai_context():
+    """Returns an app context for computer players' turns.
+
+    Within a request the current one is kept, so their pushes go in the
+    request's push buffer and are sent when it ends.
+    """
+    return nullcontext() if has_app_context() else app.app_context()
+
 
-    return matches[0]
+def play_ai_turns(room: rooms.Room):
+    """Rolls for computer players whose turn it is, and starts a search for their move.
+
+    The search runs in the process pool; its move is made by finish_ai_turn.
+    """
+    with room_registry.locked(room):
+        game = room.game
+        while game.players and len(game.players) == game.number_of_players:
+            player = game.players[0]
+            if not ai.is_ai(player.user_id) or game.check_win(player.colour):
+                return
+
+            with ai_context():
+                if roll_die_for_player(room, player.user_id, AI_ROLL_POWER):
+                    break
+        else:
+            return
+
+        counts = rules.encode(game)
+        future = get_ai_executor().submit(
+            ai.search_move, counts, player.die_roll, game.counters_per_player, AI_TIME_BUDGET_S
+        )
+    future.add_done_callback(lambda future: finish_ai_turn(room, player.user_id, counts, future))
+
+
+def finish_ai_turn(room: rooms.Room, user_id: str, counts: tuple, future):
+    """Makes the move a computer player's search chose, if the game has not moved on.
+
+    The room's game may have been reloaded from the shared state meanwhile,
+    so it is compared by state rather than identity. If the search failed,
+    the first legal move is made, so the game does not stall.
+    """
+    with room_registry.locked(room):
+        game = room.game
+        if (not game.players or game.players[0].user_id != user_id
+                or rules.encode(game) != counts):
+            return
+
+        if future.exception():
+            app.logger.error("Computer player search failed in room %s; making the first legal move.",
+                             room.room_id, exc_info=future.exception())
+            square = game.legal_moves()[0]
+        else:
+            square = future.result()
+        player = game.players[0]
+        with ai_context():
+            move_piece_for_player(room, square, player.colour, player.user_id)
+
+    play_ai_turns(room)
 
 
 @app.route("/login", methods=["GET", "POST"])
-def login():
+@with_room
+@checks_version
+def login(room: rooms.Room):
     """Function to make new players login."""
+    game = room.game
     if request.method == "GET":
         player_colours = [player.colour for player in game.players]
         #player_colours = ['red']
@@ -100,9 +623,9 @@ def login():
         user_id = current_user.get_id()
 
         if not user_id:
-            user = User(users)
+            user = users.new_user(room.room_id)
             if login_user(user):
-                users.append(user)
+                room.add_user(user.get_id())
         else:
             user = load_user(user_id)
             if user_id in game.player_ids:
@@ -117,20 +640,28 @@ def login():
                 'title': "Game Full",
                 'text': "Sorry, there are no spots left in this game; feel free to watch."
                 }
-            return render_template('TRS.html',
-                                   counters = game.board,
-                                   counters_per_square = max(ceil(sqrt(game.total_number_of_counters)), 3),
-                                   finished_tokens = game.finished_tokens,
-                                   die_number = game.players[0].die_roll,
-                                   player_turn = game.players[0].colour,
-                                   message=message)
+            key = (room.room_id, room.generation, room.version, 'spectator')
+            page = page_cache.get(key) or page_cache.put(key, render_template(
+                'TRS.html',
+                counters = game.counters,
+                counters_per_square = max(ceil(sqrt(game.total_number_of_counters)), 3),
+                finished_tokens = game.finished_tokens,
+                die_number = game.players[0].die_roll,
+                player_turn = game.players[0].colour,
+                event_number = room.number_of_events,
+                room_id = room.room_id,
+                version = room.version,
+                message=message
+            ), room.generation)
+            return page_response(page)
 
         return render_template('TRS.html',
-                               counters = game.board,
+                               counters = game.counters,
                                counters_per_square = max(ceil(sqrt(game.total_number_of_counters)), 3),
                                finished_tokens = game.finished_tokens,
                                die_number = 0,
                                player_turn = "",
+                               version = room.version,
                                message=message)
 
     elif request.method == "POST":
@@ -139,81 +670,141 @@ def login():
         if user_id in game.player_ids:
             redirect(url_for('display_game'), code=302)
 
-        num_players = request.form.get('num_players')
-        counters_per_player = request.form.get('counters_per_player')
-        colour = request.form.get('colour').lower()
+        try:
+            num_players = int(request.form.get('num_players') or 0)
+            counters_per_player = int(request.form.get('counters_per_player') or 0)
+        except ValueError:
+            return Response("Invalid player settings.", status=400)
+        minimum = 0 if game.number_of_players else 1
+        if not (minimum <= num_players <= MAX_PLAYERS
+                and minimum <= counters_per_player <= MAX_COUNTERS_PER_PLAYER):
+            return Response("Invalid player settings.", status=400)
+        colour = (request.form.get('colour') or '').lower()
+        if colour not in COLOURS_AVAILABLE:
+            return Response("Unknown colour.", status=400)
+        if colour in [player.colour for player in game.players]:
+            return redirect(url_for('login'))
 
-        if num_players and counters_per_player:
-            game.set_num_players_and_counters(int(num_players), int(counters_per_player))
+        user = load_user(user_id)
+        if user is None:
+            # The visitor expired from the user store since the login page was served.
+            return redirect(url_for('login'))
+        user.authenticate_user()
+        users.save(user)
+        try:
+            add_player_to_game(room, colour, user_id, num_players, counters_per_player)
+        except ValueError:
+            return Response("Invalid player settings.", status=400)
+        play_ai_turns(room)
 
-        game.add_player(backend.Player(colour, user_id))
-        load_user(user_id).authenticate_user()
+        return redirect(url_for('display_game'))
 
-        turbo.push(
-            turbo.update(
-                render_template(
-                    'head.html',
-                    counters_per_square = max(ceil(sqrt(game.total_number_of_counters)), 3)
-                ),
-                'head'
-            )
-        )
 
-        if len(game.players) < game.number_of_players:
-            non_player_ids = list(set([user.get_id() for user in users]).difference(set(game.player_ids)))
-            player_colours = [player.colour for player in game.players]
-            available_colours_remaining = list(set(COLOURS_AVAILABLE).difference(set(player_colours)))
-            if non_player_ids:
-                turbo.push(
-                    turbo.replace(
-                        render_template(
-                            'game.html',
-                            counters = game.board,
-                            finished_tokens = game.finished_tokens,
-                            die_number = 0,
-                            player_turn = "",
-                            message={
-                                'players': player_colours,
-                                'colours_available': available_colours_remaining
-                            }
-                        ),
-                        'game'
-                    ),
-                    to=non_player_ids
-                )
+@app.route("/add_ai", methods=["POST"])
+@login_required
+@with_room
+def add_ai(room: rooms.Room):
+    """Fills a free seat in the game with a computer player."""
+    game = room.game
+    if (game.number_of_players == 0) or (len(game.players) >= game.number_of_players):
+        return Response(status=400)
 
-            turbo.push(
-                turbo.replace(
-                    render_template(
-                        'game.html',
-                        counters = game.board,
-                        finished_tokens = game.finished_tokens,
-                        die_number = 0,
-                        player_turn = "",
-                        message={
-                            'title': "Please Wait",
-                            'text': f"Please wait for the rest of the players to join ({len(game.players)}/{game.number_of_players})."
-                        }
-                    ),
-                    'game'
-                ),
-                to=game.player_ids
-            )
+    player_colours = [player.colour for player in game.players]
+    colour = [colour for colour in COLOURS_AVAILABLE if colour not in player_colours][0]
+    add_player_to_game(room, colour, f"{ai.AI_USER_ID_PREFIX}{uuid4().hex[:8]}")
+    play_ai_turns(room)
+    return redirect(url_for('display_game'))
+
+
+def stream_events(events: list[tuple[int, bytes]], as_json: bool):
+    """Yields events in chunks of REPLAY_CHUNK_EVENTS, as JSON lines or history records."""
+    for start in range(0, len(events), REPLAY_CHUNK_EVENTS):
+        chunk = events[start:start + REPLAY_CHUNK_EVENTS]
+        if as_json:
+            yield ''.join(json.dumps(eventlog.describe_event(*event)) + '\n' for event in chunk)
         else:
-            turbo.push(
-                turbo.replace(
-                    render_template(
-                        'game.html',
-                        counters = game.board,
-                        finished_tokens = game.finished_tokens,
-                        die_number = game.players[0].die_roll,
-                        player_turn = game.players[0].colour, message={}
-                    ),
-                    'game'
-                )
-            )
+            yield b''.join(eventlog.encode_record(*event) for event in chunk)
+
+
+def event_number_arg(name: str, default: int) -> int:
+    """Returns a query argument as a number of events, default if it is missing, or None if it is not one."""
+    value = request.args.get(name)
+    if value is None:
+        return default
+    return int(value) if value.isdigit() else None
+
+
+@app.route("/games/<room_id>/replay", methods=["GET"])
+def replay_game(room_id: str):
+    """Streams the history of a room's game from event number `since` (default 0).
+
+    With format=json each event is a line of JSON; otherwise the binary
+    history records are sent. Spectators pass the event number their page
+    was rendered at to catch up on only the events since.
+    """
+    room = room_registry.get(room_id)
+    if room is None:
+        return Response(status=404)
+
+    since = event_number_arg('since', 0)
+    if since is None:
+        return Response("since must be a number of events.", status=400)
+    with room_registry.locked(room):
+        events = list(eventlog.decode_records(room.history))
+        finished = room.finished
+    if not finished:
+        # The dice seed would let anyone predict the rest of a live game's rolls.
+        events = [eventlog.without_dice(*event) for event in events]
+    as_json = request.args.get('format') == 'json'
+    return Response(
+        stream_events(events[since:], as_json),
+        mimetype='application/x-ndjson' if as_json else 'application/octet-stream',
+        headers={'X-Number-Of-Events': str(len(events))}
+    )
 
-        return redirect(url_for('display_game'))
+
+@app.route("/games/<room_id>/state", methods=["GET"])
+def game_state(room_id: str):
+    """Returns a room's game as it was after `event` events (default: all), replayed on the server."""
+    room = room_registry.get(room_id)
+    if room is None:
+        return Response(status=404)
+
+    event = event_number_arg('event', None)
+    if event is None and 'event' in request.args:
+        return Response("event must be a number of events.", status=400)
+    with room_registry.locked(room):
+        history = bytes(room.history)
+        version = room.version
+        finished = room.finished
+    game = eventlog.replay(history, event)
+    return jsonify({
+        'event': event,
+        'version': version,
+        'game': eventlog.snapshot_game(game, include_dice=finished),
+        'finished_tokens': game.finished_tokens,
+        'player_turn': game.players[0].colour if game.players else None
+    })
+
+
+@app.route("/games/export", methods=["GET"])
+def export_games():
+    """Streams every finished game as a line of JSON, for offline analysis."""
+    finished_games = list(room_registry.finished_games)
+    for room in room_registry.rooms():
+        with room_registry.locked(room):
+            if room.finished:
+                finished_games.append({'room_id': room.room_id, 'history': bytes(room.history)})
+
+    def generate():
+        for finished_game in finished_games:
+            yield json.dumps({
+                'room_id': finished_game['room_id'],
+                'events': [eventlog.describe_event(*event)
+                           for event in eventlog.decode_records(finished_game['history'])]
+            }) + '\n'
+
+    return Response(generate(), mimetype='application/x-ndjson')
 
 
 @login_manager.unauthorized_handler
@@ -222,149 +813,181 @@ def unauthorised():
     return redirect(url_for('login'))
 
 
+@app.route("/rooms", methods=["GET", "POST"])
+@login_required
+def list_rooms():
+    """Lists the rooms on GET; creates a new room and joins it on POST."""
+    if request.method == "GET":
+        return jsonify(room_registry.list())
+
+    room = room_registry.create()
+    return redirect(url_for('join_room', room_id=room.room_id))
+
+
+@app.route("/rooms/<room_id>", methods=["GET"])
+def join_room(room_id: str):
+    """Moves the current user to a room, creating the room if needed."""
+    user_id = current_user.get_id()
+    if not user_id:
+        user = users.new_user(room_id)
+        login_user(user)
+    else:
+        user = load_user(user_id)
+        room = room_registry.get(user.room_id)
+        if room and user_id in room.game.player_ids:
+            with room_registry.locked(room):
+                room.game.remove_player(user_id)
+                record_event(room, eventlog.QUIT, eventlog.quit_payload(user_id))
+        room_registry.leave(user.room_id, user_id)
+
+    room_registry.join(room_id, user.get_id())
+
+    user.room_id = room_id
+    user.unauthenticate_user()
+    users.save(user)
+    return redirect(url_for('login'))
+
+
+@turbo.sock.route('/board-sync')
+def board_sync_stream(ws):
+    """Websocket sending sync.js the board as versioned deltas; the client replies with acknowledgements."""
+    user_id = current_user.get_id()
+    if not user_id:
+        return
+    room = current_room()
+    connection = board_sync.connect(user_id, ws)
+    try:
+        with room_registry.locked(room):
+            room.set_synced(user_id, True)
+            board_sync.send(connection, room.version, sync.snapshot(room.game, COLOURS_AVAILABLE))
+        while True:
+            message = ws.receive(timeout=10)
+            if message:
+                board_sync.acknowledge(connection, json.loads(message))
+    except (BrokenPipeError, ConnectionClosed):
+        pass
+    finally:
+        board_sync.disconnect(connection)
+        if not board_sync.connected(user_id):
+            with room_registry.locked(room):
+                room.set_synced(user_id, False)
+
+
+@app.route("/push_stats", methods=["GET"])
+def get_push_stats():
+    """Returns the number of messages pushed by handlers and actually sent."""
+    return jsonify(push_stats.as_dict())
+
+
+@app.route("/metrics", methods=["GET"])
+def get_metrics():
+    """Returns live counts and, if enabled, timing histograms in Prometheus text format."""
+    gauges = {
+        'trs_rooms': ("Rooms in memory.", len(room_registry)),
+        'trs_users': ("Users in the user store.", len(users)),
+        'trs_websocket_connections': ("Open websocket connections.",
+                                      sum(len(clients) for clients in turbo.clients.values()))
+    }
+    return Response(metrics_recorder.render(gauges), mimetype='text/plain; version=0.0.4')
+
+
 @app.route("/", methods=["GET"])
 @login_required
 def display_game():
     """ Creates an index route with an index page for the API """
-    message = {}
+    room = current_room()
     user_id = current_user.get_id()
-    if (len(game.players) < game.number_of_players) or len(game.players) == 0:
-        if user_id not in game.player_ids:
-            return redirect(url_for('login'))
-        else:
-            message = {
-                'title': "Please Wait",
-                'text': f"Please wait for the rest of the players to join ({len(game.players)}/{game.number_of_players})."
-            }
-
-    return render_template(
-        'TRS.html',
-        counters = game.board,
-        counters_per_square = max(ceil(sqrt(game.total_number_of_counters)), 3),
-        finished_tokens = game.finished_tokens,
-        die_number = game.players[0].die_roll,
-        player_turn = game.players[0].colour,
-        message=message
-    )
+    # Pages are cached per version of the game, for the player to move and
+    # for everyone else; only copying the game's state on a miss holds the
+    # room lock, and the page renders without it.
+    with room_registry.locked(room):
+        room.add_user(user_id)
+        game = room.game
+        message = {}
+        if (len(game.players) < game.number_of_players) or len(game.players) == 0:
+            if user_id not in game.player_ids:
+                return redirect(url_for('login'))
+            else:
+                message = {
+                    'title': "Please Wait",
+                    'text': f"Please wait for the rest of the players to join ({len(game.players)}/{game.number_of_players}).",
+                    'type': 'waiting'
+                }
+
+        is_mover = game.validate_user(user_id)
+        key = (room.room_id, room.generation, room.version, 'mover' if is_mover else 'player')
+        generation = room.generation
+        page = page_cache.get(key)
+        if page is None:
+            context = dict(
+                counters = game.counters,
+                counters_per_square = max(ceil(sqrt(game.total_number_of_counters)), 3),
+                finished_tokens = game.finished_tokens,
+                die_number = game.players[0].die_roll,
+                player_turn = game.players[0].colour,
+                playable = game.legal_moves() if is_mover else [],
+                version = room.version,
+                message=message
+            )
+
+    if page is None:
+        page = page_cache.put(key, render_template('TRS.html', **context), generation)
+    return page_response(page)
 
 
 @app.route("/move_piece", methods = ["POST"])
 @login_required
-def move_piece():
+@with_room
+@checks_version
+def move_piece(room: rooms.Room):
     """Function called to move a selected piece."""
-    colour = game.players[0].colour
-    game.move_piece(
+    move_piece_for_player(
+        room,
         int(request.form['square_num']),
         request.form['colour'],
         current_user.get_id()
     )
-
-    turbo.push([
-        turbo.replace(
-            render_template(
-                'board.html',
-                counters=game.board,
-                counters_per_square = ceil(sqrt(game.total_number_of_counters))
-            ),
-            'board'
-        ),
-        turbo.replace(
-            render_template(
-                'player_turn_label.html',
-                player_turn = game.players[0].colour
-            ),
-            'player_turn_label'
-        ),
-        turbo.replace(
-            render_template(
-                'off_board.html',
-                finished_tokens=game.finished_tokens
-            ),
-            'off_board'
-        )
-    ])
-
-    if game.check_win(colour):
-        turbo.push(
-            turbo.replace(
-                render_template(
-                    'popup.html',
-                    message={
-                        'title': "Winner",
-                        'text': f"Congratulations {colour} player, you have won!"
-                    }
-                ),
-                'popup_box'
-            )
-        )
+    play_ai_turns(room)
     return Response(status=200)
 
 
 @app.route("/roll_die", methods=["POST"])
 @login_required
-def roll_die():
+@with_room
+@checks_version
+def roll_die(room: rooms.Room):
     """Function to roll a die, if it's not already been rolled."""
+    game = room.game
     if not game.validate_user(current_user.get_id()):
         redirect(url_for('display_game'))
         return Response(status=400)
 
-    power = int(request.form['power'])
-    time_threshold = 0.5
-    time_s = time_threshold/(1.2**power)
-    time_factor = 1.3 - 0.002*power
-    if game.players[0].die_roll == 0:
-        with app.app_context():
-            while time_s < time_threshold:
-                sleep(time_s)
-                turbo.push(
-                    turbo.replace(
-                        render_template(
-                            'die_image.html',
-                            die_number=randint(1,6)
-                        ),
-                        'die_image'
-                    )
-                )
-                time_s *= time_factor
-
-            game.players[0].reset_die()
-            game.players[0].roll_die()
-            turbo.push(
-                turbo.replace(
-                    render_template(
-                        'die_image.html',
-                        die_number=game.players[0].die_roll),
-                        'die_image'
-                )
-            )
+    try:
+        power = int(request.form.get('power', ''))
+    except ValueError:
+        return Response("Invalid power.", status=400)
+    if not animation.MIN_POWER <= power <= animation.MAX_POWER:
+        return Response("Invalid power.", status=400)
 
-    if not game.check_if_moves_exist():
-        message = {
-            'title': "No Moves Available",
-            'text': f"Sorry {game.players[0].colour}, you have no moves available!"
-        }
-        turbo.push(
-            turbo.replace(
-                render_template('popup.html', message=message),
-                "popup_box"
-            ),
-            to=current_user.get_id()
-        )
-        game.players[0].reset_die()
-        game.next_player()
+    moves_exist = roll_die_for_player(room, current_user.get_id(), power)
+    if not moves_exist:
+        play_ai_turns(room)
         return Response(status=200)
 
     return redirect(url_for('display_game'))
 
 
 @app.route("/close_popup", methods=["POST"])
-def close_popup():
+@with_room
+def close_popup(room: rooms.Room):
     """Function to close popup when okay button pressed."""
-    turbo.push(
+    game = room.game
+    push(
         turbo.replace(
             render_template('popup.html', message={}),
             'popup_box'
         ),
+        room,
         to=current_user.get_id()
     )
     if game.players:
@@ -374,7 +997,7 @@ def close_popup():
         die_number = None
         player_colour = None
 
-    turbo.push(
+    push(
         turbo.replace(
             render_template(
                 'controls.html',
@@ -384,7 +1007,8 @@ def close_popup():
                 message={}
             ),
             'controls'
-        )
+        ),
+        room
     )
     if current_user.is_authenticated or request.form.get('type') == "new game":
         return redirect(url_for('display_game'))
@@ -394,11 +1018,14 @@ def close_popup():
 
 @app.route("/quit_game", methods=["GET", "POST"])
 @login_required
-def quit_game():
+@with_room
+@checks_version
+def quit_game(room: rooms.Room):
     """Allows a player to leave the game."""
+    game = room.game
     if request.method == "GET":
         user_id = current_user.get_id()
-        turbo.push(
+        push(
             turbo.replace(
                 render_template(
                     'popup.html',
@@ -409,6 +1036,7 @@ def quit_game():
                 ),
                 "popup_box"
             ),
+            room,
             to=user_id
         )
         return Response(status=200)
@@ -416,36 +1044,47 @@ def quit_game():
     elif request.method == "POST":
         user_id = current_user.get_id()
         game.remove_player(user_id)
-        load_user(user_id).unauthenticate_user()
-        if len(game.players) != 0:
-            turbo.push(
+        record_event(room, eventlog.QUIT, eventlog.quit_payload(user_id))
+        user = load_user(user_id)
+        user.unauthenticate_user()
+        users.save(user)
+        if not game.players:
+            die_animator.cancel(room.room_id)
+        else:
+            board_fragments.changed(room.fragment_keys, game.counters, game.finished_tokens)
+            push(
                 turbo.replace(
                     render_template(
                         'game.html',
-                        counters = game.board,
+                        counters = game.counters,
                         finished_tokens = game.finished_tokens,
                         die_number = game.players[0].die_roll,
                         player_turn = game.players[0].colour,
                         message={}
                     ),
                     "game"
-                )
+                ),
+                room
             )
         return redirect(url_for('login'))
 
 
 @app.route("/new_game", methods=["GET"])
 @login_required
-def new_game():
-    """Called to start a new game, and unauthenticate all users."""
-    global game
+@with_room
+def new_game(room: rooms.Room):
+    """Called to start a new game, and unauthenticate all users in the room."""
     # Game reset
-    game = backend.Game()
-    turbo.push(
+    room_registry.archive(room)
+    die_animator.cancel(room.room_id)
+    room.new_game()
+    push_version(room)
+    game = room.game
+    push(
         turbo.replace(
             render_template(
                 'game.html',
-                counters = game.board,
+                counters = game.counters,
                 finished_tokens = game.finished_tokens,
                 die_number = 0,
                 player_turn = "",
@@ -456,12 +1095,185 @@ def new_game():
                 }
             ),
         'game'
-        )
+        ),
+        room
     )
-    for user in users:
-        user.unauthenticate_user()
+    for user_id in room.user_ids:
+        user = load_user(user_id)
+        if user:
+            user.unauthenticate_user()
+            users.save(user)
     return redirect(url_for('login'), code=302)
 
 
-if __name__ == "app":
-    game = backend.Game()
+def recover_rooms():
+    """Rebuilds rooms from their event logs, restoring the users seated in them."""
+    for room in room_registry.recover():
+        for player in room.game.players:
+            if ai.is_ai(player.user_id):
+                continue
+            user = users.get(player.user_id) or User(player.user_id)
+            user.room_id = room.room_id
+            user.authenticate_user()
+            users.add(user)
+            room.add_user(player.user_id)
+        play_ai_turns(room)
+
+
+def instrument_app():
+    """Wraps route handlers, render_template, turbo pushes and game methods in timing hooks."""
+    global render_template
+    timed_render = render_template
+
+    def render_template(template_name, **context):
+        start = perf_counter()
+        try:
+            return timed_render(template_name, **context)
+        finally:
+            metrics_recorder.observe('trs_render_seconds', perf_counter() - start, template=template_name)
+
+    for endpoint, view in app.view_functions.items():
+        app.view_functions[endpoint] = metrics_recorder.timed('trs_request_seconds', endpoint=endpoint)(view)
+    turbo.push = metrics_recorder.timed_push(turbo.push)
+    metrics_recorder.instrument(backend.Game, ['move_piece', '_validate_move', 'check_if_moves_exist',
+                                               'legal_moves', 'remove_player', 'next_player'])
+
+
+def warm_templates():
+    """Compiles every template, loading them from the bytecode cache where it has them."""
+    for template_name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(template_name)
+    board_fragments.layout()
+
+
+def run_startup():
+    """Recovers rooms, letting requests through, then warms the templates and marks the app ready.
+
+    If either step fails, the error is logged and kept in startup_error,
+    and requests are answered 503 rather than waiting forever.
+    """
+    global startup_error
+    try:
+        recover_rooms()
+    except Exception as exception:
+        startup_error = exception
+        app.logger.exception("Recovering rooms from the event logs failed.")
+        return
+    finally:
+        rooms_recovered.set()
+
+    try:
+        warm_templates()
+    except Exception as exception:
+        startup_error = exception
+        app.logger.exception("Compiling templates failed.")
+        return
+    app_ready.set()
+
+
+def start_up():
+    """Starts the deferred startup work in a background thread, once."""
+    global startup_thread
+    with startup_lock:
+        if startup_thread is None:
+            startup_thread = Thread(target=run_startup, name='startup', daemon=True)
+            startup_thread.start()
+
+
+@app.before_request
+def wait_for_startup():
+    """Starts the deferred startup work if needed, holding requests that use rooms until recovery is done.
+
+    Requests are answered 503 if startup failed, or if recovery takes
+    longer than STARTUP_TIMEOUT_S.
+    """
+    start_up()
+    if request.endpoint in STARTUP_EXEMPT_ENDPOINTS:
+        return None
+    if not rooms_recovered.wait(STARTUP_TIMEOUT_S):
+        return Response("Starting.", status=503)
+    if startup_error:
+        return Response("Startup failed.", status=503)
+    return None
+
+
+def is_profile_admin() -> bool:
+    """Returns if the request carries the profiling token."""
+    token = request.headers.get('X-Profile-Token')
+    return bool(PROFILE_TOKEN and token and compare_digest(token, PROFILE_TOKEN))
+
+
+@app.before_request
+def start_profiling():
+    """Profiles the request if an admin asked to, and tags it with its route and room while profiles run."""
+    if not PROFILE_TOKEN:
+        return
+    profiled = is_profile_admin() and request.endpoint not in ('start_profile_window', 'get_profile')
+    if profiled or sampling_profiler.active:
+        route = request.url_rule.rule if request.url_rule else request.path
+        sampling_profiler.tag(route, getattr(current_user, 'room_id', None))
+    if profiled:
+        g.profile = sampling_profiler.start_thread()
+
+
+@app.after_request
+def name_profile(response: Response) -> Response:
+    """Tells an admin the name of the profile their request is written to."""
+    if 'profile' in g:
+        response.headers['X-Profile'] = g.profile.name
+    return response
+
+
+@app.route("/profile", methods=["POST"])
+def start_profile_window():
+    """Profiles every thread for the number of seconds posted (default 10); admins only."""
+    if not is_profile_admin():
+        return Response("Forbidden.", status=403)
+    try:
+        seconds = min(float(request.form.get('seconds', 10)), MAX_PROFILE_WINDOW_S)
+    except ValueError:
+        return Response("Invalid number of seconds.", status=400)
+    if not seconds > 0:
+        return Response("Invalid number of seconds.", status=400)
+    profile = sampling_profiler.start_window(seconds)
+    return jsonify({
+        'profile': profile.name,
+        'seconds': seconds,
+        'files': [url_for('get_profile', name=name) for name in sampling_profiler.file_names(profile)]
+    }), 202
+
+
+@app.route("/profile/<name>", methods=["GET"])
+def get_profile(name: str):
+    """Downloads a written profile file; admins only."""
+    if not is_profile_admin():
+        return Response("Forbidden.", status=403)
+    return send_from_directory(sampling_profiler.output_dir, name)
+
+
+@app.route("/ready", methods=["GET"])
+def readiness():
+    """Readiness probe: 200 once rooms are recovered and templates compiled, 503 until then or if that failed."""
+    start_up()
+    if startup_error:
+        return Response("Startup failed.", status=503)
+    if not app_ready.is_set():
+        return Response("Starting.", status=503)
+    return Response("Ready.", status=200)
+
+
+def create_app() -> Flask:
+    """Entry point for WSGI servers: returns the app with its startup work already under way.
+
+    e.g. gunicorn 'app:create_app()'. This is not a factory: the app, its
+    rooms, users and templates are still built when the module is imported,
+    and create_app only starts recovery and template compilation early.
+    Importing app and serving `app` directly works too; the startup work
+    then begins with the first request.
+    """
+    start_up()
+    return app
+
+
+if metrics_recorder.enabled:
+    instrument_app()
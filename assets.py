@@ -0,0 +1,191 @@
+"""Module containing the static asset build: die face sprite, fingerprints and precompression.
+
+build() copies every file under static/ into a build directory under a
+name carrying a hash of its contents, e.g. styles/game.3f9c0a1d2b4e.css,
+rewriting url() references in stylesheets to the fingerprinted names, and
+writes gzip (and, if the brotli module is installed, brotli) variants of
+those that compress. manifest.json maps each file to its fingerprinted
+name; StaticAssets reads it so the app can link to, and serve, the
+fingerprinted files, which never change and can be cached for a year.
+
+The seven die faces are also combined into one sprite sheet,
+images/die_faces.svg, which the die image shows by offset, so the roll
+animation never fetches an image.
+
+Run as a script before starting the app, e.g.
+    python assets.py --output static_build
+"""
+
+import gzip
+import json
+import posixpath
+import re
+import shutil
+from argparse import ArgumentParser
+from base64 import b64encode
+from hashlib import blake2b
+from os import environ, makedirs, path, walk
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+MANIFEST = 'manifest.json'
+DIE_FACES = 7
+DIE_FACE_PIXELS = 512
+SPRITE = 'images/die_faces.svg'
+# Variants are only kept when they save at least this fraction of the file.
+MIN_SAVING = 0.1
+ENCODINGS = {'br': '.br', 'gzip': '.gz'}
+CSS_URL = re.compile(r"""url\((['"]?)([^'")]+)\1\)""")
+
+
+def die_face_sprite(faces_dir: str) -> str:
+    """Returns an SVG sprite sheet of the die faces in a row, face 0 first, each scaled to a square cell."""
+    images = []
+    for number in range(DIE_FACES):
+        with open(path.join(faces_dir, f'die_face_{number}.png'), 'rb') as face:
+            data = b64encode(face.read()).decode()
+        images.append(
+            f'<image x="{number * DIE_FACE_PIXELS}" y="0" width="{DIE_FACE_PIXELS}" '
+            f'height="{DIE_FACE_PIXELS}" preserveAspectRatio="none" '
+            f'href="data:image/png;base64,{data}"/>'
+        )
+    return (
+        f'<svg xmlns="http://www.w3.org/2000/svg" width="{DIE_FACES * DIE_FACE_PIXELS}" '
+        f'height="{DIE_FACE_PIXELS}">\n' + '\n'.join(images) + '\n</svg>\n'
+    )
+
+
+def write_sprite(static_dir: str):
+    """Writes the die face sprite sheet into the static directory, if its faces changed."""
+    sprite = die_face_sprite(path.join(static_dir, 'images', 'die_faces'))
+    sprite_path = path.join(static_dir, SPRITE)
+    if path.exists(sprite_path):
+        with open(sprite_path) as existing:
+            if existing.read() == sprite:
+                return
+    with open(sprite_path, 'w') as sprite_file:
+        sprite_file.write(sprite)
+
+
+def fingerprint(name: str, content: bytes) -> str:
+    """Returns name with a hash of content before its extension."""
+    root, extension = posixpath.splitext(name)
+    return f'{root}.{blake2b(content, digest_size=6).hexdigest()}{extension}'
+
+
+def rewrite_css(name: str, css: bytes, manifest: dict) -> bytes:
+    """Returns a stylesheet with its url() references to other static files fingerprinted."""
+    directory = posixpath.dirname(name)
+
+    def replace(match: re.Match) -> str:
+        quote, url = match.groups()
+        target = posixpath.normpath(posixpath.join(directory, url))
+        if target not in manifest:
+            return match.group(0)
+        url = posixpath.relpath(manifest[target], directory)
+        return f'url({quote}{url}{quote})'
+
+    return CSS_URL.sub(replace, css.decode()).encode()
+
+
+def compress(content: bytes) -> dict:
+    """Returns the compressed variants of content worth keeping, by encoding."""
+    variants = {'gzip': gzip.compress(content, compresslevel=9, mtime=0)}
+    if brotli:
+        variants['br'] = brotli.compress(content, quality=11)
+    return {encoding: variant for encoding, variant in variants.items()
+            if len(variant) <= len(content) * (1 - MIN_SAVING)}
+
+
+def build(static_dir: str, output_dir: str) -> dict:
+    """Builds the fingerprinted, precompressed copy of static_dir in output_dir; returns the manifest.
+
+    The manifest maps each file, by its path under static_dir, to its
+    fingerprinted path and the encodings it has variants for.
+    """
+    write_sprite(static_dir)
+    names = []
+    for directory, _, files in walk(static_dir):
+        for file in files:
+            names.append(path.relpath(path.join(directory, file), static_dir).replace(path.sep, '/'))
+    # Stylesheets go last, so the files they reference are already fingerprinted.
+    names.sort(key=lambda name: (name.endswith('.css'), name))
+
+    if path.isdir(output_dir):
+        shutil.rmtree(output_dir)
+    fingerprints = {}
+    manifest = {}
+    for name in names:
+        with open(path.join(static_dir, name), 'rb') as source:
+            content = source.read()
+        if name.endswith('.css'):
+            content = rewrite_css(name, content, fingerprints)
+        fingerprinted = fingerprint(name, content)
+        variants = compress(content)
+
+        target = path.join(output_dir, fingerprinted)
+        makedirs(path.dirname(target), exist_ok=True)
+        with open(target, 'wb') as output:
+            output.write(content)
+        for encoding, variant in variants.items():
+            with open(target + ENCODINGS[encoding], 'wb') as output:
+                output.write(variant)
+        fingerprints[name] = fingerprinted
+        manifest[name] = {'path': fingerprinted, 'encodings': sorted(variants)}
+
+    with open(path.join(output_dir, MANIFEST), 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=1, sort_keys=True)
+    return manifest
+
+
+class StaticAssets():
+    """Class looking up fingerprinted static files in a build directory's manifest.
+
+    Without a manifest, every file keeps its own name.
+    """
+
+    def __init__(self, build_dir: str) -> None:
+        self.build_dir = build_dir
+        self.manifest = {}
+        manifest_path = path.join(build_dir, MANIFEST) if build_dir else None
+        if manifest_path and path.exists(manifest_path):
+            with open(manifest_path) as manifest_file:
+                self.manifest = json.load(manifest_file)
+        self.files = {entry['path']: (name, entry['encodings']) for name, entry in self.manifest.items()}
+
+    def __bool__(self) -> bool:
+        return bool(self.manifest)
+
+    def url_name(self, name: str) -> str:
+        """Returns the name to link a static file by: its fingerprinted name if it was built."""
+        entry = self.manifest.get(name)
+        return entry['path'] if entry else name
+
+    def variant(self, fingerprinted: str, accepted) -> tuple:
+        """Returns the file to send for a fingerprinted name and its encoding, or None if not built.
+
+        accepted holds the encodings the client accepts; the smallest
+        precompressed variant among them is chosen, else the file itself.
+        """
+        if fingerprinted not in self.files:
+            return None
+        _, encodings = self.files[fingerprinted]
+        for encoding in ENCODINGS:
+            if encoding in encodings and encoding in accepted:
+                return fingerprinted + ENCODINGS[encoding], encoding
+        return fingerprinted, None
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Build the fingerprinted static files of The Roman Stones.")
+    parser.add_argument('--static', default='static', help="directory of the static files")
+    parser.add_argument('--output', default=environ.get('STATIC_BUILD_DIR', 'static_build'),
+                        help="directory to build into, replacing its contents")
+    args = parser.parse_args()
+
+    manifest = build(args.static, args.output)
+    print(f"Built {len(manifest)} static files into {args.output}"
+          f"{'' if brotli else ' (gzip only: the brotli module is not installed)'}.")
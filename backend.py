@@ -1,77 +1,192 @@
 """Module containing backend workings of the game."""
 
+from array import array
 from math import ceil, sqrt
-from random import randint
+
+from dice import DiceStream
+
+NUMBER_OF_SQUARES = 28
+FINISH = NUMBER_OF_SQUARES
+
 
 class Player():
     """Class for player instances."""
+
+    __slots__ = ('colour', 'die_roll', 'user_id')
+
     def __init__(self, colour: str, user_id: str) -> None:
         self.colour = colour
         self.die_roll = 0
         self.user_id = user_id
 
-    def roll_die(self):
-        """Function to randomly roll die if it is currently zero."""
+    def roll_die(self, dice: DiceStream):
+        """Function to roll die from the game's dice stream if it is currently zero."""
         if self.die_roll == 0:
-            self.die_roll = randint(1,6)
+            self.die_roll = dice.roll()
 
     def reset_die(self):
         self.die_roll = 0
 
 
+class Board():
+    """Class storing the number of counters of each colour on each square.
+
+    Square FINISH holds the counters that have left the board. The squares
+    each colour occupies, and the squares holding two or more counters, are
+    kept up to date as counters move so legal moves can be found without
+    scanning the board.
+    """
+
+    __slots__ = ('capacity', 'counts', 'totals', 'occupied', 'crowded')
+
+    def __init__(self, capacity: int = 9) -> None:
+        self.capacity = capacity
+        self.counts = {}
+        self.totals = array('B', [0] * (FINISH + 1))
+        self.occupied = {}
+        self.crowded = set()
+
+    def _update_index(self, colour: str, index: int):
+        """Updates the occupied and crowded squares after a change at index."""
+        if index == FINISH:
+            return
+
+        if self.counts[colour][index]:
+            self.occupied[colour].add(index)
+        else:
+            self.occupied[colour].discard(index)
+
+        if self.totals[index] >= 2:
+            self.crowded.add(index)
+        else:
+            self.crowded.discard(index)
+
+    def add_colour(self, colour: str):
+        """Adds a row of empty squares for a colour."""
+        if colour not in self.counts:
+            self.counts[colour] = array('B', [0] * (FINISH + 1))
+            self.occupied[colour] = set()
+
+    def remove_colour(self, colour: str):
+        """Removes all counters of a colour from the board."""
+        squares = self.counts.pop(colour, None)
+        if squares is None:
+            return
+
+        for index in self.occupied.pop(colour):
+            self.totals[index] -= squares[index]
+            if self.totals[index] < 2:
+                self.crowded.discard(index)
+        self.totals[FINISH] -= squares[FINISH]
+
+    def add(self, colour: str, index: int, number: int = 1):
+        """Adds counters of a colour to the square at index."""
+        self.counts[colour][index] += number
+        self.totals[index] += number
+        self._update_index(colour, index)
+
+    def remove(self, colour: str, index: int, number: int = 1):
+        """Removes counters of a colour from the square at index."""
+        squares = self.counts[colour]
+        if squares[index] < number:
+            raise ValueError(f"Not enough {colour} counters on square {index}.")
+        squares[index] -= number
+        self.totals[index] -= number
+        self._update_index(colour, index)
+
+    def count(self, colour: str, index: int) -> int:
+        """Number of counters of a colour on the square at index."""
+        squares = self.counts.get(colour)
+        return squares[index] if squares else 0
+
+    def is_blocked(self, index: int, colour: str) -> bool:
+        """A square blocks a colour if it holds two or more counters of mixed colour."""
+        total = self.totals[index]
+        return total >= 2 and self.count(colour, index) < total
+
+    def legal_moves(self, colour: str, die_roll: int) -> list[int]:
+        """Squares from which a counter of a colour can move die_roll squares."""
+        if die_roll == 0:
+            return []
+
+        blocks = [index for index in self.crowded if self.is_blocked(index, colour)]
+        return sorted(
+            index for index in self.occupied.get(colour, ())
+            if index + die_roll <= FINISH
+            and not any(index < block < index + die_roll for block in blocks)
+        )
+
+    def square(self, index: int) -> list:
+        """List of counter colours on the square at index, grouped by colour."""
+        return [colour for colour, squares in self.counts.items()
+                for _ in range(squares[index])]
+
+    def as_lists(self) -> list[list]:
+        """Board in the list-of-lists layout used by the templates."""
+        return [self.square(index) + [None] * (self.capacity - self.totals[index])
+                for index in range(NUMBER_OF_SQUARES)]
+
+
 class Game():
-    """Class for game instance."""
+    """Class for game instance.
+
+    Rolls come from the game's own DiceStream, so a game played again
+    with the same seed and moves rolls the same dice.
+    """
 
-    def __init__(self) -> None:
+    __slots__ = ('players', 'number_of_players', 'counters_per_player', 'board', 'dice')
+
+    def __init__(self, seed: int = None) -> None:
         self.players = []
         self.number_of_players = 0
         self.counters_per_player = 0
-        self.board = [[None] * 9 for i in range(28)]
-        self.finished_tokens = []
+        self.board = Board()
+        self.dice = DiceStream(seed)
 
 
     def _remove_piece(self, colour, index):
-        """Replaces counter at given index on board with None."""
-        position = self.board[index].index(colour)
-        self.board[index][position] = None
+        """Removes a counter of the given colour from the square at index."""
+        self.board.remove(colour, index)
+
 
-    
     def _add_piece(self, colour, index):
-        """Replaces first None at given index on board with colour."""
-        position = self.board[index].index(None)
-        self.board[index][position] = colour
+        """Adds a counter of the given colour to the square at index."""
+        self.board.add(colour, index)
+
 
-    
     def set_num_players_and_counters(self, number_of_players: int, counters_per_player: int):
         self.number_of_players = number_of_players
         self.counters_per_player = counters_per_player
-        self.board = [[None] * (ceil(sqrt(self.total_number_of_counters))**2) for i in range(28)]
+        self.board = Board(ceil(sqrt(self.total_number_of_counters))**2)
 
 
     def remove_player(self, user_id: str):
-        """Removes a player from the game"""
+        """Removes a player from the game, if seated"""
         for player in self.players:
             if player.user_id == user_id:
-                colour = player.colour
                 self.players.remove(player)
-
-        for square in self.board:
-            for i, counter in enumerate(square):
-                if counter == colour:
-                    square[i] = None
-
-        for counter in self.finished_tokens:
-            if counter == colour:
-                self.finished_tokens.remove(counter)
-        
-        self.number_of_players -= 1
+                self.board.remove_colour(player.colour)
+                self.number_of_players -= 1
+                break
 
 
     def add_player(self, player: Player):
         """Function to add player to the board."""
         self.players.append(player)
-        for i in range(self.counters_per_player):
-            self._add_piece(player.colour, 0)
+        self.board.add_colour(player.colour)
+        self.board.add(player.colour, 0, self.counters_per_player)
+
+
+    @property
+    def counters(self) -> list[list]:
+        """Board in the list-of-lists layout used by the templates."""
+        return self.board.as_lists()
+
+
+    @property
+    def finished_tokens(self) -> list[str]:
+        """List of colours of the counters that have left the board."""
+        return self.board.square(FINISH)
 
 
     @property
@@ -100,12 +215,14 @@ class Game():
         
         die_roll = self.players[0].die_roll
         
-        if current_index + die_roll > 28:
+        if (current_index < 0) or (current_index + die_roll > FINISH):
+            return False
+
+        if self.board.count(colour, current_index) == 0:
             return False
 
-        for place in self.board[current_index+1:current_index+die_roll]:
-            num_counters = len([counter for counter in place if counter])
-            if (num_counters >= 2) and (place.count(colour) < num_counters):
+        for i in self.board.crowded:
+            if (current_index < i < current_index + die_roll) and self.board.is_blocked(i, colour):
                 return False
             
         return True
@@ -113,13 +230,16 @@ class Game():
     
     def check_if_moves_exist(self) -> bool:
         """Function to check if any moves are available for the current player."""
-        colour = self.players[0].colour
+        return bool(self.legal_moves())
 
-        for i, place in enumerate(self.board):
-            if (colour in place) and self._validate_move(i, colour):
-                return True
 
-        return False
+    def legal_moves(self) -> list[int]:
+        """Squares from which the current player can move with their die roll."""
+        if not self.players:
+            return []
+
+        player = self.players[0]
+        return self.board.legal_moves(player.colour, player.die_roll)
 
 
     def next_player(self):
@@ -127,7 +247,7 @@ class Game():
         player = self.players.pop(0)
         self.players.append(player)
         for i, player in enumerate(self.players):
-            if self.finished_tokens.count(player.colour) < self.counters_per_player:
+            if self.board.count(player.colour, FINISH) < self.counters_per_player:
                 self.players = self.players[i:] + self.players[:i]
                 return True
             
@@ -136,7 +256,7 @@ class Game():
 
     def check_win(self, colour: str) -> bool:
         """Function to check if the game has been won by a given colour."""
-        if self.finished_tokens.count(colour) == self.counters_per_player:
+        if self.board.count(colour, FINISH) == self.counters_per_player:
             return True
         
         return False
@@ -151,16 +271,16 @@ class Game():
 
         self._remove_piece(colour, current_index)
 
-        for i in range(current_index + 1, current_index + die_roll):
-            for counter in self.board[i]:
-                if (counter != colour) and (i % 7 != 0):
-                    self._remove_piece(counter, i)
-                    self._add_piece(counter, 0)
+        for other_colour, occupied in self.board.occupied.items():
+            if other_colour == colour:
+                continue
+            for i in [i for i in occupied if current_index < i < current_index + die_roll]:
+                if i % 7 != 0:
+                    number = self.board.counts[other_colour][i]
+                    self.board.remove(other_colour, i, number)
+                    self.board.add(other_colour, 0, number)
 
-        if current_index + die_roll == 28:
-            self.finished_tokens.append(colour)
-        else:
-            self._add_piece(colour, current_index + die_roll)
+        self._add_piece(colour, current_index + die_roll)
 
         self.players[0].reset_die()
         self.next_player()
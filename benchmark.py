@@ -0,0 +1,307 @@
+"""Module containing benchmarks of the game engine, page rendering and request hot paths.
+
+Every benchmark runs on a mid-game position for each combination of
+PLAYER_COUNTS and COUNTER_COUNTS (boards sized to the
+ceil(sqrt(total))**2 square capacity the game uses). Request benchmarks
+go through the Flask test client with turbo's websocket clients stubbed.
+
+Run as a script to save results as JSON, e.g.
+    python benchmark.py --output baseline.json
+and compare a later run against them, exiting non-zero on regressions:
+    python benchmark.py --compare baseline.json --threshold 0.2
+"""
+
+import json
+import platform
+import sys
+from argparse import ArgumentParser
+from datetime import datetime, timezone
+from math import ceil, sqrt
+from os import environ
+from random import Random
+from statistics import median
+from time import perf_counter_ns
+
+import backend
+import eventlog
+
+PLAYER_COUNTS = (2, 4, 6, 8, 10)
+COUNTER_COUNTS = (1, 2, 4, 8)
+COLOURS = ['red', 'orange', 'yellow', 'green', 'blue', 'indigo',
+           'violet', 'teal', 'maroon', 'black']
+
+
+def measure(run, setup=None, number: int = 500) -> dict:
+    """Times number calls of run(state), state coming from setup() outside the timing."""
+    samples = []
+    for _ in range(number):
+        state = setup() if setup else None
+        start = perf_counter_ns()
+        run(state)
+        samples.append(perf_counter_ns() - start)
+
+    return summarise(samples)
+
+
+def summarise(samples: list[int]) -> dict:
+    """Returns the statistics saved for a benchmark from per-call times in nanoseconds."""
+    return {
+        'median_ns': median(samples),
+        'min_ns': min(samples),
+        'mean_ns': sum(samples) / len(samples),
+        'calls': len(samples)
+    }
+
+
+def new_game(number_of_players: int, counters_per_player: int, seed: int = None) -> backend.Game:
+    """Returns a game with every seat filled, as at the start of play."""
+    game = backend.Game(seed)
+    game.set_num_players_and_counters(number_of_players, counters_per_player)
+    for seat in range(number_of_players):
+        game.add_player(backend.Player(COLOURS[seat], str(seat)))
+
+    return game
+
+
+def midgame(number_of_players: int, counters_per_player: int, seed: int = 0) -> backend.Game:
+    """Returns a game after random play of eight turns per counter, or until someone finishes."""
+    rng = Random(seed)
+    game = new_game(number_of_players, counters_per_player, seed)
+    for _ in range(8 * game.total_number_of_counters):
+        player = game.players[0]
+        player.roll_die(game.dice)
+        moves = game.legal_moves()
+        if not moves:
+            player.reset_die()
+            game.next_player()
+            continue
+        game.move_piece(rng.choice(moves), player.colour, player.user_id)
+        if game.check_win(player.colour):
+            break
+
+    return game
+
+
+def clone(game: backend.Game) -> backend.Game:
+    """Returns an independent copy of a game."""
+    return eventlog.restore_game(eventlog.snapshot_game(game))
+
+
+def with_move(game: backend.Game) -> backend.Game:
+    """Sets the current player's die to the lowest roll that gives a legal move."""
+    player = game.players[0]
+    for die_roll in range(1, 7):
+        player.die_roll = die_roll
+        if game.legal_moves():
+            return game
+    player.die_roll = 1
+    return game
+
+
+def configurations():
+    """Yields (label, number of players, counters per player) for every benchmarked size."""
+    for number_of_players in PLAYER_COUNTS:
+        for counters_per_player in COUNTER_COUNTS:
+            yield f'p{number_of_players}c{counters_per_player}', number_of_players, counters_per_player
+
+
+def engine_benchmarks(number: int) -> dict:
+    """Times the backend.Game methods on the hot paths of a turn."""
+    results = {}
+    for label, number_of_players, counters_per_player in configurations():
+        base = with_move(midgame(number_of_players, counters_per_player))
+        player = base.players[0]
+        moves = base.legal_moves() or [0]
+
+        results[f'move_piece[{label}]'] = measure(
+            lambda game: game.move_piece(moves[0], player.colour, player.user_id),
+            lambda: clone(base), number)
+        results[f'validate_move[{label}]'] = measure(
+            lambda _: [base._validate_move(index, player.colour)
+                       for index in range(backend.NUMBER_OF_SQUARES)],
+            number=number)
+        results[f'check_if_moves_exist[{label}]'] = measure(
+            lambda _: base.check_if_moves_exist(), number=number)
+        results[f'remove_player[{label}]'] = measure(
+            lambda game: game.remove_player(game.players[-1].user_id),
+            lambda: clone(base), number)
+        cycling = clone(base)
+        results[f'next_player[{label}]'] = measure(lambda _: cycling.next_player(), number=number)
+
+    return results
+
+
+class StubClients(dict):
+    """Stands in for turbo's websocket clients: everyone is connected and pushes are counted."""
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.messages = 0
+        self.bytes = 0
+
+    def __contains__(self, user_id) -> bool:
+        return True
+
+    def __getitem__(self, user_id) -> list:
+        return [self]
+
+    def __bool__(self) -> bool:
+        return True
+
+    def send(self, stream: str):
+        self.messages += 1
+        self.bytes += len(stream)
+
+
+def load_app():
+    """Imports the app with turbo stubbed, without event logs or server-side die animation."""
+    environ.setdefault('SECRET_KEY', 'benchmark')
+    environ.setdefault('EVENT_LOG_DIR', '')
+    environ.setdefault('DIE_ANIMATION', 'client')
+    import app
+    app.turbo.clients = StubClients()
+    return app
+
+
+def render_benchmarks(number: int) -> dict:
+    """Times full renders of TRS.html and board.html."""
+    from flask import render_template
+
+    app = load_app()
+    results = {}
+    for label, number_of_players, counters_per_player in configurations():
+        game = with_move(midgame(number_of_players, counters_per_player))
+        context = {
+            'counters': game.counters,
+            'counters_per_square': max(ceil(sqrt(game.total_number_of_counters)), 3),
+            'finished_tokens': game.finished_tokens,
+            'die_number': game.players[0].die_roll,
+            'player_turn': game.players[0].colour,
+            'playable': game.legal_moves(),
+            'message': {}
+        }
+        with app.app.test_request_context():
+            results[f'render_trs[{label}]'] = measure(
+                lambda _: render_template('TRS.html', **context), number=number)
+            results[f'render_board[{label}]'] = measure(
+                lambda _: render_template('board.html', **context), number=number)
+
+    return results
+
+
+def seat_clients(app, room_id: str, number_of_players: int, counters_per_player: int) -> dict:
+    """Logs a test client into every seat of a new room; returns clients by user id."""
+    clients = {}
+    for seat in range(number_of_players):
+        client = app.app.test_client()
+        client.get(f'/rooms/{room_id}')
+        data = {'colour': COLOURS[seat]}
+        if seat == 0:
+            data.update(num_players=number_of_players, counters_per_player=counters_per_player)
+        client.post('/login', data=data)
+        clients[app.room_registry.get(room_id).game.players[-1].user_id] = client
+
+    return clients
+
+
+def request_benchmarks(number: int) -> dict:
+    """Times /roll_die and /move_piece end to end through the Flask test client."""
+    app = load_app()
+    results = {}
+    for label, number_of_players, counters_per_player in configurations():
+        rolls, moves = [], []
+        games = 0
+        while len(moves) < number:
+            room_id = f'benchmark-{label}-{games}'
+            clients = seat_clients(app, room_id, number_of_players, counters_per_player)
+            room = app.room_registry.get(room_id)
+            games += 1
+            while not room.finished and len(moves) < number:
+                player = room.game.players[0]
+                client = clients[player.user_id]
+
+                start = perf_counter_ns()
+                client.post('/roll_die', data={'power': 1})
+                rolls.append(perf_counter_ns() - start)
+
+                legal = room.game.legal_moves() if room.game.players[0] is player else []
+                if legal:
+                    start = perf_counter_ns()
+                    client.post('/move_piece', data={'square_num': legal[-1], 'colour': player.colour})
+                    moves.append(perf_counter_ns() - start)
+
+        results[f'roll_die_request[{label}]'] = summarise(rolls)
+        results[f'move_piece_request[{label}]'] = summarise(moves)
+
+    return results
+
+
+SUITES = {
+    'engine': engine_benchmarks,
+    'render': render_benchmarks,
+    'requests': request_benchmarks
+}
+
+
+def run(suites=SUITES, number: int = 500, request_number: int = 100) -> dict:
+    """Runs benchmark suites and returns the results with details of the machine."""
+    results = {}
+    for name in suites:
+        results.update(SUITES[name](request_number if name == 'requests' else number))
+
+    return {
+        'created': datetime.now(timezone.utc).isoformat(),
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'results': results
+    }
+
+
+def compare(results: dict, baseline: dict, threshold: float = 0.2) -> list[dict]:
+    """Returns the benchmarks whose median is more than threshold slower than the baseline's."""
+    regressions = []
+    for name, current in results['results'].items():
+        previous = baseline['results'].get(name)
+        if previous is None or previous['median_ns'] == 0:
+            continue
+        ratio = current['median_ns'] / previous['median_ns']
+        if ratio > 1 + threshold:
+            regressions.append({
+                'name': name,
+                'baseline_ns': previous['median_ns'],
+                'median_ns': current['median_ns'],
+                'ratio': ratio
+            })
+
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Benchmark The Roman Stones.")
+    parser.add_argument('--suite', choices=SUITES, nargs='*', default=list(SUITES))
+    parser.add_argument('--number', type=int, default=500,
+                        help="timed calls per engine and render benchmark")
+    parser.add_argument('--request-number', type=int, default=100,
+                        help="timed requests per request benchmark")
+    parser.add_argument('--output', help="file to save the results to as JSON")
+    parser.add_argument('--compare', help="JSON results to compare against")
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help="fractional slowdown of the median counted as a regression")
+    args = parser.parse_args()
+
+    results = run(args.suite, args.number, args.request_number)
+    for name, result in results['results'].items():
+        print(f"{name:40} {result['median_ns'] / 1000:10.1f} us")
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            regressions = compare(results, json.load(baseline_file), args.threshold)
+        for regression in regressions:
+            print(f"REGRESSION {regression['name']}: {regression['baseline_ns'] / 1000:.1f} us"
+                  f" -> {regression['median_ns'] / 1000:.1f} us ({regression['ratio']:.2f}x)")
+        if regressions:
+            sys.exit(1)
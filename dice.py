@@ -0,0 +1,53 @@
+"""Module containing the seeded die roll streams of games.
+
+Each game owns a DiceStream, so rolls never contend on a shared generator
+and a game can be reproduced from its seed. Rolls are drawn in blocks of
+BLOCK_ROLLS from NumPy generators, block n seeded from (seed, n) alone,
+so the roll at any index is the same however the stream got there, and a
+stream resumes at (seed, index) without replaying the rolls before it.
+The faces shown while a roll is animated come from a separate stream
+keyed by the roll's index, so they never shift the rolls of the game.
+"""
+
+from secrets import randbits
+
+BLOCK_ROLLS = 256
+ROLLS = 0
+FRAMES = 1
+
+
+def _generator(seed: int, stream: int, key: int):
+    """Returns a NumPy generator seeded from seed, a stream and a key within it."""
+    import numpy as np
+
+    return np.random.Generator(np.random.PCG64(np.random.SeedSequence(seed, spawn_key=(stream, key))))
+
+
+def roll_block(seed: int, block_number: int):
+    """Returns the NumPy array of BLOCK_ROLLS rolls in block block_number of the stream with seed."""
+    return _generator(seed, ROLLS, block_number).integers(1, 7, size=BLOCK_ROLLS, dtype='uint8')
+
+
+class DiceStream():
+    """Class for a game's stream of die rolls, from a seed and the index of the next roll."""
+
+    __slots__ = ('seed', 'index', '_block', '_block_number')
+
+    def __init__(self, seed: int = None, index: int = 0) -> None:
+        self.seed = randbits(64) if seed is None else seed
+        self.index = index
+        self._block = None
+        self._block_number = None
+
+    def roll(self) -> int:
+        """Returns the next roll, from 1 to 6."""
+        block_number, offset = divmod(self.index, BLOCK_ROLLS)
+        if block_number != self._block_number:
+            self._block = roll_block(self.seed, block_number).tolist()
+            self._block_number = block_number
+        self.index += 1
+        return self._block[offset]
+
+    def frames(self, roll_index: int, number: int) -> list[int]:
+        """Returns the faces to show while animating the roll at roll_index."""
+        return _generator(self.seed, FRAMES, roll_index).integers(1, 7, size=number, dtype='uint8').tolist()
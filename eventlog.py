@@ -0,0 +1,347 @@
+"""Module containing the append-only event logs that let games survive a restart.
+
+Each room has a log file of binary records and a snapshot file. A record
+is a header of (sequence number, event type, payload length, CRC32 of the
+payload) followed by the payload. A game's history (kept in memory and in
+snapshots, for replays) uses shorter records of (event type, payload
+length) followed by the payload. Every SNAPSHOT_EVERY events the game is
+snapshotted and the log restarted, so recovery replays at most that many
+events. Writes are fsynced in batches by a single background thread.
+"""
+
+import json
+import os
+import struct
+import zlib
+from base64 import b64decode, b64encode
+from threading import Lock, Thread
+from time import sleep
+
+import backend
+from dice import DiceStream
+
+HEADER = struct.Struct('<IBHI')
+RECORD = struct.Struct('<BB')
+
+JOIN = 1
+ROLL = 2
+MOVE = 3
+QUIT = 4
+NEW_GAME = 5
+
+EVENT_NAMES = {JOIN: 'join', ROLL: 'roll', MOVE: 'move', QUIT: 'quit', NEW_GAME: 'new_game'}
+
+SNAPSHOT_EVERY = 200
+# Longest string, payload or count a one-byte field of a record holds.
+MAX_FIELD = 255
+
+
+def pack_strings(*strings: str) -> bytes:
+    """Packs strings as length-prefixed UTF-8; raises ValueError for one over 255 bytes."""
+    packed = b''
+    for string in strings:
+        encoded = string.encode()
+        if len(encoded) > MAX_FIELD:
+            raise ValueError(f"{string[:16]!r}... is longer than {MAX_FIELD} bytes.")
+        packed += struct.pack('<B', len(encoded)) + encoded
+    return packed
+
+
+def unpack_strings(payload: bytes, offset: int = 0) -> list[str]:
+    """Unpacks length-prefixed UTF-8 strings from offset to the end of payload."""
+    strings = []
+    while offset < len(payload):
+        length = payload[offset]
+        strings.append(payload[offset + 1:offset + 1 + length].decode())
+        offset += 1 + length
+    return strings
+
+
+def join_payload(colour: str, user_id: str, number_of_players: int = 0,
+                 counters_per_player: int = 0) -> bytes:
+    """Packs a join; raises ValueError if a field does not fit, before anything is changed."""
+    if not (0 <= number_of_players <= MAX_FIELD and 0 <= counters_per_player <= MAX_FIELD):
+        raise ValueError(f"Player and counter numbers must be from 0 to {MAX_FIELD}.")
+    payload = struct.pack('<BB', number_of_players, counters_per_player) + pack_strings(colour, user_id)
+    if len(payload) > MAX_FIELD:
+        raise ValueError(f"A join record cannot be longer than {MAX_FIELD} bytes.")
+    return payload
+
+
+def roll_payload(die_roll: int, seed: int = None, roll_index: int = None) -> bytes:
+    """Packs a roll, with the seed and index it was drawn at if it came from the game's dice."""
+    if seed is None:
+        return struct.pack('<B', die_roll)
+    return struct.pack('<BQI', die_roll, seed, roll_index)
+
+
+def move_payload(square_num: int, colour: str) -> bytes:
+    return struct.pack('<B', square_num) + pack_strings(colour)
+
+
+def quit_payload(user_id: str) -> bytes:
+    return pack_strings(user_id)
+
+
+def encode_record(event_type: int, payload: bytes = b'') -> bytes:
+    """Encodes an event as a history record; raises ValueError for a payload over 255 bytes."""
+    if len(payload) > MAX_FIELD:
+        raise ValueError(f"A history record cannot be longer than {MAX_FIELD} bytes.")
+    return RECORD.pack(event_type, len(payload)) + payload
+
+
+def decode_records(data: bytes):
+    """Yields (event type, payload) from history records."""
+    offset = 0
+    while offset + RECORD.size <= len(data):
+        event_type, length = RECORD.unpack_from(data, offset)
+        offset += RECORD.size
+        yield event_type, bytes(data[offset:offset + length])
+        offset += length
+
+
+def count_records(data: bytes) -> int:
+    """Returns the number of history records in data."""
+    return sum(1 for _ in decode_records(data))
+
+
+def describe_event(event_type: int, payload: bytes) -> dict:
+    """Returns an event as JSON-serialisable data."""
+    event = {'event': EVENT_NAMES[event_type]}
+    if event_type == JOIN:
+        event['number_of_players'], event['counters_per_player'] = struct.unpack_from('<BB', payload)
+        event['colour'], event['user_id'] = unpack_strings(payload, 2)
+    elif event_type == ROLL:
+        event['die_roll'] = payload[0]
+        if len(payload) > 1:
+            event['seed'], event['roll_index'] = struct.unpack_from('<QI', payload, 1)
+    elif event_type == MOVE:
+        event['square_num'] = payload[0]
+        (event['colour'],) = unpack_strings(payload, 1)
+    elif event_type == QUIT:
+        (event['user_id'],) = unpack_strings(payload)
+    return event
+
+
+def without_dice(event_type: int, payload: bytes) -> tuple[int, bytes]:
+    """Returns an event with a roll's seed and index left out, as they would let anyone predict later rolls."""
+    if event_type == ROLL:
+        return event_type, payload[:1]
+    return event_type, payload
+
+
+def replay(history: bytes, number_of_events: int = None) -> backend.Game:
+    """Returns the game after the first number_of_events events of a history (all if None)."""
+    game = backend.Game()
+    for count, (event_type, payload) in enumerate(decode_records(history)):
+        if number_of_events is not None and count >= number_of_events:
+            break
+        game = apply_event(game, event_type, payload)
+    return game
+
+
+def snapshot_game(game: backend.Game, include_dice: bool = True) -> dict:
+    """Returns the state of a game as JSON-serialisable data; include_dice adds the dice stream's position."""
+    snapshot = {
+        'players': [[player.colour, player.user_id, player.die_roll] for player in game.players],
+        'number_of_players': game.number_of_players,
+        'counters_per_player': game.counters_per_player,
+        'capacity': game.board.capacity,
+        'counts': {colour: list(squares) for colour, squares in game.board.counts.items()}
+    }
+    if include_dice:
+        snapshot['dice'] = [game.dice.seed, game.dice.index]
+    return snapshot
+
+
+def restore_game(snapshot: dict) -> backend.Game:
+    """Builds a game from the data returned by snapshot_game."""
+    game = backend.Game()
+    game.number_of_players = snapshot['number_of_players']
+    game.counters_per_player = snapshot['counters_per_player']
+    game.board = backend.Board(snapshot['capacity'])
+    if 'dice' in snapshot:
+        game.dice = DiceStream(*snapshot['dice'])
+    for colour, user_id, die_roll in snapshot['players']:
+        player = backend.Player(colour, user_id)
+        player.die_roll = die_roll
+        game.players.append(player)
+    for colour, squares in snapshot['counts'].items():
+        game.board.add_colour(colour)
+        for index, count in enumerate(squares):
+            if count:
+                game.board.add(colour, index, count)
+    return game
+
+
+def apply_event(game: backend.Game, event_type: int, payload: bytes) -> backend.Game:
+    """Applies a logged event to a game, returning the game (a new one for NEW_GAME)."""
+    if event_type == JOIN:
+        number_of_players, counters_per_player = struct.unpack_from('<BB', payload)
+        colour, user_id = unpack_strings(payload, 2)
+        if number_of_players and counters_per_player and not game.number_of_players:
+            game.set_num_players_and_counters(number_of_players, counters_per_player)
+        game.add_player(backend.Player(colour, user_id))
+    elif event_type == ROLL:
+        game.players[0].die_roll = payload[0]
+        if len(payload) > 1:
+            seed, roll_index = struct.unpack_from('<QI', payload, 1)
+            game.dice = DiceStream(seed, roll_index + 1)
+        if not game.check_if_moves_exist():
+            game.players[0].reset_die()
+            game.next_player()
+    elif event_type == MOVE:
+        (colour,) = unpack_strings(payload, 1)
+        game.move_piece(payload[0], colour, game.players[0].user_id)
+    elif event_type == QUIT:
+        (user_id,) = unpack_strings(payload)
+        game.remove_player(user_id)
+    elif event_type == NEW_GAME:
+        game = backend.Game()
+    return game
+
+
+def read_records(path: str):
+    """Yields (sequence, event type, payload) from a log, stopping at a torn or corrupt record."""
+    if not os.path.exists(path):
+        return
+    with open(path, 'rb') as log_file:
+        data = log_file.read()
+
+    offset = 0
+    while offset + HEADER.size <= len(data):
+        sequence, event_type, length, checksum = HEADER.unpack_from(data, offset)
+        payload = data[offset + HEADER.size:offset + HEADER.size + length]
+        if len(payload) < length or zlib.crc32(payload) != checksum:
+            return
+        yield sequence, event_type, payload
+        offset += HEADER.size + length
+
+
+class EventLog():
+    """Class for the event log and snapshot of one room."""
+
+    def __init__(self, directory: str, room_id: str, syncer: "Syncer" = None) -> None:
+        name = room_id.encode().hex()
+        self.log_path = os.path.join(directory, f'{name}.log')
+        self.snapshot_path = os.path.join(directory, f'{name}.snap')
+        self.room_id = room_id
+        self.syncer = syncer
+        self.sequence = 0
+        self.events_since_snapshot = 0
+        self._lock = Lock()
+        self._file = None
+
+    def recover(self) -> tuple[backend.Game, bytearray]:
+        """Rebuilds the game and its history from the snapshot and the log.
+
+        Also opens the log for appending.
+        """
+        game = backend.Game()
+        history = bytearray()
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, 'rb') as snapshot_file:
+                snapshot = json.loads(zlib.decompress(snapshot_file.read()))
+            self.sequence = snapshot['sequence']
+            game = restore_game(snapshot['game'])
+            history = bytearray(b64decode(snapshot['history']))
+
+        for sequence, event_type, payload in read_records(self.log_path):
+            if sequence <= self.sequence:
+                continue
+            game = apply_event(game, event_type, payload)
+            if event_type == NEW_GAME:
+                history = bytearray()
+            else:
+                history += encode_record(event_type, payload)
+            self.sequence = sequence
+            self.events_since_snapshot += 1
+
+        # Rewrite from a fresh snapshot, dropping any torn tail.
+        self.snapshot(game, history)
+        return game, history
+
+    def append(self, game: backend.Game, history: bytes, event_type: int, payload: bytes = b''):
+        """Appends an event (already applied to game and history), snapshotting when due."""
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.log_path, 'ab')
+            self.sequence += 1
+            self._file.write(HEADER.pack(self.sequence, event_type, len(payload), zlib.crc32(payload)) + payload)
+            self.events_since_snapshot += 1
+        if self.syncer:
+            self.syncer.mark_dirty(self)
+        if self.events_since_snapshot >= SNAPSHOT_EVERY:
+            self.snapshot(game, history)
+
+    def snapshot(self, game: backend.Game, history: bytes):
+        """Writes a snapshot atomically and restarts the log after it."""
+        with self._lock:
+            data = zlib.compress(json.dumps({
+                'sequence': self.sequence,
+                'game': snapshot_game(game),
+                'history': b64encode(history).decode()
+            }).encode())
+            temporary_path = self.snapshot_path + '.tmp'
+            with open(temporary_path, 'wb') as snapshot_file:
+                snapshot_file.write(data)
+                snapshot_file.flush()
+                os.fsync(snapshot_file.fileno())
+            os.replace(temporary_path, self.snapshot_path)
+
+            if self._file is not None:
+                self._file.close()
+            self._file = open(self.log_path, 'wb')
+            self.events_since_snapshot = 0
+
+    def sync(self):
+        """Flushes and fsyncs the log."""
+        with self._lock:
+            if self._file is not None:
+                self._file.flush()
+                os.fsync(self._file.fileno())
+
+    def delete(self):
+        """Closes the log and removes its files."""
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            for path in (self.log_path, self.snapshot_path):
+                if os.path.exists(path):
+                    os.remove(path)
+
+
+class Syncer():
+    """Class fsyncing every log written to in the last interval, from one background thread."""
+
+    def __init__(self, interval_s: float = 0.05) -> None:
+        self.interval_s = interval_s
+        self._dirty = set()
+        self._lock = Lock()
+        self._thread = Thread(target=self._run, name='event-log-syncer', daemon=True)
+        self._thread.start()
+
+    def mark_dirty(self, event_log: EventLog):
+        """Queues a log to be fsynced in the next batch."""
+        with self._lock:
+            self._dirty.add(event_log)
+
+    def sync_all(self):
+        """Fsyncs every queued log."""
+        with self._lock:
+            dirty, self._dirty = self._dirty, set()
+        for event_log in dirty:
+            event_log.sync()
+
+    def _run(self):
+        while True:
+            sleep(self.interval_s)
+            self.sync_all()
+
+
+def room_ids(directory: str) -> list[str]:
+    """Returns the ids of rooms with logs in a directory."""
+    names = {os.path.splitext(name)[0] for name in os.listdir(directory)
+             if name.endswith(('.log', '.snap'))}
+    return [bytes.fromhex(name).decode() for name in names]
@@ -0,0 +1,151 @@
+"""Module containing the cached rendering of board fragments."""
+
+import json
+import re
+from functools import lru_cache
+
+from markupsafe import Markup
+
+SQUARE_LABELS = ['S', 'I', 'II', 'III', 'IV', 'V', 'VI',
+                 'S', 'VII', 'IIX', 'IX', 'X', 'XI', 'XII',
+                 'S', 'XIII', 'XIV', 'XV', 'XVI', 'XVII', 'XIIX',
+                 'S', 'XIX', 'XX', 'XXI', 'XXII', 'XXIII', 'XXIV']
+
+# Sides of the board in page order, with the squares along each; rows run
+# left to right and columns top to bottom.
+BOARD_LAYOUT = [
+    ('top', 'row', (14, 13, 12, 11, 10, 9, 8, 7)),
+    ('left', 'column', (15, 16, 17, 18, 19, 20)),
+    ('center_image', None, ()),
+    ('right', 'column', (6, 5, 4, 3, 2, 1)),
+    ('bottom', 'row', (21, 22, 23, 24, 25, 26, 27, 0))
+]
+SLOT_PATTERN = re.compile(r'<!--square:(\d+)-->')
+
+
+class BoardFragments():
+    """Class rendering board squares and the off board area, caching each fragment.
+
+    Fragments are keyed by their contents (only the occupied slots, so not
+    the square capacity), so a square holding the same counters renders
+    once however many games or pushes show it. The board's static markup
+    is rendered once from BOARD_LAYOUT and the squares spliced into it.
+
+    With rendering 'json' the squares are left empty and the counters sent
+    as a compact board_state element that static/scripts/board.js draws.
+    """
+
+    def __init__(self, jinja_env, maxsize: int = 4096, rendering: str = 'html') -> None:
+        self.jinja_env = jinja_env
+        self.rendering = rendering
+        self._render_square = lru_cache(maxsize)(self._render_square)
+        self._render_off_board = lru_cache(maxsize)(self._render_off_board)
+        self._layout = None
+        self._empty = None
+
+    def _render_square(self, index: int, counters: tuple, playable: bool, player_turn: str) -> Markup:
+        return Markup(self.jinja_env.get_template('square.html').render(
+            index=index,
+            label=SQUARE_LABELS[index],
+            counters=counters,
+            playable=playable,
+            player_turn=player_turn
+        ))
+
+    def _render_off_board(self, finished_tokens: tuple) -> Markup:
+        return Markup(self.jinja_env.get_template('off_board.html').render(
+            finished_tokens=finished_tokens
+        ))
+
+    def layout(self) -> list:
+        """Returns the board's static markup split around its squares, rendering it on first use.
+
+        Even items are markup and odd items square indices.
+        """
+        if self._layout is None:
+            markup = self.jinja_env.get_template('board_layout.html').render(layout=BOARD_LAYOUT)
+            parts = SLOT_PATTERN.split(markup)
+            self._layout = [part if i % 2 == 0 else int(part) for i, part in enumerate(parts)]
+        return self._layout
+
+    def square(self, index: int, counters: list, playable=None, player_turn: str = '') -> Markup:
+        """Renders the occupied slots of the square at index."""
+        is_playable = bool(playable) and index in playable
+        return self._render_square(
+            index,
+            tuple(counter for counter in counters[index] if counter is not None),
+            is_playable,
+            player_turn if is_playable else ''
+        )
+
+    def board(self, counters: list, playable=None, player_turn: str = '') -> Markup:
+        """Renders the board; used as the `board` template global."""
+        if self.rendering == 'json':
+            return self._empty_board() + self.board_state(counters, playable, player_turn)
+
+        return Markup(''.join(
+            self.square(part, counters, playable, player_turn) if i % 2 else part
+            for i, part in enumerate(self.layout())
+        ))
+
+    def _empty_board(self) -> Markup:
+        """Renders the board with every square empty, on first use."""
+        if self._empty is None:
+            self._empty = Markup(''.join(
+                self._render_square(part, (), False, '') if i % 2 else part
+                for i, part in enumerate(self.layout())
+            ))
+        return self._empty
+
+    def board_state(self, counters: list, playable=None, player_turn: str = '') -> Markup:
+        """Renders the counters as a JSON element for board.js.
+
+        Squares map to strings of indices into the colour list; only
+        occupied squares are sent.
+        """
+        colours = {}
+        squares = {}
+        for index, square in enumerate(counters):
+            if square and square[0] is not None:
+                squares[index] = ''.join(str(colours.setdefault(colour, len(colours)))
+                                         for colour in square if colour is not None)
+
+        state = {'colours': list(colours), 'squares': squares}
+        if playable:
+            state['playable'] = list(playable)
+            state['player_turn'] = player_turn
+        return Markup('<script type="application/json" id="board_state">{}</script>').format(
+            Markup(json.dumps(state, separators=(',', ':')).replace('<', '\\u003c'))
+        )
+
+    def off_board(self, finished_tokens: list) -> Markup:
+        """Renders the off board area."""
+        return self._render_off_board(tuple(finished_tokens))
+
+    def changed(self, last_keys: dict, counters: list, finished_tokens: list) -> list[tuple[str, Markup]]:
+        """Returns (target id, fragment) for each square whose contents differ from last_keys.
+
+        last_keys maps target ids to the contents last sent and is updated
+        in place. With rendering 'json', one board_state fragment replaces
+        the squares.
+        """
+        fragments = []
+        if self.rendering == 'json':
+            key = self.board_state(counters)
+            if last_keys.get('board_state') != key:
+                last_keys['board_state'] = str(key)
+                fragments.append(('board_state', key))
+        else:
+            for index, square in enumerate(counters):
+                key = tuple(counter for counter in square if counter is not None)
+                target = f'square_{index}'
+                if last_keys.get(target) != key:
+                    last_keys[target] = key
+                    fragments.append((target, self.square(index, counters)))
+
+        key = tuple(finished_tokens)
+        if last_keys.get('off_board') != key:
+            last_keys['off_board'] = key
+            fragments.append(('off_board', self.off_board(finished_tokens)))
+
+        return fragments
@@ -0,0 +1,221 @@
+"""Module containing an asyncio gateway holding the turbo stream websockets of every worker.
+
+The gateway is a separate process serving /turbo-stream in place of the
+app: it reads each browser's user id from its Flask session cookie and
+holds the connection in a single event loop thread, so an idle spectator
+costs a few kilobytes rather than a thread. Workers send their pushes to
+the gateway's Unix socket as lines of JSON through GatewayClient, and the
+gateway frames each push once and writes it to every recipient's
+connection. Connections that stop reading are dropped once
+max_buffer_bytes of pushes are waiting for them. Messages are not
+compressed, as a compressor per connection would cost far more memory
+than the pushes it saves.
+
+Run it alongside the app with the same SECRET_KEY, e.g.
+    python gateway.py --port 8001 --socket /tmp/trs_gateway.sock
+set PUSH_GATEWAY=/tmp/trs_gateway.sock for the app, and route
+/turbo-stream to port 8001 in the reverse proxy.
+"""
+
+import asyncio
+import json
+import logging
+import socket
+from argparse import ArgumentParser
+from http.cookies import CookieError, SimpleCookie
+from os import environ, unlink
+from threading import Lock
+
+from wsproto import ConnectionType, WSConnection
+from wsproto.events import AcceptConnection, CloseConnection, Ping, RejectConnection, Request
+from wsproto.utilities import LocalProtocolError, RemoteProtocolError
+
+logger = logging.getLogger(__name__)
+
+TURBO_ROUTE = '/turbo-stream'
+# Longest line a worker may send: a push and its recipients as JSON.
+PUBLISH_LIMIT_BYTES = 64 << 20
+
+
+def encode_frame(text: str) -> bytes:
+    """Returns a text message as a single unmasked websocket frame, as a server sends it."""
+    payload = text.encode()
+    length = len(payload)
+    if length < 126:
+        header = bytes((0x81, length))
+    elif length < 1 << 16:
+        header = bytes((0x81, 126)) + length.to_bytes(2, 'big')
+    else:
+        header = bytes((0x81, 127)) + length.to_bytes(8, 'big')
+    return header + payload
+
+
+def session_user_loader(secret_key: str):
+    """Returns a function reading the logged in user's id from a Cookie header, or None."""
+    from flask import Flask
+    from itsdangerous import BadSignature
+
+    app = Flask(__name__)
+    app.secret_key = secret_key
+    serializer = app.session_interface.get_signing_serializer(app)
+    cookie_name = app.config['SESSION_COOKIE_NAME']
+    max_age = int(app.permanent_session_lifetime.total_seconds())
+
+    def load_user_id(cookie_header: str):
+        try:
+            cookie = SimpleCookie(cookie_header)
+        except CookieError:
+            return None
+        morsel = cookie.get(cookie_name)
+        if morsel is None:
+            return None
+        try:
+            return serializer.loads(morsel.value, max_age=max_age).get('_user_id')
+        except BadSignature:
+            return None
+
+    return load_user_id
+
+
+class Gateway():
+    """Class holding websocket connections by user id and writing pushes to them."""
+
+    def __init__(self, load_user_id, max_buffer_bytes: int = 1 << 20) -> None:
+        self.load_user_id = load_user_id
+        self.max_buffer_bytes = max_buffer_bytes
+        self.connections = {}
+        self.pushes = 0
+        self.servers = []
+
+    def __len__(self) -> int:
+        return sum(len(writers) for writers in self.connections.values())
+
+    def publish(self, stream: str, recipients: list[str]):
+        """Writes a push to every connection of the recipients."""
+        frame = encode_frame(stream)
+        self.pushes += 1
+        for user_id in recipients:
+            for writer in list(self.connections.get(user_id, ())):
+                if writer.transport.get_write_buffer_size() > self.max_buffer_bytes:
+                    writer.transport.abort()
+                    continue
+                writer.write(frame)
+
+    def _add(self, user_id: str, writer):
+        self.connections.setdefault(user_id, set()).add(writer)
+
+    def _remove(self, user_id: str, writer):
+        writers = self.connections.get(user_id)
+        if writers is not None:
+            writers.discard(writer)
+            if not writers:
+                del self.connections[user_id]
+
+    async def handle_publisher(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """Reads pushes from a worker, one JSON object of stream and recipients per line."""
+        try:
+            while line := await reader.readline():
+                message = json.loads(line)
+                self.publish(message['stream'], message['recipients'])
+        except (ConnectionError, ValueError):
+            logger.exception("Reading pushes from a worker failed.")
+        finally:
+            writer.close()
+
+    async def handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """Accepts a browser's websocket on TURBO_ROUTE and holds it until it closes.
+
+        Pushes are written straight to the transport, already framed, so
+        the connection only reads here: the handshake, pings and the close.
+        """
+        ws = WSConnection(ConnectionType.SERVER)
+        user_id = None
+        try:
+            while data := await reader.read(4096):
+                ws.receive_data(data)
+                for event in ws.events():
+                    if isinstance(event, Request):
+                        if event.target.split('?')[0] != TURBO_ROUTE:
+                            writer.write(ws.send(RejectConnection(status_code=404)))
+                            return
+                        cookie = b'; '.join(value for name, value in event.extra_headers
+                                            if name.lower() == b'cookie')
+                        user_id = self.load_user_id(cookie.decode('latin-1'))
+                        writer.write(ws.send(AcceptConnection()))
+                        # Keep only the frame protocol, dropping the HTTP handshake's state.
+                        ws = ws.connection
+                        if user_id:
+                            self._add(user_id, writer)
+                    elif isinstance(event, Ping):
+                        writer.write(ws.send(event.response()))
+                    elif isinstance(event, CloseConnection):
+                        writer.write(ws.send(event.response()))
+                        return
+        except (ConnectionError, LocalProtocolError, RemoteProtocolError):
+            pass
+        finally:
+            if user_id:
+                self._remove(user_id, writer)
+            writer.close()
+
+    async def serve(self, host: str, port: int, socket_path: str):
+        """Serves browsers on host:port and workers on the Unix socket until cancelled."""
+        try:
+            unlink(socket_path)
+        except FileNotFoundError:
+            pass
+        clients = await asyncio.start_server(self.handle_client, host, port, backlog=4096)
+        publishers = await asyncio.start_unix_server(self.handle_publisher, socket_path,
+                                                     limit=PUBLISH_LIMIT_BYTES)
+        self.servers = [clients, publishers]
+        logger.info("Push gateway serving %s:%s, taking pushes on %s.", host, port, socket_path)
+        async with clients, publishers:
+            await asyncio.gather(clients.serve_forever(), publishers.serve_forever())
+
+
+class GatewayClient():
+    """Class sending pushes from a worker to the gateway's Unix socket, from any thread.
+
+    A push that cannot be sent after reconnecting once is dropped and
+    logged; browsers catch up from the next push or page load.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._socket = None
+        self._lock = Lock()
+
+    def publish(self, stream: str, recipients: list[str]):
+        """Sends a push to the gateway for the recipients connected to it."""
+        line = (json.dumps({'stream': stream, 'recipients': recipients}) + '\n').encode()
+        with self._lock:
+            for _ in range(2):
+                try:
+                    if self._socket is None:
+                        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                        self._socket.connect(self.path)
+                    self._socket.sendall(line)
+                    return
+                except OSError:
+                    if self._socket is not None:
+                        self._socket.close()
+                    self._socket = None
+        logger.warning("Could not send a push to the gateway at %s.", self.path)
+
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    parser = ArgumentParser(description="Hold the turbo stream websockets of The Roman Stones.")
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=8001)
+    parser.add_argument('--socket', default=environ.get('PUSH_GATEWAY', 'trs_gateway.sock'),
+                        help="Unix socket the app's workers send pushes to")
+    parser.add_argument('--max-buffer-bytes', type=int, default=1 << 20,
+                        help="unsent pushes after which a connection is dropped")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    gateway = Gateway(session_user_loader(environ['SECRET_KEY']), args.max_buffer_bytes)
+    asyncio.run(gateway.serve(args.host, args.port, args.socket))
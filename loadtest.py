@@ -0,0 +1,371 @@
+"""Module containing a load generator playing many simulated browsers against a local server.
+
+Each simulated browser joins a table, picks a colour, keeps the turbo
+websocket open and, whenever a push tells it the game has changed,
+checks the game state and, on its turn, rolls the die and makes a random
+legal move. When a game finishes the table moves on to a new room.
+Reported are request latency percentiles per endpoint, push latency
+(from the start of an action to each browser at the table receiving its
+first push) and the server's memory use over time.
+
+Unless --url is given, the app is started on a free localhost port with
+event logs off and client-side die animation. Nothing leaves the machine.
+Run e.g.
+    python loadtest.py --tables 50 --players 4 --duration 60
+"""
+
+import http.client
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+from argparse import ArgumentParser
+from itertools import count
+from threading import Event, Lock, Thread
+from time import monotonic, perf_counter, sleep
+from urllib.parse import urlencode, urlsplit
+
+from simple_websocket import Client, ConnectionClosed
+
+import eventlog
+
+COLOURS = ['red', 'orange', 'yellow', 'green', 'blue', 'indigo',
+           'violet', 'teal', 'maroon', 'black']
+# The most counters per player the server's login accepts (app.MAX_COUNTERS_PER_PLAYER).
+MAX_COUNTERS_PER_PLAYER = 8
+SERVER_CODE = (
+    "import logging, sys\n"
+    "import app\n"
+    "logging.getLogger('werkzeug').setLevel(logging.ERROR)\n"
+    "app.app.run(host='127.0.0.1', port=int(sys.argv[1]), threaded=True)\n"
+)
+
+
+def percentiles(samples: list[float]) -> dict:
+    """Returns the count, 50th, 90th and 99th percentiles and maximum of samples, in milliseconds."""
+    if not samples:
+        return {'count': 0}
+
+    ordered = sorted(samples)
+    def at(fraction):
+        return round(ordered[min(int(fraction * len(ordered)), len(ordered) - 1)] * 1000, 3)
+
+    return {'count': len(ordered), 'p50_ms': at(0.5), 'p90_ms': at(0.9), 'p99_ms': at(0.99),
+            'max_ms': round(ordered[-1] * 1000, 3)}
+
+
+class Stats():
+    """Class collecting latencies and counts from every simulated browser."""
+
+    def __init__(self) -> None:
+        self.requests = {}
+        self.statuses = {}
+        self.push_latencies = []
+        self.errors = 0
+        self.games_finished = 0
+        self.memory = []
+        self._lock = Lock()
+
+    def request(self, endpoint: str, seconds: float, status: int):
+        with self._lock:
+            self.requests.setdefault(endpoint, []).append(seconds)
+            self.statuses[status] = self.statuses.get(status, 0) + 1
+
+    def push(self, seconds: float):
+        with self._lock:
+            self.push_latencies.append(seconds)
+
+    def error(self):
+        with self._lock:
+            self.errors += 1
+
+    def game_finished(self):
+        with self._lock:
+            self.games_finished += 1
+
+    def report(self, duration_s: float) -> dict:
+        """Returns the statistics collected as JSON-serialisable data."""
+        with self._lock:
+            report = {
+                'duration_s': round(duration_s, 1),
+                'requests': {endpoint: percentiles(samples) for endpoint, samples in self.requests.items()},
+                'statuses': {str(status): number for status, number in sorted(self.statuses.items())},
+                'push_latency': percentiles(self.push_latencies),
+                'moves_per_s': round(len(self.requests.get('/move_piece', [])) / duration_s, 1),
+                'games_finished': self.games_finished,
+                'errors': self.errors
+            }
+        if self.memory:
+            rss = [kilobytes for _, kilobytes in self.memory]
+            report['memory'] = {
+                'start_kb': rss[0], 'end_kb': rss[-1], 'max_kb': max(rss),
+                'growth_kb_per_min': round((rss[-1] - rss[0]) / max(self.memory[-1][0] / 60, 1 / 60), 1),
+                'samples': self.memory
+            }
+        return report
+
+
+class Table():
+    """Class coordinating the browsers seated at one table across its games."""
+
+    def __init__(self, name: str, number_of_players: int, counters_per_player: int) -> None:
+        self.name = name
+        self.number_of_players = number_of_players
+        self.counters_per_player = counters_per_player
+        self.lock = Lock()
+        self.ready = {}
+        self.action = (0, 0.0)
+        self._actions = count(1)
+
+    def room_id(self, game_number: int) -> str:
+        return f'{self.name}-{game_number}'
+
+    def seated(self, game_number: int) -> Event:
+        """Returns the event set once the first seat has set up a game."""
+        with self.lock:
+            return self.ready.setdefault(game_number, Event())
+
+    def start_action(self):
+        """Marks the start of an action, for push latencies to be measured from."""
+        self.action = (next(self._actions), perf_counter())
+
+
+class Browser(Thread):
+    """Class for one simulated browser: an HTTP session plus a turbo websocket."""
+
+    def __init__(self, base_url: str, table: Table, seat: int, stats: Stats,
+                 stop: Event, think_time_s: float) -> None:
+        super().__init__(name=f'browser-{table.name}-{seat}', daemon=True)
+        url = urlsplit(base_url)
+        self.host, self.port = url.hostname, url.port
+        self.table = table
+        self.seat = seat
+        self.colour = COLOURS[seat]
+        self.stats = stats
+        self.stop = stop
+        self.think_time_s = think_time_s
+        self.cookie = None
+        self.changed = Event()
+        self.websocket = None
+        self.last_action = 0
+        self.rng = random.Random(f'{table.name}-{seat}')
+
+    def request(self, method: str, path: str, form: dict = None, endpoint: str = None) -> tuple[int, bytes]:
+        """Makes a request with the session cookie, recording its latency under endpoint (default path).
+
+        Redirects are not followed.
+        """
+        connection = http.client.HTTPConnection(self.host, self.port, timeout=30)
+        headers = {'Cookie': self.cookie} if self.cookie else {}
+        body = None
+        if form is not None:
+            body = urlencode(form)
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+
+        start = perf_counter()
+        connection.request(method, path, body, headers)
+        response = connection.getresponse()
+        data = response.read()
+        self.stats.request(endpoint or path, perf_counter() - start, response.status)
+        connection.close()
+
+        set_cookie = response.getheader('Set-Cookie')
+        if set_cookie:
+            self.cookie = set_cookie.split(';')[0]
+        return response.status, data
+
+    def listen(self):
+        """Receives pushes, timing the first after each action and waking the browser."""
+        while not self.stop.is_set():
+            try:
+                message = self.websocket.receive(timeout=1)
+            except ConnectionClosed:
+                return
+            if message is None:
+                continue
+
+            action, started = self.table.action
+            if action != self.last_action:
+                self.last_action = action
+                self.stats.push(perf_counter() - started)
+            self.changed.set()
+
+    def take_seat(self, game_number: int):
+        """Takes this browser's seat in a game, the first seat setting it up."""
+        if self.seat:
+            self.table.seated(game_number).wait()
+        self.request('GET', f'/rooms/{self.table.room_id(game_number)}', endpoint='/rooms/<room_id>')
+        self.request('GET', '/login')
+        form = {'colour': self.colour}
+        if self.seat == 0:
+            form.update(num_players=self.table.number_of_players,
+                        counters_per_player=self.table.counters_per_player)
+        self.request('POST', '/login', form)
+        if self.seat == 0:
+            self.table.seated(game_number).set()
+
+    def state(self, game_number: int) -> dict:
+        """Returns the current game state of the table's room."""
+        status, data = self.request('GET', f'/games/{self.table.room_id(game_number)}/state',
+                                    endpoint='/games/<room_id>/state')
+        return json.loads(data) if status == 200 else None
+
+    def take_turn(self, game_number: int, state: dict):
+        """Rolls the die and makes a random legal move."""
+        sleep(self.rng.uniform(0, self.think_time_s))
+        self.table.start_action()
+        self.request('POST', '/roll_die', {'power': self.rng.randint(1, 99), 'version': state['version']})
+
+        state = self.state(game_number)
+        game = eventlog.restore_game(state['game'])
+        if not game.players or game.players[0].colour != self.colour:
+            return
+        moves = game.legal_moves()
+        if moves:
+            self.table.start_action()
+            self.request('POST', '/move_piece', {
+                'square_num': self.rng.choice(moves), 'colour': self.colour, 'version': state['version']
+            })
+
+    def run(self):
+        try:
+            self.request('GET', f'/rooms/{self.table.room_id(0)}', endpoint='/rooms/<room_id>')
+            self.websocket = Client.connect(f'ws://{self.host}:{self.port}/turbo-stream',
+                                            headers={'Cookie': self.cookie})
+            Thread(target=self.listen, daemon=True).start()
+
+            game_number = 0
+            self.take_seat(game_number)
+            while not self.stop.is_set():
+                state = self.state(game_number)
+                game = eventlog.restore_game(state['game'])
+                if game.players and any(game.check_win(player.colour) for player in game.players):
+                    if self.seat == 0:
+                        self.stats.game_finished()
+                    game_number += 1
+                    self.take_seat(game_number)
+                    continue
+
+                if (len(game.players) == self.table.number_of_players
+                        and game.players[0].colour == self.colour):
+                    self.take_turn(game_number, state)
+                    continue
+
+                self.changed.wait(timeout=1)
+                self.changed.clear()
+        except Exception:
+            self.stats.error()
+            raise
+        finally:
+            if self.websocket:
+                self.websocket.close()
+
+
+def rss_kb(pid: int) -> int:
+    """Returns the resident memory of a process in kilobytes (Linux only)."""
+    with open(f'/proc/{pid}/status') as status_file:
+        for line in status_file:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+    return 0
+
+
+def sample_memory(pid: int, stats: Stats, stop: Event, interval_s: float = 1.0):
+    """Records the server's memory use every interval until stopped."""
+    start = monotonic()
+    while not stop.is_set():
+        try:
+            stats.memory.append((round(monotonic() - start, 1), rss_kb(pid)))
+        except OSError:
+            return
+        stop.wait(interval_s)
+
+
+def free_port() -> int:
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+
+
+def start_server() -> tuple[subprocess.Popen, str]:
+    """Starts the app on a free localhost port; returns the process and its URL."""
+    port = free_port()
+    environment = dict(os.environ, EVENT_LOG_DIR='', DIE_ANIMATION='client', MAX_ROOMS='100000')
+    environment.setdefault('SECRET_KEY', 'load-test')
+    server = subprocess.Popen([sys.executable, '-c', SERVER_CODE, str(port)], env=environment,
+                              cwd=os.path.dirname(os.path.abspath(__file__)),
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = monotonic() + 30
+    while monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return server, f'http://127.0.0.1:{port}'
+        except OSError:
+            sleep(0.1)
+
+    server.kill()
+    raise RuntimeError("The server did not start.")
+
+
+def run(tables: int, players: int, counters: int, duration_s: float,
+        think_time_s: float = 0.05, url: str = None, pid: int = None) -> dict:
+    """Plays tables of simulated browsers against a server for duration_s and returns the report."""
+    server = None
+    if url is None:
+        server, url = start_server()
+        pid = server.pid
+
+    stats = Stats()
+    stop = Event()
+    if pid:
+        Thread(target=sample_memory, args=(pid, stats, stop), daemon=True).start()
+
+    browsers = []
+    for table_number in range(tables):
+        table = Table(f'load-{os.getpid()}-{table_number}', players, counters)
+        browsers += [Browser(url, table, seat, stats, stop, think_time_s) for seat in range(players)]
+
+    start = monotonic()
+    try:
+        for browser in browsers:
+            browser.start()
+        stop.wait(duration_s)
+    finally:
+        stop.set()
+        for browser in browsers:
+            browser.join(timeout=5)
+        if server:
+            server.terminate()
+            server.wait()
+
+    return stats.report(monotonic() - start)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Load test The Roman Stones with simulated browsers.")
+    parser.add_argument('--tables', type=int, default=10)
+    parser.add_argument('--players', type=int, default=2, choices=range(1, len(COLOURS) + 1))
+    parser.add_argument('--counters', type=int, default=2)
+    parser.add_argument('--duration', type=float, default=30, help="seconds to run for")
+    parser.add_argument('--think-time', type=float, default=0.05,
+                        help="most seconds a browser waits before taking its turn")
+    parser.add_argument('--url', help="server to test instead of starting one")
+    parser.add_argument('--pid', type=int, help="process id of that server, to sample its memory")
+    parser.add_argument('--output', help="file to save the report to as JSON")
+    args = parser.parse_args()
+    if not 1 <= args.counters <= MAX_COUNTERS_PER_PLAYER:
+        parser.error(f"--counters must be from 1 to {MAX_COUNTERS_PER_PLAYER}, the most the server accepts.")
+    if args.tables < 1 or args.duration <= 0:
+        parser.error("--tables and --duration must be positive.")
+
+    report = run(args.tables, args.players, args.counters, args.duration,
+                 args.think_time, args.url, args.pid)
+    samples = report.get('memory', {}).pop('samples', None)
+    print(json.dumps(report, indent=2))
+    if args.output:
+        if samples is not None:
+            report['memory']['samples'] = samples
+        with open(args.output, 'w') as output_file:
+            json.dump(report, output_file, indent=2)
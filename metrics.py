@@ -0,0 +1,144 @@
+"""Module containing timing hooks and histograms exposed in Prometheus text format.
+
+Each thread records into its own histograms, so recording takes no lock;
+a thread only takes the registry lock once, when it records its first
+value. Histograms of threads that have exited are merged into a shared
+total when metrics are collected. Nothing is wrapped or hooked unless
+metrics are enabled, so disabled metrics cost nothing on the hot paths.
+"""
+
+from bisect import bisect_left
+from functools import wraps
+from threading import Lock, current_thread, local
+from time import perf_counter
+
+SECONDS_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+BYTES_BUCKETS = (64, 256, 1024, 4096, 16384, 65536, 262144)
+RECIPIENTS_BUCKETS = (1, 2, 4, 8, 16, 64, 256)
+
+HISTOGRAMS = {
+    'trs_request_seconds': ("Time spent in route handlers.", SECONDS_BUCKETS),
+    'trs_render_seconds': ("Time spent in render_template calls.", SECONDS_BUCKETS),
+    'trs_push_seconds': ("Time spent sending turbo stream pushes.", SECONDS_BUCKETS),
+    'trs_push_bytes': ("Size of turbo stream pushes.", BYTES_BUCKETS),
+    'trs_push_recipients': ("Number of recipients of turbo stream pushes.", RECIPIENTS_BUCKETS),
+    'trs_game_seconds': ("Time spent in backend.Game methods.", SECONDS_BUCKETS)
+}
+
+
+def format_labels(labels: tuple, **extra) -> str:
+    """Formats label pairs as a Prometheus label set."""
+    pairs = list(labels) + list(extra.items())
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in pairs) + '}'
+
+
+class Metrics():
+    """Class recording per-thread histograms and rendering them for /metrics."""
+
+    def __init__(self, enabled: bool = False) -> None:
+        self.enabled = enabled
+        self._local = local()
+        self._threads = []
+        self._retired = {}
+        self._lock = Lock()
+
+    def _histograms(self) -> dict:
+        """Returns this thread's histograms, registering them on first use."""
+        histograms = getattr(self._local, 'histograms', None)
+        if histograms is None:
+            histograms = self._local.histograms = {}
+            with self._lock:
+                self._threads.append((current_thread(), histograms))
+        return histograms
+
+    def observe(self, name: str, value: float, **labels):
+        """Records a value in a histogram."""
+        key = (name, tuple(labels.items()))
+        histograms = self._histograms()
+        histogram = histograms.get(key)
+        if histogram is None:
+            # Bucket counts (the last for +Inf), then the sum.
+            histogram = histograms[key] = [0] * (len(HISTOGRAMS[name][1]) + 1) + [0.0]
+        histogram[bisect_left(HISTOGRAMS[name][1], value)] += 1
+        histogram[-1] += value
+
+    def timed(self, name: str, **labels):
+        """Decorator recording the time taken by each call of a function."""
+        def decorator(function):
+            @wraps(function)
+            def wrapper(*args, **kwargs):
+                start = perf_counter()
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    self.observe(name, perf_counter() - start, **labels)
+            return wrapper
+        return decorator
+
+    def instrument(self, cls, method_names: list[str]):
+        """Times the named methods of a class, labelled by method."""
+        for method_name in method_names:
+            setattr(cls, method_name, self.timed('trs_game_seconds', method=method_name)(getattr(cls, method_name)))
+
+    def timed_push(self, push):
+        """Wraps turbo.push to record its time, payload size and number of recipients."""
+        @wraps(push)
+        def wrapper(stream, to=None):
+            start = perf_counter()
+            try:
+                return push(stream, to)
+            finally:
+                self.observe('trs_push_seconds', perf_counter() - start)
+                self.observe('trs_push_bytes', len(stream))
+                if to is not None and not isinstance(to, str):
+                    self.observe('trs_push_recipients', len(to))
+        return wrapper
+
+    def _merge(self, into: dict, histograms: dict):
+        for key, histogram in list(histograms.items()):
+            total = into.setdefault(key, [0] * (len(histogram) - 1) + [0.0])
+            for i, value in enumerate(histogram):
+                total[i] += value
+
+    def collect(self) -> dict:
+        """Returns every histogram merged across threads, retiring those of exited threads."""
+        with self._lock:
+            alive = []
+            for thread, histograms in self._threads:
+                if thread.is_alive():
+                    alive.append((thread, histograms))
+                else:
+                    self._merge(self._retired, histograms)
+            self._threads = alive
+
+            merged = {}
+            self._merge(merged, self._retired)
+            for _, histograms in alive:
+                self._merge(merged, histograms)
+
+        return merged
+
+    def render(self, gauges: dict) -> str:
+        """Returns the histograms and the given gauges ({name: (help, value)}) as Prometheus text."""
+        lines = []
+        for name, (help_text, value) in gauges.items():
+            lines += [f'# HELP {name} {help_text}', f'# TYPE {name} gauge', f'{name} {value}']
+
+        histograms = self.collect()
+        for name, (help_text, buckets) in HISTOGRAMS.items():
+            keys = sorted(key for key in histograms if key[0] == name)
+            if not keys:
+                continue
+            lines += [f'# HELP {name} {help_text}', f'# TYPE {name} histogram']
+            for key in keys:
+                histogram = histograms[key]
+                cumulative = 0
+                for bound, count in zip(buckets + ('+Inf',), histogram):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{format_labels(key[1], le=bound)} {cumulative}')
+                lines.append(f'{name}_sum{format_labels(key[1])} {histogram[-1]}')
+                lines.append(f'{name}_count{format_labels(key[1])} {cumulative}')
+
+        return '\n'.join(lines) + '\n'
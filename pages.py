@@ -0,0 +1,59 @@
+"""Module containing the cache of fully rendered pages, keyed by room version.
+
+A page is cached under (room id, room generation, room version,
+variant), the variant covering whatever differs between viewers of the
+same version, so it is rendered once per change of the game however many
+viewers load it. The generation tells apart rooms evicted and created
+again under the same id, whose versions start again from 0. Each page's
+ETag is a hash of its generation and contents, so it is the same from
+every worker and changes when templates do.
+"""
+
+from collections import OrderedDict
+from hashlib import blake2b
+from threading import Lock
+
+
+class Page():
+    """Class for a rendered page and its ETag."""
+
+    __slots__ = ('body', 'etag')
+
+    def __init__(self, body: str, generation: str = '') -> None:
+        self.body = body.encode()
+        self.etag = blake2b(self.body, digest_size=12, key=generation.encode()).hexdigest()
+
+
+class PageCache():
+    """Class caching rendered pages, evicting the least recently used past maxsize."""
+
+    def __init__(self, maxsize: int = 1024) -> None:
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._pages = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self) -> int:
+        return len(self._pages)
+
+    def get(self, key: tuple) -> Page:
+        """Returns the cached page for key, or None."""
+        with self._lock:
+            page = self._pages.get(key)
+            if page is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._pages.move_to_end(key)
+        return page
+
+    def put(self, key: tuple, body: str, generation: str = '') -> Page:
+        """Caches a page rendered for a room generation, evicting the least recently used if full, and returns it."""
+        page = Page(body, generation)
+        with self._lock:
+            self._pages[key] = page
+            self._pages.move_to_end(key)
+            if len(self._pages) > self.maxsize:
+                self._pages.popitem(last=False)
+        return page
@@ -0,0 +1,199 @@
+"""Module containing an on-demand sampling profiler writing collapsed stack and speedscope files.
+
+Nothing runs until a profile is started: then one background thread
+wakes every interval_s, reads the stacks of the threads being profiled
+with sys._current_frames() and counts them. A profile follows either a
+single thread (one request) or every thread for a window of time, which
+takes in the die animation, push delivery and other background threads.
+Threads are tagged with the route and room they are working on (other
+threads by their name), and every sample starts with frames naming
+both, e.g.
+    route /roll_die;room default;roll_die (app.py:912);... 7
+so profiles can be split by table or endpoint in any flamegraph viewer.
+
+Each profile is written to output_dir as NAME.collapsed (for
+flamegraph.pl, inferno or speedscope) and NAME.speedscope.json (for
+https://www.speedscope.app), once it ends.
+"""
+
+import json
+import logging
+import sys
+from collections import Counter
+from os import makedirs, path
+from threading import Condition, Thread, enumerate as enumerate_threads, get_ident
+from time import monotonic, strftime
+from uuid import uuid4
+
+logger = logging.getLogger(__name__)
+
+UNTAGGED = '-'
+
+
+def frame_name(code) -> str:
+    """Returns a function's name as shown in profiles: its qualified name, file and first line."""
+    return f'{code.co_qualname} ({path.basename(code.co_filename)}:{code.co_firstlineno})'
+
+
+def collapsed(samples: Counter) -> str:
+    """Returns counted stacks in collapsed stack format: frames root first, joined by ;, then the count."""
+    return ''.join(f"{';'.join(stack)} {count}\n" for stack, count in samples.most_common())
+
+
+def speedscope(samples: Counter, name: str, interval_s: float) -> dict:
+    """Returns counted stacks as a speedscope sampled profile, weighted in seconds."""
+    frames = []
+    indices = {}
+    stacks = []
+    weights = []
+    for stack, count in samples.most_common():
+        for frame in stack:
+            if frame not in indices:
+                indices[frame] = len(frames)
+                frames.append({'name': frame})
+        stacks.append([indices[frame] for frame in stack])
+        weights.append(count * interval_s)
+
+    return {
+        '$schema': 'https://www.speedscope.app/file-format-schema.json',
+        'name': name,
+        'exporter': 'The Roman Stones profiler',
+        'shared': {'frames': frames},
+        'profiles': [{
+            'type': 'sampled',
+            'name': name,
+            'unit': 'seconds',
+            'startValue': 0,
+            'endValue': sum(weights),
+            'samples': stacks,
+            'weights': weights
+        }]
+    }
+
+
+class Profile():
+    """Class for one profile: the threads it follows (None for all), its samples and when it ends."""
+
+    __slots__ = ('name', 'thread_ids', 'deadline', 'samples')
+
+    def __init__(self, name: str, thread_ids: set = None, deadline: float = None) -> None:
+        self.name = name
+        self.thread_ids = thread_ids
+        self.deadline = deadline
+        self.samples = Counter()
+
+
+class SamplingProfiler():
+    """Class sampling the stacks of profiled threads from a background thread while profiles run."""
+
+    def __init__(self, output_dir: str = 'profiles', interval_s: float = 0.002) -> None:
+        self.output_dir = output_dir
+        self.interval_s = interval_s
+        self.tags = {}
+        self.thread_names = {}
+        self._profiles = []
+        self._condition = Condition()
+        self._thread = None
+
+    @property
+    def active(self) -> bool:
+        """Returns if any profile is running."""
+        return bool(self._profiles)
+
+    def tag(self, route: str, room_id: str):
+        """Tags the calling thread's samples with the route and room it is working on."""
+        self.tags[get_ident()] = (route, room_id or UNTAGGED)
+
+    def untag(self):
+        """Clears the calling thread's tags."""
+        self.tags.pop(get_ident(), None)
+
+    def _new_name(self, kind: str) -> str:
+        return f"{strftime('%Y%m%d-%H%M%S')}-{kind}-{uuid4().hex[:6]}"
+
+    def _add(self, profile: Profile) -> Profile:
+        with self._condition:
+            if self._thread is None:
+                self._thread = Thread(target=self._run, name='profiler', daemon=True)
+                self._thread.start()
+            self._profiles.append(profile)
+            self._condition.notify()
+        return profile
+
+    def start_thread(self) -> Profile:
+        """Starts profiling the calling thread, until stop is called with the profile returned."""
+        return self._add(Profile(self._new_name('request'), {get_ident()}))
+
+    def start_window(self, duration_s: float) -> Profile:
+        """Starts profiling every thread for duration_s seconds; the profile is written when it ends."""
+        return self._add(Profile(self._new_name('window'), deadline=monotonic() + duration_s))
+
+    def stop(self, profile: Profile) -> list[str]:
+        """Ends a profile and writes it; returns the paths written."""
+        with self._condition:
+            if profile in self._profiles:
+                self._profiles.remove(profile)
+        return self.write(profile)
+
+    def file_names(self, profile: Profile) -> list[str]:
+        """Returns the names of the collapsed stack and speedscope files of a profile."""
+        return [f'{profile.name}.collapsed', f'{profile.name}.speedscope.json']
+
+    def write(self, profile: Profile) -> list[str]:
+        """Writes a profile's collapsed stack and speedscope files; returns their paths."""
+        makedirs(self.output_dir, exist_ok=True)
+        collapsed_path, speedscope_path = (path.join(self.output_dir, name) for name in self.file_names(profile))
+        with open(collapsed_path, 'w') as collapsed_file:
+            collapsed_file.write(collapsed(profile.samples))
+        with open(speedscope_path, 'w') as speedscope_file:
+            json.dump(speedscope(profile.samples, profile.name, self.interval_s), speedscope_file)
+        return [collapsed_path, speedscope_path]
+
+    def _stack(self, thread_id: int, frame) -> tuple:
+        """Returns a thread's stack as frame names, root first, after its route and room."""
+        names = []
+        while frame is not None:
+            names.append(frame_name(frame.f_code))
+            frame = frame.f_back
+        route, room_id = self.tags.get(thread_id) or (f'thread:{self.thread_names.get(thread_id, thread_id)}',
+                                                      UNTAGGED)
+        return (f'route {route}', f'room {room_id}') + tuple(reversed(names))
+
+    def sample(self):
+        """Counts the current stack of every thread followed by a running profile."""
+        own_id = get_ident()
+        frames = sys._current_frames()
+        if any(profile.thread_ids is None for profile in self._profiles):
+            self.thread_names = {thread.ident: thread.name for thread in enumerate_threads()}
+        stacks = {}
+        for profile in list(self._profiles):
+            thread_ids = frames if profile.thread_ids is None else profile.thread_ids
+            for thread_id in thread_ids:
+                frame = frames.get(thread_id)
+                if frame is None or thread_id == own_id:
+                    continue
+                if thread_id not in stacks:
+                    stacks[thread_id] = self._stack(thread_id, frame)
+                profile.samples[stacks[thread_id]] += 1
+
+    def _run(self):
+        """Samples while profiles run, writing window profiles as they end."""
+        while True:
+            with self._condition:
+                while not self._profiles:
+                    self._condition.wait()
+                now = monotonic()
+                ended = [profile for profile in self._profiles
+                         if profile.deadline is not None and profile.deadline <= now]
+                for profile in ended:
+                    self._profiles.remove(profile)
+                self.sample()
+
+            for profile in ended:
+                try:
+                    paths = self.write(profile)
+                    logger.info("Profile written to %s.", ', '.join(paths))
+                except OSError:
+                    logger.exception("Writing profile %s failed.", profile.name)
+            with self._condition:
+                self._condition.wait(self.interval_s)
@@ -0,0 +1,88 @@
+"""Module containing the buffering and coalescing of turbo stream pushes."""
+
+import re
+from itertools import count
+from threading import Lock
+
+STREAM_PATTERN = re.compile(r'<turbo-stream action="(\w+)" (target|targets)="([^"]*)">')
+COALESCED_ACTIONS = ('replace', 'update')
+
+
+class PushStats():
+    """Class counting messages pushed by handlers against websocket messages actually sent."""
+
+    def __init__(self) -> None:
+        self.issued = 0
+        self.sent = 0
+        self._lock = Lock()
+
+    def record(self, issued: int = 0, sent: int = 0):
+        """Adds to the counters."""
+        with self._lock:
+            self.issued += issued
+            self.sent += sent
+
+    def as_dict(self) -> dict:
+        """Returns the counters as a dictionary."""
+        return {'issued': self.issued, 'sent': self.sent}
+
+
+def split_streams(stream) -> list[str]:
+    """Splits a stream, or list of streams, into single turbo-stream elements."""
+    if not isinstance(stream, str):
+        return [part for item in stream for part in split_streams(item)]
+
+    starts = [match.start() for match in STREAM_PATTERN.finditer(stream)]
+    if not starts:
+        return [stream]
+
+    return [stream[start:end] for start, end in zip(starts, starts[1:] + [len(stream)])]
+
+
+class PushBuffer():
+    """Class collecting pushes so they can be sent together.
+
+    Replace and update actions aimed at the same target for the same user
+    are merged, keeping the last. On flush, users due the same streams are
+    sent them in a single push.
+    """
+
+    def __init__(self, send, stats: PushStats = None) -> None:
+        self.send = send
+        self.stats = stats
+        self._streams = {}
+        self._sequence = count()
+
+    def __len__(self) -> int:
+        return sum(len(streams) for streams in self._streams.values())
+
+    def add(self, stream, recipients):
+        """Buffers a stream (or list of streams) for each of the recipients."""
+        parts = split_streams(stream)
+        if self.stats:
+            self.stats.record(issued=len(recipients))
+
+        for part in parts:
+            match = STREAM_PATTERN.match(part)
+            if match and match.group(1) in COALESCED_ACTIONS and match.group(2) == 'target':
+                key = match.group(3)
+            else:
+                key = next(self._sequence)
+
+            for recipient in recipients:
+                streams = self._streams.setdefault(recipient, {})
+                # Re-inserting moves the stream to the end, keeping the order it takes effect in.
+                streams.pop(key, None)
+                streams[key] = part
+
+    def flush(self):
+        """Sends everything buffered, one push per distinct payload."""
+        payloads = {}
+        for recipient, streams in self._streams.items():
+            payloads.setdefault(''.join(streams.values()), []).append(recipient)
+        self._streams = {}
+
+        for payload, recipients in payloads.items():
+            self.send(payload, recipients)
+            if self.stats:
+                self.stats.record(sent=len(recipients))
@@ -0,0 +1,288 @@
+"""Module containing the registry of game rooms hosted by the server."""
+
+import os
+from collections import deque
+from contextlib import contextmanager
+from threading import Lock, RLock
+from time import monotonic, time
+from uuid import uuid4
+
+import backend
+import eventlog
+import shared
+
+DEFAULT_ROOM_ID = 'default'
+
+
+class RoomsFull(Exception):
+    """Raised when a room is requested but the registry is at capacity."""
+
+
+class Room():
+    """Class for a single table: a game plus the users watching it.
+
+    version goes up with every event recorded in the game, so actions
+    submitted against an older version can be rejected. revision goes up
+    with every change to the game or its users, so workers sharing the
+    room can tell when their copy is out of date.
+    """
+
+    __slots__ = ('room_id', 'game', 'lock', 'user_ids', 'last_active', 'fragment_keys',
+                 'event_log', 'history', 'number_of_events', 'version', 'revision', 'lock_depth',
+                 'sync_user_ids', 'generation')
+
+    def __init__(self, room_id: str, event_log: eventlog.EventLog = None) -> None:
+        self.room_id = room_id
+        self.event_log = event_log
+        self.game = backend.Game()
+        self.history = bytearray()
+        self.number_of_events = 0
+        # Tells this room apart from earlier ones with the same id, e.g. in cached pages.
+        self.generation = uuid4().hex[:12]
+        self.lock = RLock()
+        self.user_ids = set()
+        self.sync_user_ids = set()
+        self.last_active = monotonic()
+        self.fragment_keys = {}
+        self.version = 0
+        self.revision = 0
+        self.lock_depth = 0
+
+    def touch(self):
+        """Marks the room as active now."""
+        self.last_active = monotonic()
+
+    def record(self, event_type: int, payload: bytes = b''):
+        """Records an event already applied to the game in the history and event log."""
+        if event_type == eventlog.NEW_GAME:
+            self.history = bytearray()
+            self.number_of_events = 0
+        else:
+            self.history += eventlog.encode_record(event_type, payload)
+            self.number_of_events += 1
+        self.version += 1
+        self.revision += 1
+        if self.event_log:
+            self.event_log.append(self.game, self.history, event_type, payload)
+
+    def add_user(self, user_id: str):
+        """Adds a user to those watching the room."""
+        if user_id not in self.user_ids:
+            self.user_ids.add(user_id)
+            self.revision += 1
+
+    def remove_user(self, user_id: str):
+        """Removes a user from those watching the room."""
+        if user_id in self.user_ids:
+            self.user_ids.discard(user_id)
+            self.sync_user_ids.discard(user_id)
+            self.revision += 1
+
+    def set_synced(self, user_id: str, synced: bool):
+        """Marks whether a user receives board deltas through sync.js instead of board fragments."""
+        if synced != (user_id in self.sync_user_ids):
+            if synced:
+                self.sync_user_ids.add(user_id)
+            else:
+                self.sync_user_ids.discard(user_id)
+            self.revision += 1
+
+    @property
+    def finished(self) -> bool:
+        """Returns if a player has won the current game."""
+        return any(self.game.check_win(player.colour) for player in self.game.players)
+
+    def new_game(self):
+        """Replaces the game in the room with a fresh one."""
+        self.game = backend.Game()
+        self.fragment_keys = {}
+        self.record(eventlog.NEW_GAME)
+        self.touch()
+
+    @property
+    def spectator_ids(self) -> list[str]:
+        """Returns user ids in the room that are not playing."""
+        player_ids = self.game.player_ids
+        return [user_id for user_id in self.user_ids if user_id not in player_ids]
+
+    def summary(self) -> dict:
+        """Returns a short description of the room for listings."""
+        return {
+            'room_id': self.room_id,
+            'players': len(self.game.players),
+            'number_of_players': self.game.number_of_players,
+            'spectators': len(self.spectator_ids)
+        }
+
+
+class RoomRegistry():
+    """Class holding every room in the process, keyed by room id.
+
+    Rooms nobody has touched for idle_timeout_s seconds are evicted, and no
+    more than max_rooms are held at once. If event_log_dir is given, every
+    room keeps an event log there, and recover() rebuilds the rooms from it.
+    If state is a shared backend (see shared.py), rooms are loaded from and
+    saved to it by locked(), so several worker processes can serve them.
+    """
+
+    def __init__(self, max_rooms: int = 5000, idle_timeout_s: float = 3600,
+                 event_log_dir: str = None, max_finished_games: int = 1000,
+                 state: shared.MemoryState = None) -> None:
+        self.max_rooms = max_rooms
+        self.finished_games = deque(maxlen=max_finished_games)
+        self.idle_timeout_s = idle_timeout_s
+        self.event_log_dir = event_log_dir
+        self.state = state or shared.MemoryState()
+        self.syncer = None
+        if event_log_dir:
+            os.makedirs(event_log_dir, exist_ok=True)
+            self.syncer = eventlog.Syncer()
+        self._rooms = {}
+        self._pending_leaves = {}
+        self._lock = Lock()
+
+    def _new_room(self, room_id: str) -> Room:
+        """Creates a room, with an event log if logging is enabled."""
+        if not self.event_log_dir:
+            return Room(room_id)
+        return Room(room_id, eventlog.EventLog(self.event_log_dir, room_id, self.syncer))
+
+    def recover(self) -> list[Room]:
+        """Rebuilds the rooms found in the event log directory."""
+        if not self.event_log_dir:
+            return []
+
+        recovered = []
+        with self._lock:
+            for room_id in eventlog.room_ids(self.event_log_dir):
+                room = self._new_room(room_id)
+                room.game, room.history = room.event_log.recover()
+                room.number_of_events = eventlog.count_records(room.history)
+                room.version = room.event_log.sequence
+                self._rooms[room_id] = room
+                recovered.append(room)
+        return recovered
+
+    def __len__(self) -> int:
+        return len(self._rooms)
+
+    @contextmanager
+    def locked(self, room: Room):
+        """Holds a room's lock, across workers if the state is shared.
+
+        On first entry the room is brought up to date with the shared
+        state, and on last exit it is saved there if it changed.
+        """
+        with room.lock:
+            if room.lock_depth:
+                room.lock_depth += 1
+                try:
+                    yield room
+                finally:
+                    room.lock_depth -= 1
+                return
+
+            with self.state.lock(room.room_id):
+                self.state.refresh(room)
+                for user_id in self._pending_leaves.pop(room.room_id, ()):
+                    room.remove_user(user_id)
+                revision = room.revision
+                room.lock_depth = 1
+                try:
+                    yield room
+                finally:
+                    room.lock_depth = 0
+                    if room.revision != revision:
+                        self.state.save(room)
+
+    def _evict_idle(self):
+        """Removes rooms idle for longer than the timeout; caller holds the lock."""
+        cutoff = monotonic() - self.idle_timeout_s
+        for room_id in [room_id for room_id, room in self._rooms.items()
+                        if room.last_active < cutoff and room_id != DEFAULT_ROOM_ID]:
+            room = self._rooms.pop(room_id)
+            self._pending_leaves.pop(room_id, None)
+            if room.event_log:
+                room.event_log.delete()
+            self.state.delete(room_id, time() - self.idle_timeout_s)
+
+    def create(self, room_id: str = None) -> Room:
+        """Creates a new room, evicting idle rooms if at capacity."""
+        with self._lock:
+            if len(self._rooms) >= self.max_rooms:
+                self._evict_idle()
+            if len(self._rooms) >= self.max_rooms:
+                raise RoomsFull("No rooms available.")
+
+            room_id = room_id or uuid4().hex[:8]
+            room = self._rooms.get(room_id) or self._rooms.setdefault(room_id, self._new_room(room_id))
+            room.touch()
+            return room
+
+    def get(self, room_id: str, touch: bool = True) -> Room:
+        """Returns the room with room_id, or None if it does not exist; touch marks it as active.
+
+        With shared state, a room created by another worker is loaded.
+        """
+        room = self._rooms.get(room_id)
+        if room is None and self.state.shared:
+            stored = self._new_room(room_id)
+            with self.state.lock(room_id):
+                if not self.state.refresh(stored):
+                    return None
+            with self._lock:
+                room = self._rooms.setdefault(room_id, stored)
+        if room and touch:
+            room.touch()
+        return room
+
+    def is_seated(self, room_id: str, user_id: str) -> bool:
+        """Returns if a user plays in a room that still exists, without marking the room as active."""
+        room = self.get(room_id, touch=False) if room_id else None
+        return room is not None and user_id in room.game.player_ids
+
+    def get_or_create(self, room_id: str) -> Room:
+        """Returns the room with room_id, creating it if needed."""
+        return self.get(room_id) or self.create(room_id)
+
+    def join(self, room_id: str, user_id: str) -> Room:
+        """Adds a user to a room, creating the room if needed."""
+        room = self.get_or_create(room_id)
+        with self.locked(room):
+            room.add_user(user_id)
+        return room
+
+    def leave(self, room_id: str, user_id: str):
+        """Removes a user from a room if both exist.
+
+        The user is removed the next time the room is locked, so leave never
+        waits on the room, or on another worker with shared state; it is
+        called as users expire, with the user store's lock held.
+        """
+        if self.state.shared or room_id in self._rooms:
+            self._pending_leaves.setdefault(room_id, []).append(user_id)
+
+    def archive(self, room: Room):
+        """Keeps the history of the room's game if it has finished, for export."""
+        if room.finished:
+            self.finished_games.append({'room_id': room.room_id, 'history': bytes(room.history)})
+
+    def rooms(self) -> list[Room]:
+        """Returns all rooms, including those created by other workers if the state is shared."""
+        for room_id in self.state.room_ids():
+            if room_id not in self._rooms:
+                self.get(room_id)
+        return list(self._rooms.values())
+
+    def list(self) -> list[dict]:
+        """Returns summaries of all rooms."""
+        rooms = self.rooms()
+        with self._lock:
+            self._evict_idle()
+
+        summaries = []
+        for room in rooms:
+            if room.room_id in self._rooms:
+                with self.locked(room):
+                    summaries.append(room.summary())
+        return summaries
@@ -0,0 +1,211 @@
+"""Module containing the move rules as pure functions on immutable compact states.
+
+A State holds counts (for each seat, a tuple of the number of that
+seat's counters on each square, square FINISH holding finished counters),
+the seat to move and the counters each seat started with. Nothing here
+knows about players, users or colours, so move sequences can be checked
+in bulk, e.g. for tournament adjudication or replaying submitted games,
+and spread across a process pool with check_sequences.
+
+A move is (die_roll, square moved from), with square None for a turn
+passed because the roll allowed no move.
+
+Run as a script to check NDJSON sequences, one per line, e.g.
+    {"number_of_players": 2, "counters_per_player": 1, "moves": [[3, 0], [2, null]]}
+with python rules.py sequences.ndjson --workers 4
+"""
+
+import json
+import sys
+from argparse import ArgumentParser
+from typing import NamedTuple
+
+from backend import FINISH, NUMBER_OF_SQUARES
+
+
+class IllegalMove(ValueError):
+    """Raised when a move breaks the rules in the state it is applied to."""
+
+
+class State(NamedTuple):
+    """Immutable position: counters per seat and square, the seat to move and counters per seat."""
+
+    counts: tuple
+    seat: int
+    counters_per_player: int
+
+
+def initial_state(number_of_players: int, counters_per_player: int) -> State:
+    """Returns the start of a game: every counter on square 0 and seat 0 to move."""
+    squares = (counters_per_player,) + (0,) * NUMBER_OF_SQUARES
+    return State((squares,) * number_of_players, 0, counters_per_player)
+
+
+def encode(game) -> tuple:
+    """Returns the counts of a backend.Game, seated from the player to move."""
+    return tuple(tuple(game.board.counts[player.colour]) for player in game.players)
+
+
+def from_game(game) -> State:
+    """Returns the state of a backend.Game, seated from the player to move."""
+    return State(encode(game), 0, game.counters_per_player)
+
+
+def movable_squares(counts: tuple, seat: int, die_roll: int) -> list[int]:
+    """Squares from which the seat can move a counter die_roll squares.
+
+    A square between the start and the destination blocks the move if it
+    holds two or more counters not all of the seat's own, and a counter
+    must finish exactly on FINISH.
+    """
+    own = counts[seat]
+    totals = [sum(square) for square in zip(*counts)]
+    moves = []
+    for index in range(NUMBER_OF_SQUARES):
+        if own[index] == 0 or index + die_roll > FINISH:
+            continue
+        if all(totals[i] < 2 or own[i] == totals[i] for i in range(index + 1, index + die_roll)):
+            moves.append(index)
+
+    return moves
+
+
+def can_move(counts: tuple, seat: int, index: int, die_roll: int) -> bool:
+    """Returns if the seat can move a counter from index die_roll squares; see movable_squares."""
+    if not 0 <= index < NUMBER_OF_SQUARES or index + die_roll > FINISH or counts[seat][index] == 0:
+        return False
+    own = counts[seat]
+    for i in range(index + 1, index + die_roll):
+        total = sum(squares[i] for squares in counts)
+        if total >= 2 and own[i] < total:
+            return False
+    return True
+
+
+def move_counts(counts: tuple, seat: int, index: int, die_roll: int) -> tuple:
+    """Returns the counts after the seat moves a counter from index.
+
+    Other seats' counters passed over go back to square 0, unless they are
+    on a safe square (a multiple of 7).
+    """
+    destination = index + die_roll
+    new_counts = [list(squares) for squares in counts]
+    new_counts[seat][index] -= 1
+    for other, squares in enumerate(new_counts):
+        if other == seat:
+            continue
+        for i in range(index + 1, destination):
+            if squares[i] and i % 7 != 0:
+                squares[0] += squares[i]
+                squares[i] = 0
+    new_counts[seat][destination] += 1
+
+    return tuple(tuple(squares) for squares in new_counts)
+
+
+def next_seat(counts: tuple, seat: int, counters_per_player: int) -> int:
+    """The next seat after seat with counters left to finish."""
+    number_of_seats = len(counts)
+    for step in range(1, number_of_seats + 1):
+        candidate = (seat + step) % number_of_seats
+        if counts[candidate][FINISH] < counters_per_player:
+            return candidate
+
+    return (seat + 1) % number_of_seats
+
+
+def legal_moves(state: State, die_roll: int) -> list[int]:
+    """Squares from which the seat to move can move a counter with die_roll."""
+    return movable_squares(state.counts, state.seat, die_roll)
+
+
+def apply(state: State, move: tuple) -> State:
+    """Returns the state after a move, with the turn passed on; raises IllegalMove if it is not legal."""
+    die_roll, index = move
+    if not 1 <= die_roll <= 6:
+        raise IllegalMove(f"A die cannot roll {die_roll}.")
+
+    if index is None:
+        moves = legal_moves(state, die_roll)
+        if moves:
+            raise IllegalMove(f"Seat {state.seat} passed with moves from {moves}.")
+        counts = state.counts
+    elif not can_move(state.counts, state.seat, index, die_roll):
+        raise IllegalMove(f"Seat {state.seat} cannot move {die_roll} from square {index}.")
+    else:
+        counts = move_counts(state.counts, state.seat, index, die_roll)
+
+    return State(counts, next_seat(counts, state.seat, state.counters_per_player), state.counters_per_player)
+
+
+def finished(state: State, seat: int) -> bool:
+    """Returns if every counter of a seat has finished."""
+    return state.counts[seat][FINISH] == state.counters_per_player
+
+
+def check_sequence(number_of_players: int, counters_per_player: int, moves: list) -> dict:
+    """Plays moves from the start of a game, stopping at the first illegal one.
+
+    Returns if every move was legal, how many were applied, the error if
+    any, the first seat to finish (or None) and the final counts.
+    """
+    state = initial_state(number_of_players, counters_per_player)
+    winner = None
+    error = None
+    applied = 0
+    for move in moves:
+        seat = state.seat
+        try:
+            state = apply(state, tuple(move))
+        except (TypeError, ValueError) as exception:
+            error = str(exception)
+            break
+        applied += 1
+        if winner is None and finished(state, seat):
+            winner = seat
+
+    return {
+        'valid': error is None,
+        'moves_applied': applied,
+        'error': error,
+        'winner': winner,
+        'counts': [list(squares) for squares in state.counts]
+    }
+
+
+def _check(sequence: dict) -> dict:
+    """Checks one sequence given as a dictionary; the entry point for worker processes."""
+    return check_sequence(sequence['number_of_players'], sequence['counters_per_player'], sequence['moves'])
+
+
+def check_sequences(sequences: list[dict], workers: int = 1, chunksize: int = 64) -> list[dict]:
+    """Checks sequences (dictionaries of number_of_players, counters_per_player and moves) in order.
+
+    With more than one worker they are spread, in chunks, across a pool of
+    processes.
+    """
+    if workers <= 1:
+        return [_check(sequence) for sequence in sequences]
+
+    from concurrent.futures import ProcessPoolExecutor
+    from multiprocessing import get_context
+
+    with ProcessPoolExecutor(max_workers=workers, mp_context=get_context('spawn')) as executor:
+        return list(executor.map(_check, sequences, chunksize=chunksize))
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Check sequences of moves against the rules of The Roman Stones.")
+    parser.add_argument('input', help="NDJSON file of sequences, or - for standard input")
+    parser.add_argument('--workers', type=int, default=1, help="processes to check sequences in")
+    parser.add_argument('--chunksize', type=int, default=64, help="sequences sent to a process at a time")
+    args = parser.parse_args()
+
+    input_file = sys.stdin if args.input == '-' else open(args.input)
+    with input_file:
+        sequences = [json.loads(line) for line in input_file if line.strip()]
+
+    for sequence, result in zip(sequences, check_sequences(sequences, args.workers, args.chunksize)):
+        if 'id' in sequence:
+            result = {'id': sequence['id'], **result}
+        print(json.dumps(result))
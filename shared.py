@@ -0,0 +1,233 @@
+"""Module containing the state backends and push channels rooms are shared through.
+
+The in-process defaults keep everything in this process's memory, which
+is all a single worker needs. The SQLite implementations let several
+worker processes on one machine serve the same rooms: each room's state
+is stored with a revision number and guarded by a per-room file lock,
+and pushes are published to a table every worker polls, so each worker
+can deliver them to the websocket clients connected to it.
+"""
+
+import fcntl
+import json
+import logging
+import os
+import sqlite3
+from base64 import b64decode, b64encode
+from contextlib import contextmanager, nullcontext
+from threading import Lock, Thread, local
+from time import sleep, time
+
+import eventlog
+
+logger = logging.getLogger(__name__)
+
+
+def connect(path: str) -> sqlite3.Connection:
+    """Opens a SQLite database for sharing between processes."""
+    connection = sqlite3.connect(path, timeout=5, isolation_level=None, check_same_thread=False)
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('PRAGMA synchronous=NORMAL')
+    return connection
+
+
+def room_state(room) -> str:
+    """Returns the state of a room as JSON."""
+    return json.dumps({
+        'game': eventlog.snapshot_game(room.game),
+        'history': b64encode(room.history).decode(),
+        'number_of_events': room.number_of_events,
+        'version': room.version,
+        'generation': room.generation,
+        'user_ids': list(room.user_ids),
+        'sync_user_ids': list(room.sync_user_ids),
+        'fragment_keys': room.fragment_keys
+    })
+
+
+def restore_room(room, state: str):
+    """Sets a room's game, history, version, users and sent fragments from JSON made by room_state."""
+    state = json.loads(state)
+    room.game = eventlog.restore_game(state['game'])
+    room.history = bytearray(b64decode(state['history']))
+    room.number_of_events = state.get('number_of_events')
+    if room.number_of_events is None:
+        room.number_of_events = eventlog.count_records(room.history)
+    room.version = state['version']
+    room.generation = state.get('generation', room.generation)
+    room.user_ids = set(state['user_ids'])
+    room.sync_user_ids = set(state.get('sync_user_ids', []))
+    room.fragment_keys = {target: tuple(key) if isinstance(key, list) else key
+                          for target, key in state['fragment_keys'].items()}
+
+
+class MemoryState():
+    """Class for rooms held only in this process; every operation is a no-op."""
+
+    shared = False
+
+    def lock(self, room_id: str):
+        """Returns a context manager holding the room across processes."""
+        return nullcontext()
+
+    def refresh(self, room) -> bool:
+        """Loads a newer revision of the room if one is stored; returns if it is stored at all."""
+        return False
+
+    def save(self, room):
+        """Stores the room's current revision."""
+
+    def room_ids(self) -> list[str]:
+        """Returns the ids of stored rooms."""
+        return []
+
+    def delete(self, room_id: str, idle_since: float):
+        """Deletes a stored room if it has not been saved since idle_since (a time.time())."""
+
+
+class SqliteState(MemoryState):
+    """Class storing rooms in a SQLite database shared by every worker process."""
+
+    shared = True
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.lock_dir = f'{path}.locks'
+        os.makedirs(self.lock_dir, exist_ok=True)
+        self._local = local()
+        self._lock_files = {}
+        self._lock_files_lock = Lock()
+        self._connection().execute(
+            'CREATE TABLE IF NOT EXISTS rooms '
+            '(room_id TEXT PRIMARY KEY, revision INTEGER, updated REAL, state TEXT)'
+        )
+
+    def _connection(self) -> sqlite3.Connection:
+        """Returns this thread's connection to the database."""
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = self._local.connection = connect(self.path)
+        return connection
+
+    def _lock_file(self, room_id: str) -> int:
+        """Returns the descriptor of the room's lock file, opening it on first use."""
+        with self._lock_files_lock:
+            descriptor = self._lock_files.get(room_id)
+            if descriptor is None:
+                path = os.path.join(self.lock_dir, room_id.encode().hex())
+                descriptor = self._lock_files[room_id] = os.open(path, os.O_RDWR | os.O_CREAT)
+        return descriptor
+
+    @contextmanager
+    def lock(self, room_id: str):
+        descriptor = self._lock_file(room_id)
+        fcntl.flock(descriptor, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(descriptor, fcntl.LOCK_UN)
+
+    def refresh(self, room) -> bool:
+        row = self._connection().execute(
+            'SELECT revision, state FROM rooms WHERE room_id = ?', (room.room_id,)
+        ).fetchone()
+        if row is None:
+            return False
+        if row[0] > room.revision:
+            restore_room(room, row[1])
+            room.revision = row[0]
+        return True
+
+    def save(self, room):
+        self._connection().execute(
+            'INSERT INTO rooms VALUES (?, ?, ?, ?) ON CONFLICT(room_id) DO UPDATE SET '
+            'revision = excluded.revision, updated = excluded.updated, state = excluded.state',
+            (room.room_id, room.revision, time(), room_state(room))
+        )
+
+    def room_ids(self) -> list[str]:
+        return [row[0] for row in self._connection().execute('SELECT room_id FROM rooms')]
+
+    def delete(self, room_id: str, idle_since: float):
+        self._connection().execute(
+            'DELETE FROM rooms WHERE room_id = ? AND updated < ?', (room_id, idle_since)
+        )
+
+
+class LocalPubSub():
+    """Class delivering published pushes straight to this process's subscribers."""
+
+    def __init__(self) -> None:
+        self._subscribers = []
+
+    def subscribe(self, deliver):
+        """Calls deliver(stream, recipients) for every push published by any worker."""
+        self._subscribers.append(deliver)
+
+    def publish(self, stream: str, recipients: list[str]):
+        """Publishes a push to every worker."""
+        for deliver in self._subscribers:
+            deliver(stream, recipients)
+
+
+class SqlitePubSub(LocalPubSub):
+    """Class publishing pushes through a SQLite table that every worker polls.
+
+    Messages older than retention_s are deleted by whichever worker
+    notices them first.
+    """
+
+    def __init__(self, path: str, poll_interval_s: float = 0.005, retention_s: float = 60) -> None:
+        super().__init__()
+        self.poll_interval_s = poll_interval_s
+        self.retention_s = retention_s
+        self._local = local()
+        self.path = path
+        connection = self._connection()
+        connection.execute(
+            'CREATE TABLE IF NOT EXISTS pushes '
+            '(id INTEGER PRIMARY KEY AUTOINCREMENT, created REAL, stream TEXT, recipients TEXT)'
+        )
+        self._last_id = connection.execute('SELECT COALESCE(MAX(id), 0) FROM pushes').fetchone()[0]
+        self._thread = None
+
+    def _connection(self) -> sqlite3.Connection:
+        """Returns this thread's connection to the database."""
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = self._local.connection = connect(self.path)
+        return connection
+
+    def subscribe(self, deliver):
+        super().subscribe(deliver)
+        if self._thread is None:
+            self._thread = Thread(target=self._run, name='push-subscriber', daemon=True)
+            self._thread.start()
+
+    def publish(self, stream: str, recipients: list[str]):
+        self._connection().execute(
+            'INSERT INTO pushes (created, stream, recipients) VALUES (?, ?, ?)',
+            (time(), stream, json.dumps(recipients))
+        )
+
+    def _run(self):
+        """Delivers new messages as they appear, pruning old ones now and then."""
+        connection = connect(self.path)
+        last_pruned = time()
+        while True:
+            rows = connection.execute(
+                'SELECT id, stream, recipients FROM pushes WHERE id > ? ORDER BY id', (self._last_id,)
+            ).fetchall()
+            for message_id, stream, recipients in rows:
+                self._last_id = message_id
+                for deliver in self._subscribers:
+                    try:
+                        deliver(stream, json.loads(recipients))
+                    except Exception:
+                        logger.exception("Delivering a push failed.")
+
+            if time() - last_pruned > self.retention_s:
+                last_pruned = time()
+                connection.execute('DELETE FROM pushes WHERE created < ?', (last_pruned - self.retention_s,))
+            if not rows:
+                sleep(self.poll_interval_s)
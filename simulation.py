@@ -0,0 +1,214 @@
+"""Module containing a headless simulator playing many games of The Roman Stones at once.
+
+The rules match backend.Game: a counter moves exactly the die roll, may
+not pass a square holding two or more counters of mixed colour, sends
+every other counter it passes back to square 0 (except on safe squares)
+and must finish exactly on square FINISH. A player with no legal move
+forfeits the turn. Each game stops at its first winner.
+
+Game g rolls the stream DiceStream(seeds[g]) from its start, as a live
+backend.Game(seeds[g]) does, so a simulated game rolls the same dice as
+a live game with the same seed.
+
+Run as a script to print statistics for a set of house rules, e.g.
+    python simulation.py --games 100000 --players 4 --counters 3
+"""
+
+from argparse import ArgumentParser
+
+import numpy as np
+
+from backend import FINISH, NUMBER_OF_SQUARES
+from dice import BLOCK_ROLLS, roll_block
+
+SQUARES = np.arange(NUMBER_OF_SQUARES)
+DEFAULT_SAFE_SQUARES = [i for i in range(NUMBER_OF_SQUARES) if i % 7 == 0]
+
+
+def random_policy(legal: np.ndarray, state: "BatchState", rng: np.random.Generator) -> np.ndarray:
+    """Picks a legal square uniformly at random."""
+    scores = np.where(legal, rng.random(legal.shape), -1)
+    return np.where(legal.any(1), scores.argmax(1), -1)
+
+
+def furthest_policy(legal: np.ndarray, state: "BatchState", rng: np.random.Generator) -> np.ndarray:
+    """Moves the legal counter furthest along the board."""
+    return np.where(legal, SQUARES, -1).max(1)
+
+
+def nearest_policy(legal: np.ndarray, state: "BatchState", rng: np.random.Generator) -> np.ndarray:
+    """Moves the legal counter nearest the start."""
+    nearest = np.where(legal, SQUARES, NUMBER_OF_SQUARES).min(1)
+    return np.where(nearest < NUMBER_OF_SQUARES, nearest, -1)
+
+
+POLICIES = {
+    'random': random_policy,
+    'furthest': furthest_policy,
+    'nearest': nearest_policy
+}
+
+
+class BatchState():
+    """Class holding the state of a batch of games as arrays.
+
+    counts[g, p, s] is the number of counters of player p on square s of
+    game g, with square FINISH holding finished counters. Players keep the
+    seating order they joined in; current[g] is the player whose turn it is.
+    """
+
+    def __init__(self, number_of_games: int, number_of_players: int, counters_per_player: int) -> None:
+        self.number_of_players = number_of_players
+        self.counters_per_player = counters_per_player
+        self.counts = np.zeros((number_of_games, number_of_players, FINISH + 1), dtype=np.int16)
+        self.counts[:, :, 0] = counters_per_player
+        self.current = np.zeros(number_of_games, dtype=np.int64)
+        self.winner = np.full(number_of_games, -1, dtype=np.int64)
+        self.turns = np.zeros(number_of_games, dtype=np.int64)
+        self.captures = np.zeros((number_of_games, number_of_players), dtype=np.int64)
+
+    @property
+    def active(self) -> np.ndarray:
+        """Mask of games that have no winner yet."""
+        return self.winner < 0
+
+    def legal_moves(self, games: np.ndarray, rolls: np.ndarray) -> np.ndarray:
+        """Returns a [games, squares] mask of squares the current player can move from.
+
+        rolls[i] is the die roll in game games[i].
+        """
+        counts = self.counts[games]
+        own = counts[np.arange(len(games)), self.current[games]]
+        total = counts.sum(1)
+        blocked = (total[:, :NUMBER_OF_SQUARES] >= 2) & (own[:, :NUMBER_OF_SQUARES] < total[:, :NUMBER_OF_SQUARES])
+        # blocked_before[:, k] is the number of blocked squares below square k.
+        blocked_before = np.concatenate(
+            [np.zeros((len(games), 1), dtype=np.int64), blocked.cumsum(1)], axis=1)
+
+        destination = SQUARES + rolls[:, None]
+        in_range = destination <= FINISH
+        destination = np.minimum(destination, FINISH)
+        blocks_passed = (np.take_along_axis(blocked_before, destination, 1)
+                         - blocked_before[:, SQUARES + 1])
+
+        return (own[:, :NUMBER_OF_SQUARES] > 0) & in_range & (blocks_passed <= 0)
+
+    def move(self, sources: np.ndarray, rolls: np.ndarray, safe: np.ndarray):
+        """Moves one counter of the current player from sources[g] in every game where it is not -1."""
+        games = np.flatnonzero(sources >= 0)
+        if len(games) == 0:
+            return
+
+        players = self.current[games]
+        source = sources[games]
+        destination = source + rolls[games]
+        self.counts[games, players, source] -= 1
+
+        squares = np.arange(FINISH + 1)
+        passed = ((squares > source[:, None]) & (squares < destination[:, None]) & ~safe)
+        others = np.arange(self.number_of_players) != players[:, None]
+        captured = self.counts[games] * (passed[:, None, :] & others[:, :, None])
+        captured_per_player = captured.sum(2)
+        self.counts[games] -= captured.astype(np.int16)
+        self.counts[games, :, 0] += captured_per_player.astype(np.int16)
+        self.captures[games] += captured_per_player
+
+        self.counts[games, players, destination] += 1
+        won = self.counts[games, players, FINISH] == self.counters_per_player
+        self.winner[games[won]] = players[won]
+
+    def next_player(self, games: np.ndarray):
+        """Passes the turn in the given games to the next player with counters left to finish."""
+        finished = self.counts[games, :, FINISH] >= self.counters_per_player
+        candidates = (self.current[games, None] + np.arange(1, self.number_of_players + 1)) % self.number_of_players
+        unfinished = ~np.take_along_axis(finished, candidates, 1)
+        first = unfinished.argmax(1)
+        self.current[games] = np.where(
+            unfinished.any(1),
+            candidates[np.arange(len(games)), first],
+            candidates[:, 0]
+        )
+
+
+def simulate(number_of_games: int, number_of_players: int, counters_per_player: int,
+             safe_squares=None, policy=random_policy, seed: int = 0,
+             max_turns: int = 10000, record: bool = False, seeds=None) -> dict:
+    """Plays a batch of games to their first winner and returns statistics.
+
+    seeds gives each game's dice seed; by default they are drawn from seed,
+    which also drives the random policy. If record is set, the result also
+    holds 'history': a list of (rolls, sources, active) arrays for every
+    turn, sources being -1 where no move was made.
+    """
+    rng = np.random.default_rng(seed)
+    if seeds is None:
+        seeds = np.random.SeedSequence(seed).generate_state(number_of_games, dtype=np.uint64)
+    seeds = [int(game_seed) for game_seed in seeds]
+    blocks = np.zeros((number_of_games, BLOCK_ROLLS), dtype=np.int64)
+    if safe_squares is None:
+        safe_squares = DEFAULT_SAFE_SQUARES
+    safe = np.zeros(FINISH + 1, dtype=bool)
+    safe[list(safe_squares)] = True
+
+    state = BatchState(number_of_games, number_of_players, counters_per_player)
+    history = []
+    for turn in range(max_turns):
+        active = state.active
+        if not active.any():
+            break
+
+        games = np.flatnonzero(active)
+        # Every game still playing has rolled once a turn, so all are at roll index turn.
+        block_number, offset = divmod(turn, BLOCK_ROLLS)
+        if offset == 0:
+            for game in games:
+                blocks[game] = roll_block(seeds[game], block_number)
+        rolls = np.zeros(number_of_games, dtype=np.int64)
+        rolls[games] = blocks[games, offset]
+        legal = state.legal_moves(games, rolls[games])
+        sources = np.full(number_of_games, -1, dtype=np.int64)
+        sources[games] = np.where(legal.any(1), policy(legal, state, rng), -1)
+        if record:
+            history.append((rolls, sources, active))
+
+        state.move(sources, rolls, safe)
+        state.turns += active
+        state.next_player(games)
+
+    finished = state.winner >= 0
+    lengths = state.turns[finished]
+    result = {
+        'games': number_of_games,
+        'unfinished': int((~finished).sum()),
+        'win_rates': (np.bincount(state.winner[finished], minlength=number_of_players)
+                      / max(finished.sum(), 1)).tolist(),
+        'mean_length': float(lengths.mean()) if len(lengths) else 0.0,
+        'length_percentiles': {
+            str(q): float(np.percentile(lengths, q)) if len(lengths) else 0.0 for q in (5, 50, 95)
+        },
+        'captures_per_game': float(state.captures.sum(1).mean()),
+        'captures_per_turn': float(state.captures.sum() / max(state.turns.sum(), 1)),
+        'state': state
+    }
+    if record:
+        result['history'] = history
+
+    return result
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Simulate games of The Roman Stones.")
+    parser.add_argument('--games', type=int, default=10000)
+    parser.add_argument('--players', type=int, default=2)
+    parser.add_argument('--counters', type=int, default=2)
+    parser.add_argument('--safe', type=int, nargs='*', default=None,
+                        help="safe squares (default: every seventh square)")
+    parser.add_argument('--policy', choices=POLICIES, default='random')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    result = simulate(args.games, args.players, args.counters, args.safe,
+                      POLICIES[args.policy], args.seed)
+    result.pop('state')
+    for key, value in result.items():
+        print(f"{key}: {value}")
@@ -0,0 +1,60 @@
+// Draws the counters sent as JSON in #board_state, used when the server runs
+// with BOARD_RENDERING=json, or kept by sync.js in #board_sync_state.
+// Builds the same forms as templates/square.html.
+// Guarded so that re-pushing the page head does not register the listeners twice.
+(() => {
+    if (window.boardLoaded) {
+        return;
+    }
+    window.boardLoaded = true;
+
+    function counterForm(colour, index, playable) {
+        const form = document.createElement("form");
+        form.method = "post";
+        form.action = "/move_piece";
+        for (const [name, value] of [["colour", colour], ["square_num", index]]) {
+            const input = document.createElement("input");
+            input.type = "hidden";
+            input.name = name;
+            input.value = value;
+            form.appendChild(input);
+        }
+        const button = document.createElement("button");
+        button.className = playable ? "counter playable" : "counter";
+        button.type = "submit";
+        button.style.backgroundColor = colour;
+        form.appendChild(button);
+        return form;
+    }
+
+    function drawBoard() {
+        const element = document.getElementById("board_sync_state")
+            || document.getElementById("board_state");
+        if (!element) {
+            return;
+        }
+
+        const state = JSON.parse(element.textContent);
+        const playable = new Set(state.playable || []);
+        document.querySelectorAll(".board .square").forEach((square) => {
+            const index = Number(square.id.replace("square_", ""));
+            square.querySelectorAll("form").forEach((form) => form.remove());
+            for (const colourIndex of state.squares[index] || "") {
+                const colour = state.colours[colourIndex];
+                square.appendChild(
+                    counterForm(colour, index, playable.has(index) && colour === state.player_turn)
+                );
+            }
+        });
+    }
+
+    window.drawBoard = drawBoard;
+    document.addEventListener("turbo:load", drawBoard);
+    document.addEventListener("turbo:before-stream-render", (event) => {
+        const render = event.detail.render;
+        event.detail.render = async (stream) => {
+            await render(stream);
+            drawBoard();
+        };
+    });
+})();
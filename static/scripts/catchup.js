@@ -0,0 +1,26 @@
+// Catches a spectator page up with events made after it was rendered, which its
+// websocket connected too late to be pushed: asks /games/<room>/replay how many
+// events the game has since the page's data-event-number and, if the game has
+// moved on, reloads the page, which comes from the page cache.
+// Guarded so that re-pushing the page head does not register the listener twice.
+(() => {
+    if (window.catchUpLoaded) {
+        return;
+    }
+    window.catchUpLoaded = true;
+
+    window.addEventListener("load", async () => {
+        const since = document.body.dataset.eventNumber;
+        const roomId = document.body.dataset.roomId;
+        if (since === undefined || roomId === undefined) {
+            return;
+        }
+
+        const response = await fetch(
+            `/games/${encodeURIComponent(roomId)}/replay?since=${since}&format=json`
+        );
+        if (response.ok && response.headers.get("X-Number-Of-Events") !== since) {
+            window.location.reload();
+        }
+    });
+})();
@@ -0,0 +1,51 @@
+// Client-side die roll animation, used when the server runs with DIE_ANIMATION=client.
+// Follows the same easing as animation.frame_delays on the server.
+// Guarded so that re-pushing the page head does not register the listener twice.
+(() => {
+    if (window.dieAnimationLoaded) {
+        return;
+    }
+    window.dieAnimationLoaded = true;
+
+    const TIME_THRESHOLD_S = 0.5;
+
+    function showDieFace(die, number) {
+        die.dataset.face = number;
+        die.setAttribute("aria-label", `Die Face ${number}`);
+    }
+
+    function animateDie() {
+        const die = document.querySelector("#die_image[data-power]");
+        if (!die) {
+            return;
+        }
+
+        const power = Number(die.dataset.power);
+        const result = die.dataset.result;
+        die.removeAttribute("data-power");
+
+        let timeS = TIME_THRESHOLD_S / (1.2 ** power);
+        const timeFactor = 1.3 - 0.002 * power;
+
+        const step = () => {
+            if (timeS >= TIME_THRESHOLD_S) {
+                showDieFace(die, result);
+                return;
+            }
+            setTimeout(() => {
+                showDieFace(die, 1 + Math.floor(Math.random() * 6));
+                timeS *= timeFactor;
+                step();
+            }, timeS * 1000);
+        };
+        step();
+    }
+
+    document.addEventListener("turbo:before-stream-render", (event) => {
+        const render = event.detail.render;
+        event.detail.render = async (stream) => {
+            await render(stream);
+            animateDie();
+        };
+    });
+})();
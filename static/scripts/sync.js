@@ -0,0 +1,72 @@
+// Keeps the board up to date from the versioned deltas sent on /board-sync,
+// acknowledging each version once applied. A delta that does not follow the
+// version shown asks the server for a full snapshot. The state is kept in
+// #board_sync_state, which board.js draws from. Without this script the
+// board is updated by turbo stream fragments instead.
+// Guarded so that re-pushing the page head does not open a second websocket.
+(() => {
+    if (window.boardSyncLoaded) {
+        return;
+    }
+    window.boardSyncLoaded = true;
+
+    let state = null;
+    let version = null;
+
+    function store() {
+        if (!state || !document.body) {
+            return;
+        }
+        let element = document.getElementById("board_sync_state");
+        if (!element) {
+            element = document.createElement("script");
+            element.type = "application/json";
+            element.id = "board_sync_state";
+            document.body.appendChild(element);
+        }
+        element.textContent = JSON.stringify(state);
+    }
+
+    function apply(socket, message) {
+        if (message.colours) {
+            state = {colours: message.colours, squares: {}, playable: [], player_turn: ""};
+        } else if (!state || message.base !== version) {
+            socket.send(JSON.stringify({resync: true}));
+            return;
+        }
+
+        for (const [index, counters] of Object.entries(message.squares || {})) {
+            if (counters) {
+                state.squares[index] = counters;
+            } else {
+                delete state.squares[index];
+            }
+        }
+        for (const field of ["playable", "player_turn"]) {
+            if (field in message) {
+                state[field] = message[field];
+            }
+        }
+        version = message.version;
+
+        const gameVersion = document.getElementById("game_version");
+        if (gameVersion && Number(gameVersion.dataset.version) < version) {
+            gameVersion.dataset.version = version;
+        }
+        store();
+        window.drawBoard();
+        socket.send(JSON.stringify({ack: version}));
+    }
+
+    function connect() {
+        const socket = new WebSocket(`ws${location.protocol.substring(4)}//${location.host}/board-sync`);
+        socket.addEventListener("message", (event) => apply(socket, JSON.parse(event.data)));
+        socket.addEventListener("close", () => setTimeout(connect, 1000));
+    }
+
+    document.addEventListener("turbo:load", () => {
+        store();
+        window.drawBoard();
+    });
+    connect();
+})();
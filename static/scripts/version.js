@@ -0,0 +1,40 @@
+// Sends the game version the page is showing with every form it posts, so the
+// server can reject actions made against an out-of-date board, or made twice.
+// Pushes are sent after the room is unlocked, so those of concurrent requests
+// can arrive out of order; a pushed version older than the page's is ignored.
+// Guarded so that re-pushing the page head does not register the listener twice.
+(() => {
+    if (window.gameVersionLoaded) {
+        return;
+    }
+    window.gameVersionLoaded = true;
+
+    document.addEventListener("submit", (event) => {
+        const version = document.getElementById("game_version");
+        const form = event.target;
+        if (!version || form.method.toLowerCase() !== "post") {
+            return;
+        }
+
+        let input = form.querySelector("input[name=version]");
+        if (!input) {
+            input = document.createElement("input");
+            input.type = "hidden";
+            input.name = "version";
+            form.appendChild(input);
+        }
+        input.value = version.dataset.version;
+    }, true);
+
+    document.addEventListener("turbo:before-stream-render", (event) => {
+        const stream = event.target;
+        if (stream.target !== "game_version") {
+            return;
+        }
+        const current = document.getElementById("game_version");
+        const pushed = stream.templateContent.firstElementChild;
+        if (current && pushed && Number(pushed.dataset.version) < Number(current.dataset.version)) {
+            event.preventDefault();
+        }
+    });
+})();
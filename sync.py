@@ -0,0 +1,155 @@
+"""Module containing the versioned board deltas sent to clients running static/scripts/sync.js.
+
+Each connection remembers the last board it was sent and the last version
+the client acknowledged, so a new version is sent as only the squares and
+fields that changed. Clients that fall more than max_behind versions
+behind what they were sent, or that ask to resync, get a full snapshot.
+Messages are compact JSON; the websocket compresses them with
+permessage-deflate when the browser offers it.
+"""
+
+import json
+from threading import Lock
+
+SYNC_PREFIX = 'board-sync:'
+
+
+def snapshot(game, palette: list[str]) -> dict:
+    """Returns the board of a game as squares of palette indices, with the turn and legal moves.
+
+    Counters of colours outside the palette are left out.
+    """
+    colour_index = {colour: str(index) for index, colour in enumerate(palette)}
+    squares = {}
+    for index, square in enumerate(game.counters):
+        counters = ''.join(colour_index[colour] for colour in square if colour in colour_index)
+        if counters:
+            squares[str(index)] = counters
+
+    player = game.players[0] if game.players else None
+    return {
+        'squares': squares,
+        'player_turn': player.colour if player else '',
+        'playable': game.legal_moves() if player and player.die_roll else [],
+        'mover': player.user_id if player else None
+    }
+
+
+def view(state: dict, user_id: str) -> dict:
+    """Returns the part of a snapshot a user is sent; only the mover sees their legal moves."""
+    return {
+        'squares': state['squares'],
+        'player_turn': state['player_turn'],
+        'playable': state['playable'] if state['mover'] == user_id else []
+    }
+
+
+def diff(old: dict, new: dict) -> dict:
+    """Returns the fields of new that differ from old, with emptied squares as ''."""
+    changes = {}
+    squares = {index: counters for index, counters in new['squares'].items()
+               if old['squares'].get(index) != counters}
+    squares.update({index: '' for index in old['squares'] if index not in new['squares']})
+    if squares:
+        changes['squares'] = squares
+    for field in ('player_turn', 'playable'):
+        if old[field] != new[field]:
+            changes[field] = new[field]
+    return changes
+
+
+def encode_update(version: int, state: dict) -> str:
+    """Returns a board snapshot as a message for the push channel."""
+    return SYNC_PREFIX + json.dumps({'version': version, 'state': state}, separators=(',', ':'))
+
+
+def decode_update(stream: str):
+    """Returns (version, state) from a push channel message, or None if it is a turbo stream."""
+    if not stream.startswith(SYNC_PREFIX):
+        return None
+    update = json.loads(stream[len(SYNC_PREFIX):])
+    return update['version'], update['state']
+
+
+class SyncConnection():
+    """Class for one sync.js websocket: what it was last sent and last acknowledged."""
+
+    __slots__ = ('user_id', 'ws', 'acked', 'sent_version', 'sent_state', 'lock')
+
+    def __init__(self, user_id: str, ws) -> None:
+        self.user_id = user_id
+        self.ws = ws
+        self.acked = None
+        self.sent_version = None
+        self.sent_state = None
+        self.lock = Lock()
+
+
+class BoardSync():
+    """Class holding this worker's sync.js connections and sending them board deltas."""
+
+    def __init__(self, palette: list[str], max_behind: int = 16) -> None:
+        self.palette = palette
+        self.max_behind = max_behind
+        self._connections = {}
+        self._lock = Lock()
+
+    def connect(self, user_id: str, ws) -> SyncConnection:
+        """Registers a websocket for a user."""
+        connection = SyncConnection(user_id, ws)
+        with self._lock:
+            self._connections.setdefault(user_id, []).append(connection)
+        return connection
+
+    def disconnect(self, connection: SyncConnection):
+        """Forgets a websocket."""
+        with self._lock:
+            connections = self._connections.get(connection.user_id, [])
+            if connection in connections:
+                connections.remove(connection)
+            if not connections:
+                self._connections.pop(connection.user_id, None)
+
+    def connected(self, user_id: str) -> bool:
+        """Returns if a user has a sync websocket open to this worker."""
+        return user_id in self._connections
+
+    def acknowledge(self, connection: SyncConnection, message: dict):
+        """Records a client's reply: {"ack": version} once applied, or {"resync": true}."""
+        if message.get('resync'):
+            connection.acked = None
+            if connection.sent_state is not None:
+                self.send(connection, connection.sent_version, connection.sent_state, full=True)
+        elif 'ack' in message:
+            connection.acked = message['ack']
+
+    def message(self, connection: SyncConnection, version: int, state: dict, full: bool = False) -> str:
+        """Returns the message taking a connection to version, a delta unless it needs a snapshot."""
+        behind = (connection.acked is None or connection.sent_state is None
+                  or connection.sent_version - connection.acked > self.max_behind)
+        if full or behind:
+            message = {'version': version, 'colours': self.palette, **view(state, connection.user_id)}
+        else:
+            message = {'version': version, 'base': connection.sent_version,
+                       **diff(view(connection.sent_state, connection.user_id), view(state, connection.user_id))}
+        connection.sent_version = version
+        connection.sent_state = state
+        return json.dumps(message, separators=(',', ':'))
+
+    def send(self, connection: SyncConnection, version: int, state: dict, full: bool = False):
+        """Sends a connection the message taking it to version, unless it was already sent it."""
+        with connection.lock:
+            if not full and connection.sent_version is not None and connection.sent_version >= version:
+                return
+            connection.ws.send(self.message(connection, version, state, full))
+
+    def deliver(self, version: int, state: dict, recipients: list[str]):
+        """Sends the recipients connected to this worker the message taking them to version."""
+        with self._lock:
+            connections = [connection for user_id in recipients
+                           for connection in self._connections.get(user_id, [])]
+        for connection in connections:
+            try:
+                self.send(connection, version, state)
+            except Exception:
+                self.disconnect(connection)
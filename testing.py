@@ -0,0 +1,877 @@
+"""Tests for the game backend, simulator and tooling; run with pytest testing.py"""
+
+import asyncio
+import concurrent.futures
+import json
+import shutil
+import threading
+
+import numpy as np
+import pytest
+
+import ai
+import animation
+import assets
+import backend
+import benchmark
+import dice
+import eventlog
+import fragments
+import gateway
+import metrics
+import profiler
+import pushes
+import rooms
+import rules
+import shared
+import simulation
+import sync
+import users
+
+COLOURS = ['red', 'orange', 'yellow', 'green', 'blue', 'indigo',
+           'violet', 'teal', 'maroon', 'black']
+
+
+def replay_in_backend(result: dict, game_index: int, number_of_players: int,
+                      counters_per_player: int) -> backend.Game:
+    """Plays a recorded simulated game through backend.Game, checking each turn agrees."""
+    game = backend.Game()
+    game.set_num_players_and_counters(number_of_players, counters_per_player)
+    for seat in range(number_of_players):
+        game.add_player(backend.Player(COLOURS[seat], str(seat)))
+
+    for rolls, sources, active in result['history']:
+        if not active[game_index]:
+            break
+
+        player = game.players[0]
+        player.die_roll = int(rolls[game_index])
+        source = int(sources[game_index])
+        legal = [i for i in range(backend.NUMBER_OF_SQUARES)
+                 if game._validate_move(i, player.colour)]
+        assert game.legal_moves() == legal
+
+        if source < 0:
+            assert not game.check_if_moves_exist()
+            player.reset_die()
+            game.next_player()
+        else:
+            assert source in legal
+            assert game.move_piece(source, player.colour, player.user_id)
+
+    return game
+
+
+@pytest.mark.parametrize('policy', simulation.POLICIES.values())
+@pytest.mark.parametrize('number_of_players,counters_per_player', [(1, 1), (2, 2), (4, 3), (10, 4)])
+def test_simulation_matches_backend(policy, number_of_players, counters_per_player):
+    result = simulation.simulate(20, number_of_players, counters_per_player,
+                                 policy=policy, seed=number_of_players, record=True)
+    state = result['state']
+
+    for game_index in range(20):
+        game = replay_in_backend(result, game_index, number_of_players, counters_per_player)
+        for seat in range(number_of_players):
+            assert list(game.board.counts[COLOURS[seat]]) == list(state.counts[game_index, seat])
+
+        winner = state.winner[game_index]
+        if winner >= 0:
+            assert game.check_win(COLOURS[winner])
+        else:
+            assert game.players[0].colour == COLOURS[state.current[game_index]]
+
+
+def test_simulation_rolls_the_dice_of_live_games():
+    result = simulation.simulate(2, 2, 2, seeds=[7, 8], record=True)
+    for game_index, seed in enumerate([7, 8]):
+        live = backend.Game(seed=seed)
+        rolls = [int(rolls[game_index]) for rolls, _, active in result['history'] if active[game_index]]
+        assert rolls == [live.dice.roll() for _ in rolls]
+
+
+def test_simulation_statistics():
+    result = simulation.simulate(200, 3, 2, seed=1)
+
+    assert result['unfinished'] == 0
+    assert np.isclose(sum(result['win_rates']), 1)
+    assert result['mean_length'] > 0
+
+
+def test_rules_match_backend():
+    result = simulation.simulate(10, 3, 3, seed=5, record=True)
+    game = backend.Game()
+    game.set_num_players_and_counters(3, 3)
+    for seat in range(3):
+        game.add_player(backend.Player(COLOURS[seat], str(seat)))
+
+    for rolls, sources, active in result['history']:
+        if not active[0]:
+            break
+        player = game.players[0]
+        player.die_roll = int(rolls[0])
+        counts = rules.encode(game)
+        assert rules.movable_squares(counts, 0, player.die_roll) == game.legal_moves()
+
+        source = int(sources[0])
+        if source < 0:
+            player.reset_die()
+            game.next_player()
+            continue
+        expected = rules.move_counts(counts, 0, source, player.die_roll)
+        game.move_piece(source, player.colour, player.user_id)
+        if game.check_win(player.colour):
+            break
+        seat = rules.next_seat(expected, 0, 3)
+        assert rules.encode(game) == expected[seat:] + expected[:seat]
+
+
+def test_ai_search_returns_legal_move():
+    game = backend.Game()
+    game.set_num_players_and_counters(2, 3)
+    game.add_player(backend.Player('red', 'ai-1'))
+    game.add_player(backend.Player('blue', '2'))
+    counts = rules.encode(game)
+    # Red can move 1 -> 3 or win with 26 -> 28.
+    counts = ((0, 1) + (0,) * 24 + (1, 0, 1),) + counts[1:]
+
+    searcher = ai.Searcher(ai.TranspositionTable(maxsize=1000))
+    assert searcher.choose_move(counts, 2, 3, time_budget_s=0.2) == 26
+    assert len(searcher.table) <= 1000
+
+
+def test_event_log_recovers_game(tmp_path, monkeypatch):
+    monkeypatch.setattr(eventlog, 'SNAPSHOT_EVERY', 7)
+    result = simulation.simulate(1, 2, 2, seed=3, record=True)
+    room = rooms.Room('room', eventlog.EventLog(str(tmp_path), 'room'))
+    game = room.game
+    game.set_num_players_and_counters(2, 2)
+    for seat in range(2):
+        game.add_player(backend.Player(COLOURS[seat], str(seat)))
+        settings = (2, 2) if seat == 0 else (0, 0)
+        room.record(eventlog.JOIN, eventlog.join_payload(COLOURS[seat], str(seat), *settings))
+
+    for rolls, sources, active in result['history'][:40]:
+        player = game.players[0]
+        player.die_roll = int(rolls[0])
+        source = int(sources[0])
+        if source < 0:
+            player.reset_die()
+            game.next_player()
+            room.record(eventlog.ROLL, eventlog.roll_payload(int(rolls[0])))
+        else:
+            room.record(eventlog.ROLL, eventlog.roll_payload(int(rolls[0])))
+            game.move_piece(source, player.colour, player.user_id)
+            room.record(eventlog.MOVE, eventlog.move_payload(source, player.colour))
+    room.event_log.sync()
+
+    recovered, history = eventlog.EventLog(str(tmp_path), 'room').recover()
+    assert eventlog.snapshot_game(recovered) == eventlog.snapshot_game(game)
+    assert history == room.history
+    # These rolls were not drawn from the game's dice, so the history holds no seed to replay.
+    replayed = eventlog.snapshot_game(eventlog.replay(history))
+    assert {**replayed, 'dice': None} == {**eventlog.snapshot_game(game), 'dice': None}
+
+
+def test_games_with_the_same_seed_roll_the_same_dice(tmp_path):
+    stream = dice.DiceStream(seed=42)
+    rolls = [stream.roll() for _ in range(dice.BLOCK_ROLLS + 10)]
+    again = dice.DiceStream(seed=42)
+    assert rolls == [again.roll() for _ in rolls] and set(rolls) == {1, 2, 3, 4, 5, 6}
+    resumed = dice.DiceStream(42, dice.BLOCK_ROLLS - 3)
+    assert [resumed.roll() for _ in range(6)] == rolls[dice.BLOCK_ROLLS - 3:dice.BLOCK_ROLLS + 3]
+    assert stream.frames(3, 10) == dice.DiceStream(42).frames(3, 10)
+
+    room = rooms.Room('room', eventlog.EventLog(str(tmp_path), 'room'))
+    game = room.game = backend.Game(seed=7)
+    game.set_num_players_and_counters(2, 2)
+    for seat in range(2):
+        game.add_player(backend.Player(COLOURS[seat], str(seat)))
+        settings = (2, 2) if seat == 0 else (0, 0)
+        room.record(eventlog.JOIN, eventlog.join_payload(COLOURS[seat], str(seat), *settings))
+    for _ in range(30):
+        player = game.players[0]
+        player.roll_die(game.dice)
+        room.record(eventlog.ROLL, eventlog.roll_payload(player.die_roll, game.dice.seed, game.dice.index - 1))
+        moves = game.legal_moves()
+        if moves:
+            game.move_piece(moves[0], player.colour, player.user_id)
+            room.record(eventlog.MOVE, eventlog.move_payload(moves[0], player.colour))
+        else:
+            player.reset_die()
+            game.next_player()
+    room.event_log.sync()
+
+    recovered, _ = eventlog.EventLog(str(tmp_path), 'room').recover()
+    assert (recovered.dice.seed, recovered.dice.index) == (7, 30)
+    assert recovered.dice.roll() == game.dice.roll()
+
+
+def test_benchmark_compare_flags_regressions():
+    baseline = {'results': {'fast': {'median_ns': 100}, 'slow': {'median_ns': 100}}}
+    results = {'results': {'fast': {'median_ns': 110}, 'slow': {'median_ns': 150},
+                           'new': {'median_ns': 500}}}
+    regressions = benchmark.compare(results, baseline, threshold=0.2)
+    assert [regression['name'] for regression in regressions] == ['slow']
+    assert regressions[0]['ratio'] == pytest.approx(1.5)
+
+
+def test_metrics_merge_threads_into_prometheus_histograms():
+    recorder = metrics.Metrics(enabled=True)
+    recorder.observe('trs_push_bytes', 100)
+    thread = threading.Thread(target=recorder.observe, args=('trs_push_bytes', 5000))
+    thread.start()
+    thread.join()
+
+    text = recorder.render({'trs_rooms': ("Rooms in memory.", 3)})
+    assert 'trs_rooms 3' in text
+    assert 'trs_push_bytes_bucket{le="256"} 1' in text
+    assert 'trs_push_bytes_bucket{le="+Inf"} 2' in text
+    assert 'trs_push_bytes_sum 5100.0' in text
+    assert recorder.render({}) == text.split('trs_rooms 3\n')[1]
+
+
+def test_die_animator_eases_frames_and_cancels_by_room(monkeypatch):
+    assert animation.frame_delays(0) == []
+    delays = animation.frame_delays(10)
+    assert delays[0] == pytest.approx(animation.TIME_THRESHOLD_S / 1.2**10)
+    assert all(later == pytest.approx(earlier * 1.28) for earlier, later in zip(delays, delays[1:]))
+    assert delays[-1] < animation.TIME_THRESHOLD_S <= delays[-1] * 1.28
+    assert len(animation.frame_delays(150)) == animation.MAX_FRAMES
+
+    monkeypatch.setattr(animation, 'TIME_THRESHOLD_S', 0.05)
+    faces = list(range(1, len(animation.frame_delays(10)) + 1))
+    animator = animation.DieAnimator()
+    first, second, cancelled = [], [], []
+    done = threading.Event()
+    animator.start(first.append, 10, 5, None, faces, key='table')
+    animator.start(second.append, 10, 6, done.set, faces, key='table')
+    assert done.wait(5)
+    assert first == faces + [5] and second == faces + [6]
+
+    done.clear()
+    animator.start(cancelled.append, 10, 6, lambda: cancelled.append('done'), faces, key='table')
+    animator.cancel('table')
+    animator.start(lambda die_number: None, 10, 6, done.set, faces, key='other')
+    assert done.wait(5)
+    assert cancelled == [] and animator._animations == {}
+
+
+def test_computer_roll_leaves_the_humans_animation_running(app_module, monkeypatch):
+    class IdleExecutor():
+        def submit(self, *args):
+            return concurrent.futures.Future()
+
+    sent = []
+    monkeypatch.setattr(app_module, 'DIE_ANIMATION', 'server')
+    monkeypatch.setattr(animation, 'TIME_THRESHOLD_S', 0.05)
+    monkeypatch.setattr(app_module, 'get_ai_executor', IdleExecutor)
+    monkeypatch.setattr(app_module, 'send_pushes', lambda stream, recipients: sent.append(stream))
+    client = app_module.app.test_client()
+    client.get('/rooms/animated')
+    client.post('/login', data={'colour': 'red', 'num_players': 2, 'counters_per_player': 1})
+    client.post('/add_ai')
+    game = app_module.room_registry.get('animated').game
+    # The human's counter waits one square from home, so any roll but 1 leaves no move.
+    game.board.remove('red', 0)
+    game.board.add('red', backend.FINISH - 1)
+    game.dice = dice.DiceStream(next(seed for seed in range(100) if dice.DiceStream(seed).roll() > 1))
+
+    client.post('/roll_die', data={'power': 10})
+    assert ai.is_ai(game.players[0].user_id) and game.players[0].die_roll
+    for _ in range(100):
+        if any('No Moves Available' in stream for stream in sent):
+            break
+        threading.Event().wait(0.05)
+    assert any('No Moves Available' in stream for stream in sent)
+
+
+def test_rolls_outside_the_power_slider_are_rejected(app_module):
+    clients = benchmark.seat_clients(app_module, 'power', 2, 1)
+    game = app_module.room_registry.get('power').game
+    mover = clients[game.players[0].user_id]
+    for power in ('0', '150', 'strong', ''):
+        assert mover.post('/roll_die', data={'power': power}).status_code == 400
+    assert game.players[0].die_roll == 0
+    assert mover.post('/roll_die', data={'power': animation.MAX_POWER}).status_code == 302
+
+
+def test_registry_evicts_idle_rooms_when_at_capacity():
+    registry = rooms.RoomRegistry(max_rooms=2, idle_timeout_s=60)
+    registry.create(rooms.DEFAULT_ROOM_ID)
+    idle = registry.create('idle')
+    with pytest.raises(rooms.RoomsFull):
+        registry.create('third')
+
+    idle.last_active -= 61
+    registry.get(rooms.DEFAULT_ROOM_ID).last_active -= 61
+    assert registry.create('third').room_id == 'third'
+    assert registry.get('idle') is None and registry.get(rooms.DEFAULT_ROOM_ID) is not None
+    assert len(registry) == 2
+
+
+def test_user_store_expires_users_not_seated_in_live_rooms():
+    registry = rooms.RoomRegistry()
+    room = registry.create('table')
+    expired = []
+    store = users.MemoryUserStore(
+        ttl_s=60, on_expire=expired.append,
+        keep=lambda user: registry.is_seated(user.room_id, user.get_id())
+    )
+    visitor, seated, abandoned = (store.new_user('table') for _ in range(3))
+    for user in (seated, abandoned):
+        user.authenticate_user()
+    room.game.add_player(backend.Player('red', seated.get_id()))
+    abandoned.room_id = 'evicted'
+    for user in (visitor, seated, abandoned):
+        store._last_seen[user.get_id()] -= 61
+    room.last_active -= 61
+    idle_since = room.last_active
+
+    store.add(store.new_user('table'))
+    assert expired == [visitor, abandoned]
+    assert store.get(seated.get_id()) is seated and len(store) == 2
+    assert room.last_active == idle_since
+
+
+def test_login_after_the_visitor_expired_starts_again(app_module):
+    client = app_module.app.test_client()
+    client.get('/rooms/expired')
+    client.get('/login')
+    (user_id,) = app_module.room_registry.get('expired').user_ids
+    app_module.users.remove(user_id)
+
+    response = client.post('/login', data={'colour': 'red', 'num_players': 2, 'counters_per_player': 1})
+    assert response.status_code == 302 and response.location.endswith('/login')
+    assert app_module.room_registry.get('expired').game.players == []
+
+
+def test_users_leave_rooms_under_the_room_lock():
+    registry = rooms.RoomRegistry()
+    room = registry.join('table', 'alice')
+    revision = room.revision
+    registry.leave('table', 'alice')
+    registry.leave('gone', 'bob')
+    assert 'alice' in room.user_ids and 'gone' not in registry._pending_leaves
+
+    with registry.locked(room):
+        assert 'alice' not in room.user_ids and room.revision == revision + 1
+
+
+def test_full_registry_answers_503(app_module, monkeypatch):
+    monkeypatch.setattr(app_module, 'room_registry', rooms.RoomRegistry(max_rooms=0))
+    client = app_module.app.test_client()
+    assert client.get('/rooms/anywhere').status_code == 503
+    assert client.get('/login').status_code == 503
+
+
+def test_shared_state_syncs_rooms_between_registries(tmp_path):
+    path = str(tmp_path / 'state.sqlite3')
+    first = rooms.RoomRegistry(state=shared.SqliteState(path))
+    second = rooms.RoomRegistry(state=shared.SqliteState(path))
+
+    room = first.join('table', 'alice')
+    with first.locked(room):
+        room.game.set_num_players_and_counters(2, 1)
+        room.game.add_player(backend.Player('red', 'alice'))
+        room.record(eventlog.JOIN, eventlog.join_payload('red', 'alice', 2, 1))
+
+    copy = second.get('table')
+    assert copy.user_ids == {'alice'}
+    with second.locked(copy):
+        copy.game.add_player(backend.Player('blue', 'bob'))
+        copy.record(eventlog.JOIN, eventlog.join_payload('blue', 'bob'))
+    second.leave('table', 'alice')
+
+    with first.locked(room):
+        assert room.game.player_ids == ['alice', 'bob']
+        assert room.history == copy.history
+    with second.locked(copy):
+        assert copy.user_ids == set()
+
+
+@pytest.fixture
+def app_module(monkeypatch):
+    monkeypatch.setenv('SECRET_KEY', 'testing')
+    monkeypatch.setenv('EVENT_LOG_DIR', '')
+    monkeypatch.setenv('DIE_ANIMATION', 'client')
+    return benchmark.load_app()
+
+
+def test_computer_turn_pushes_reach_the_human(app_module, monkeypatch):
+    class IdleExecutor():
+        def submit(self, *args):
+            return concurrent.futures.Future()
+
+    sent = []
+    monkeypatch.setattr(app_module, 'get_ai_executor', IdleExecutor)
+    monkeypatch.setattr(app_module, 'send_pushes', lambda stream, recipients: sent.append(stream))
+    client = app_module.app.test_client()
+    client.get('/rooms/against-ai')
+    client.post('/login', data={'colour': 'red', 'num_players': 2, 'counters_per_player': 1})
+    client.post('/add_ai')
+    room = app_module.room_registry.get('against-ai')
+    human = room.game.players[0]
+    client.post('/roll_die', data={'power': 1})
+    sent.clear()
+
+    client.post('/move_piece', data={'square_num': 0, 'colour': human.colour})
+    assert ai.is_ai(room.game.players[0].user_id) and room.game.players[0].die_roll
+    versions = [stream for stream in sent if 'id="game_version"' in stream]
+    assert f'data-version="{room.version}"' in versions[-1]
+    assert any(f'data-face="{room.game.players[0].die_roll}"' in stream for stream in sent)
+
+
+def test_failed_computer_search_still_moves(app_module, monkeypatch):
+    class FailingExecutor():
+        def submit(self, *args):
+            future = concurrent.futures.Future()
+            future.set_exception(RuntimeError("search crashed"))
+            return future
+
+    monkeypatch.setattr(app_module, 'get_ai_executor', FailingExecutor)
+    client = app_module.app.test_client()
+    client.get('/rooms/failing-ai')
+    client.post('/login', data={'colour': 'red', 'num_players': 2, 'counters_per_player': 1})
+    client.post('/add_ai')
+    game = app_module.room_registry.get('failing-ai').game
+    computer = game.players[1]
+    client.post('/roll_die', data={'power': 1})
+    client.post('/move_piece', data={'square_num': 0, 'colour': 'red'})
+    assert game.board.count(computer.colour, 0) == 0
+
+
+def test_moves_update_the_board_index_and_push_the_changed_squares(app_module, monkeypatch):
+    sent = []
+    monkeypatch.setattr(app_module, 'send_pushes', lambda stream, recipients: sent.append(stream))
+    clients = benchmark.seat_clients(app_module, 'board-index', 2, 2)
+    game = app_module.room_registry.get('board-index').game
+    mover = clients[game.players[0].user_id]
+    mover.post('/roll_die', data={'power': 1})
+    roll = game.players[0].die_roll
+    sent.clear()
+
+    mover.post('/move_piece', data={'square_num': 0, 'colour': 'red'})
+    board = game.board
+    assert (board.count('red', 0), board.count('red', roll), board.count('orange', 0)) == (1, 1, 2)
+    assert board.occupied == {'red': {0, roll}, 'orange': {0}} and board.crowded == {0}
+    pushed = ''.join(sent)
+    assert 'target="square_0"' in pushed
+    square = pushed.split(f'target="square_{roll}"')[1].split('</turbo-stream>')[0]
+    assert square.count('value="red"') == 1
+
+
+def test_json_board_pushes_one_board_state_per_move(app_module, monkeypatch):
+    sent = []
+    monkeypatch.setattr(app_module, 'send_pushes', lambda stream, recipients: sent.append(stream))
+    monkeypatch.setattr(app_module, 'board_fragments',
+                        fragments.BoardFragments(app_module.app.jinja_env, rendering='json'))
+    clients = benchmark.seat_clients(app_module, 'json-board', 2, 2)
+    room = app_module.room_registry.get('json-board')
+    mover = clients[room.game.players[0].user_id]
+    mover.post('/roll_die', data={'power': 1})
+    roll = room.game.players[0].die_roll
+    sent.clear()
+
+    mover.post('/move_piece', data={'square_num': 0, 'colour': 'red'})
+    pushed = ''.join(sent)
+    assert pushed.count('target="board_state"') == 1 and 'target="square_' not in pushed
+    assert f'"{roll}":"0"' in pushed and room.fragment_keys['board_state'] in pushed
+
+
+def test_stale_and_duplicate_actions_are_rejected(app_module):
+    clients = benchmark.seat_clients(app_module, 'versions', 2, 1)
+    room = app_module.room_registry.get('versions')
+    player = room.game.players[0]
+    client = clients[player.user_id]
+
+    version = str(room.version)
+    assert f'data-version="{version}"' in client.get('/').data.decode()
+    assert client.post('/roll_die', data={'power': 1, 'version': version}).status_code != 409
+    assert room.version == int(version) + 1
+    assert client.post('/roll_die', data={'power': 1, 'version': version}).status_code == 409
+    assert room.version == int(version) + 1
+
+
+class RecordingSocket():
+    def __init__(self) -> None:
+        self.messages = []
+
+    def send(self, message: str):
+        self.messages.append(json.loads(message))
+
+
+def test_unknown_colours_are_rejected_and_left_out_of_snapshots(app_module):
+    client = app_module.app.test_client()
+    client.get('/rooms/pink')
+    response = client.post('/login', data={'colour': 'pink', 'num_players': 2, 'counters_per_player': 1})
+    assert response.status_code == 400 and not app_module.room_registry.get('pink').game.players
+
+    game = benchmark.new_game(2, 1)
+    game.add_player(backend.Player('pink', 'intruder'))
+    assert sync.snapshot(game, COLOURS)['squares'] == {'0': '01'}
+
+
+def test_oversized_joins_are_rejected_before_the_game_changes(app_module):
+    with pytest.raises(ValueError):
+        eventlog.join_payload('red', 'x' * 256)
+    with pytest.raises(ValueError):
+        eventlog.join_payload('red', 'x' * 250)
+    with pytest.raises(ValueError):
+        eventlog.encode_record(eventlog.QUIT, b'x' * 256)
+
+    client = app_module.app.test_client()
+    client.get('/rooms/oversized')
+    response = client.post('/login', data={'colour': 'red', 'num_players': 300, 'counters_per_player': 1})
+    game = app_module.room_registry.get('oversized').game
+    assert response.status_code == 400 and not game.players and game.number_of_players == 0
+
+
+def test_player_settings_are_checked_against_the_popup_limits(app_module):
+    client = app_module.app.test_client()
+    client.get('/rooms/limits')
+    for num_players, counters_per_player in ((0, 1), (2, 0), (app_module.MAX_PLAYERS + 1, 1),
+                                             (2, app_module.MAX_COUNTERS_PER_PLAYER + 1), ('x', 1)):
+        data = {'colour': 'red', 'num_players': num_players, 'counters_per_player': counters_per_player}
+        assert client.post('/login', data=data).status_code == 400
+    assert not app_module.room_registry.get('limits').game.players
+    assert f'<option>{app_module.MAX_PLAYERS}</option>' in client.get('/login').get_data(as_text=True)
+
+
+def test_later_players_cannot_change_the_table_settings(app_module):
+    first = app_module.app.test_client()
+    first.get('/rooms/settings')
+    first.post('/login', data={'colour': 'red', 'num_players': 2, 'counters_per_player': 1})
+    second = app_module.app.test_client()
+    second.get('/rooms/settings')
+    second.post('/login', data={'colour': 'blue', 'num_players': 4, 'counters_per_player': 3})
+
+    room = app_module.room_registry.get('settings')
+    game = room.game
+    assert (game.number_of_players, game.counters_per_player) == (2, 1)
+    assert game.board.count('red', 0) == game.board.count('blue', 0) == 1
+    replayed = eventlog.replay(room.history)
+    assert eventlog.snapshot_game(replayed, include_dice=False) == eventlog.snapshot_game(game, include_dice=False)
+    first.post('/roll_die', data={'power': 1})
+    roll = game.players[0].die_roll
+    first.post('/move_piece', data={'square_num': 0, 'colour': 'red'})
+    assert game.board.count('red', 0) == 0 and game.board.count('red', roll) == 1
+
+
+def test_only_seated_players_leave_the_table():
+    game = backend.Game()
+    game.set_num_players_and_counters(3, 1)
+    game.add_player(backend.Player('red', 'a'))
+    game.add_player(backend.Player('blue', 'b'))
+    game.remove_player('spectator')
+    game.remove_player('a')
+    game.remove_player('a')
+    assert game.number_of_players == 2 and game.player_ids == ['b']
+
+
+def test_replay_endpoints_check_arguments_and_spectators_can_catch_up(app_module):
+    clients = benchmark.seat_clients(app_module, 'replays', 2, 1)
+    room = app_module.room_registry.get('replays')
+    mover = clients[room.game.players[0].user_id]
+    mover.post('/roll_die', data={'power': 1})
+    assert room.number_of_events == eventlog.count_records(room.history) == 3
+
+    spectator = app_module.app.test_client()
+    spectator.get('/rooms/replays')
+    page = spectator.get('/login').get_data(as_text=True)
+    assert 'data-event-number="3" data-room-id="replays"' in page and 'catchup.js' in page
+    assert spectator.get('/games/replays/replay?since=3').headers['X-Number-Of-Events'] == '3'
+    assert spectator.get('/games/replays/replay?since=x').status_code == 400
+    assert spectator.get('/games/replays/state?event=-1').status_code == 400
+    assert spectator.get('/games/replays/state?event=2').json['event'] == 2
+
+
+def test_live_games_do_not_publish_their_dice_seed(app_module):
+    clients = benchmark.seat_clients(app_module, 'secret-dice', 2, 1)
+    room = app_module.room_registry.get('secret-dice')
+    clients[room.game.players[0].user_id].post('/roll_die', data={'power': 1})
+    spectator = app_module.app.test_client()
+
+    assert 'dice' not in spectator.get('/games/secret-dice/state').json['game']
+    events = spectator.get('/games/secret-dice/replay?format=json').get_data(as_text=True).splitlines()
+    assert json.loads(events[-1]) == {'event': 'roll', 'die_roll': room.game.players[0].die_roll}
+    records = list(eventlog.decode_records(spectator.get('/games/secret-dice/replay').data))
+    assert records[-1] == (eventlog.ROLL, bytes([room.game.players[0].die_roll]))
+
+    colour = room.game.players[1].colour
+    room.game.board.remove(colour, 0)
+    room.game.board.add(colour, backend.FINISH)
+    assert spectator.get('/games/secret-dice/state').json['game']['dice'] == [room.game.dice.seed, 1]
+    assert 'seed' in spectator.get('/games/secret-dice/replay?format=json').get_data(as_text=True)
+
+
+def test_board_sync_sends_deltas_and_falls_back_to_snapshots():
+    board_sync = sync.BoardSync(COLOURS, max_behind=2)
+    ws = RecordingSocket()
+    connection = board_sync.connect('alice', ws)
+    game = benchmark.new_game(2, 1)
+    board_sync.send(connection, 1, sync.snapshot(game, COLOURS))
+    assert ws.messages[-1]['colours'] == COLOURS and ws.messages[-1]['squares'] == {'0': '01'}
+    board_sync.acknowledge(connection, {'ack': 1})
+
+    game.players[0].die_roll = 1
+    game.move_piece(0, 'red', '0')
+    board_sync.deliver(2, sync.snapshot(game, COLOURS), ['alice', 'bob'])
+    assert ws.messages[-1] == {'version': 2, 'base': 1, 'squares': {'0': '1', '1': '0'},
+                               'player_turn': 'orange'}
+    board_sync.deliver(2, sync.snapshot(game, COLOURS), ['alice'])
+    assert len(ws.messages) == 2
+
+    for version in (3, 4):
+        board_sync.deliver(version, sync.snapshot(game, COLOURS), ['alice'])
+    assert 'colours' not in ws.messages[-1]
+    board_sync.deliver(5, sync.snapshot(game, COLOURS), ['alice'])
+    assert ws.messages[-1]['colours'] == COLOURS
+
+    board_sync.acknowledge(connection, {'resync': True})
+    assert ws.messages[-1]['version'] == 5 and 'colours' in ws.messages[-1]
+    board_sync.disconnect(connection)
+    assert not board_sync.connected('alice')
+
+
+def test_board_fragments_are_only_sent_for_changed_squares(app_module):
+    board = backend.Board(4)
+    board.add_colour('red')
+    board.add('red', 0, 2)
+    html = fragments.BoardFragments(app_module.app.jinja_env)
+    last_keys = {}
+    assert len(html.changed(last_keys, board.as_lists(), [])) == backend.NUMBER_OF_SQUARES + 1
+    assert html.changed(last_keys, board.as_lists(), []) == []
+
+    board.remove('red', 0)
+    board.add('red', 3)
+    changed = html.changed(last_keys, board.as_lists(), ['red'])
+    assert [target for target, _ in changed] == ['square_0', 'square_3', 'off_board']
+    assert changed[1][1].count('value="red"') == 1
+
+    json_rendering = fragments.BoardFragments(app_module.app.jinja_env, rendering='json')
+    last_keys = {}
+    assert [target for target, _ in json_rendering.changed(last_keys, board.as_lists(), [])] == \
+        ['board_state', 'off_board']
+    assert json_rendering.changed(last_keys, board.as_lists(), []) == []
+    board.add('red', 5)
+    changed = json_rendering.changed(last_keys, board.as_lists(), [])
+    assert [target for target, _ in changed] == ['board_state'] and '"5":"0"' in changed[0][1]
+
+
+def test_push_buffer_coalesces_streams_and_groups_recipients(app_module):
+    def stream(action, target, content):
+        return f'<turbo-stream action="{action}" target="{target}"><template>{content}</template></turbo-stream>'
+
+    sent = []
+    stats = pushes.PushStats()
+    buffer = pushes.PushBuffer(lambda payload, recipients: sent.append((payload, sorted(recipients))), stats)
+    buffer.add(stream('replace', 'die', 1), ['a', 'b'])
+    buffer.add(stream('append', 'log', 'rolled'), ['a', 'b'])
+    buffer.add(stream('replace', 'die', 2), ['a', 'b'])
+    buffer.add(stream('update', 'turn', 'red'), ['c'])
+    assert len(buffer) == 5
+
+    buffer.flush()
+    assert sent == [
+        (stream('append', 'log', 'rolled') + stream('replace', 'die', 2), ['a', 'b']),
+        (stream('update', 'turn', 'red'), ['c'])
+    ]
+    assert stats.as_dict() == {'issued': 7, 'sent': 3} and len(buffer) == 0
+
+    clients = benchmark.seat_clients(app_module, 'push_stats', 2, 1)
+    mover = clients[app_module.room_registry.get('push_stats').game.players[0].user_id]
+    before = mover.get('/push_stats').get_json()
+    mover.post('/roll_die', data={'power': 1})
+    after = mover.get('/push_stats').get_json()
+    assert after['issued'] - before['issued'] > after['sent'] - before['sent'] > 0
+
+
+def test_readiness_probe_reports_startup(app_module):
+    assert app_module.create_app() is app_module.app
+    assert app_module.app_ready.wait(10)
+    assert app_module.app.test_client().get('/ready').status_code == 200
+
+
+def test_failed_startup_answers_503(app_module, monkeypatch, tmp_path):
+    (tmp_path / f"{'broken'.encode().hex()}.snap").write_bytes(b'not a snapshot')
+    monkeypatch.setattr(app_module, 'room_registry', rooms.RoomRegistry(event_log_dir=str(tmp_path)))
+    for name in ('rooms_recovered', 'app_ready'):
+        monkeypatch.setattr(app_module, name, threading.Event())
+    monkeypatch.setattr(app_module, 'startup_error', None)
+    monkeypatch.setattr(app_module, 'startup_thread', object())
+    monkeypatch.setattr(app_module, 'STARTUP_TIMEOUT_S', 0.01)
+    client = app_module.app.test_client()
+    assert client.get('/rooms/waiting').status_code == 503
+
+    app_module.run_startup()
+    assert app_module.rooms_recovered.is_set() and app_module.startup_error is not None
+    assert client.get('/ready').status_code == 503
+    assert client.get('/rooms/waiting').status_code == 503
+
+
+def play_random_moves(number_of_players: int, counters_per_player: int, seed: int) -> list:
+    """Plays a game through backend.Game with random rolls and moves, returning (roll, square) moves."""
+    rng = np.random.default_rng(seed)
+    game = benchmark.new_game(number_of_players, counters_per_player)
+    moves = []
+    while not any(game.check_win(player.colour) for player in game.players):
+        player = game.players[0]
+        player.die_roll = int(rng.integers(1, 7))
+        legal = game.legal_moves()
+        if not legal:
+            moves.append((player.die_roll, None))
+            player.reset_die()
+            game.next_player()
+            continue
+        square = int(rng.choice(legal))
+        moves.append((player.die_roll, square))
+        game.move_piece(square, player.colour, player.user_id)
+    return moves
+
+
+def test_rules_check_sequences_in_process_pool():
+    sequences = [{'number_of_players': 3, 'counters_per_player': 2, 'moves': play_random_moves(3, 2, seed)}
+                 for seed in range(8)]
+    cheat = dict(sequences[0], moves=list(sequences[0]['moves']))
+    cheat['moves'][5] = (cheat['moves'][5][0], 27)
+
+    results = rules.check_sequences(sequences + [cheat], workers=2, chunksize=2)
+    assert all(result['valid'] and result['winner'] is not None for result in results[:-1])
+    assert results[:-1] == rules.check_sequences(sequences)
+    assert not results[-1]['valid'] and results[-1]['moves_applied'] == 5
+
+
+def test_gateway_delivers_pushes_to_websockets(tmp_path):
+    from flask import Flask
+    from wsproto import ConnectionType, WSConnection
+    from wsproto.events import AcceptConnection, Request, TextMessage
+
+    signer = Flask(__name__)
+    signer.secret_key = 'gateway'
+    cookie = signer.session_interface.get_signing_serializer(signer).dumps({'_user_id': 'alice'})
+    hub = gateway.Gateway(gateway.session_user_loader('gateway'))
+    socket_path = str(tmp_path / 'gateway.sock')
+
+    async def browse() -> list:
+        server = asyncio.create_task(hub.serve('127.0.0.1', 0, socket_path))
+        while not hub.servers:
+            await asyncio.sleep(0.01)
+        port = hub.servers[0].sockets[0].getsockname()[1]
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        ws = WSConnection(ConnectionType.CLIENT)
+        writer.write(ws.send(Request(host='localhost', target=gateway.TURBO_ROUTE,
+                                     extra_headers=[(b'cookie', f'session={cookie}'.encode())])))
+        events = []
+        while not any(isinstance(event, TextMessage) for event in events):
+            if any(isinstance(event, AcceptConnection) for event in events) and not hub.pushes:
+                await asyncio.to_thread(gateway.GatewayClient(socket_path).publish, '<turbo-stream>', ['alice', 'bob'])
+            ws.receive_data(await asyncio.wait_for(reader.read(4096), 5))
+            events += list(ws.events())
+        server.cancel()
+        return events
+
+    events = asyncio.run(browse())
+    assert [event.data for event in events if isinstance(event, TextMessage)] == ['<turbo-stream>']
+    assert gateway.session_user_loader('gateway')('session=forged') is None
+
+
+def test_pages_leave_out_board_sync_behind_the_gateway(app_module, monkeypatch):
+    client = next(iter(benchmark.seat_clients(app_module, 'gatewayed', 2, 1).values()))
+    assert 'scripts/sync.js' in client.get('/').get_data(as_text=True)
+    monkeypatch.setitem(app_module.app.jinja_env.globals, 'board_sync', False)
+    client.post('/roll_die', data={'power': 1})
+    assert 'scripts/sync.js' not in client.get('/').get_data(as_text=True)
+
+
+def test_pages_are_cached_per_version_with_etags(app_module):
+    clients = benchmark.seat_clients(app_module, 'pages', 2, 1)
+    room = app_module.room_registry.get('pages')
+    mover = clients[room.game.players[0].user_id]
+    waiting = clients[room.game.players[1].user_id]
+
+    first = mover.get('/')
+    assert first.status_code == 200
+    etag = first.headers['ETag']
+    assert mover.get('/', headers={'If-None-Match': etag}).status_code == 304
+
+    hits = app_module.page_cache.hits
+    assert waiting.get('/').status_code == 200
+    assert waiting.get('/').status_code == 200 and app_module.page_cache.hits == hits + 1
+    mover.post('/roll_die', data={'power': 1})
+    assert mover.get('/', headers={'If-None-Match': etag}).headers['ETag'] != etag
+
+    # A room evicted and created again restarts its versions, but not its pages.
+    clients = benchmark.seat_clients(app_module, 'recreated', 2, 1)
+    mover = clients[app_module.room_registry.get('recreated').game.players[0].user_id]
+    etag = mover.get('/').headers['ETag']
+    app_module.room_registry._rooms.pop('recreated')
+    clients = benchmark.seat_clients(app_module, 'recreated', 2, 1)
+    mover = clients[app_module.room_registry.get('recreated').game.players[0].user_id]
+    assert mover.get('/', headers={'If-None-Match': etag}).status_code == 200
+
+
+def test_static_files_are_fingerprinted_and_precompressed(app_module, monkeypatch, tmp_path):
+    static_dir = tmp_path / 'static'
+    build_dir = tmp_path / 'build'
+    shutil.copytree('static', static_dir)
+    (static_dir / assets.SPRITE).unlink()
+    manifest = assets.build(str(static_dir), str(build_dir))
+    assert (static_dir / assets.SPRITE).exists()
+    assert (build_dir / manifest['styles/game.css']['path']).exists()
+    monkeypatch.setattr(app_module, 'static_assets', assets.StaticAssets(str(build_dir)))
+    clients = benchmark.seat_clients(app_module, 'assets', 2, 1)
+    client = next(iter(clients.values()))
+
+    css = manifest['styles/game.css']['path']
+    page = client.get('/').get_data(as_text=True)
+    assert f'/static/{css}' in page and 'class="die_image"' in page
+
+    response = client.get(f'/static/{css}', headers={'Accept-Encoding': 'gzip'})
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert response.headers['Content-Type'].startswith('text/css')
+    assert response.headers['Cache-Control'] == 'public, max-age=31536000, immutable'
+    stylesheet = client.get(f'/static/{css}').get_data(as_text=True)
+    assert manifest['images/die_faces.svg']['path'].split('/')[-1] in stylesheet
+    assert client.get('/static/styles/game.css').status_code == 200
+
+
+def test_profiler_writes_tagged_stacks(app_module, monkeypatch, tmp_path):
+    sampler = profiler.SamplingProfiler(str(tmp_path), interval_s=0.001)
+    stop = threading.Event()
+
+    def busy():
+        sampler.tag('/busy', 'room-1')
+        while not stop.is_set():
+            sum(range(1000))
+
+    thread = threading.Thread(target=busy)
+    thread.start()
+    profile = sampler.start_window(10)
+    stop.wait(0.2)
+    stop.set()
+    thread.join()
+    sampler.stop(profile)
+    stacks = (tmp_path / f'{profile.name}.collapsed').read_text().splitlines()
+    assert any(line.startswith('route /busy;room room-1;') and 'busy (testing.py' in line for line in stacks)
+    speedscope = json.loads((tmp_path / f'{profile.name}.speedscope.json').read_text())
+    assert speedscope['profiles'][0]['type'] == 'sampled' and speedscope['profiles'][0]['samples']
+
+    monkeypatch.setattr(app_module, 'PROFILE_TOKEN', 'secret')
+    monkeypatch.setattr(app_module, 'sampling_profiler', sampler)
+    client = next(iter(benchmark.seat_clients(app_module, 'profiled', 2, 1).values()))
+    assert client.post('/profile', data={'seconds': 1}).status_code == 403
+    response = client.get('/', headers={'X-Profile-Token': 'secret'})
+    assert (tmp_path / f"{response.headers['X-Profile']}.speedscope.json").exists()
+    started = client.post('/profile', data={'seconds': 0.05}, headers={'X-Profile-Token': 'secret'})
+    assert started.status_code == 202 and len(started.json['files']) == 2
+    for seconds in ('soon', 'nan', '-1'):
+        response = client.post('/profile', data={'seconds': seconds}, headers={'X-Profile-Token': 'secret'})
+        assert response.status_code == 400
+
+    tags = []
+    monkeypatch.setattr(app_module, 'push',
+                        lambda *args, **kwargs: tags.append(sampler.tags.get(threading.get_ident())))
+    window = sampler.start_window(10)
+    app_module.push_die_face(app_module.room_registry.get('profiled'), 3)
+    sampler.stop(window)
+    assert tags == [('die-animator', 'profiled')] and threading.get_ident() not in sampler.tags
@@ -0,0 +1,224 @@
+"""Module containing users and the store that indexes them."""
+
+from collections import OrderedDict
+from secrets import randbits
+from threading import Lock, local
+from time import monotonic, time
+
+import shared
+
+
+class User():
+    """Class for users for use by flask_login library."""
+
+    def __init__(self, user_id: str) -> None:
+        self._user_id = user_id
+        self._authenticated = False
+        self.room_id = None
+
+    def get_id(self):
+        """Returns id of user."""
+        return self._user_id
+
+    @property
+    def is_active(self):
+        """Returns if the user is active."""
+        return True
+
+    @property
+    def is_authenticated(self):
+        """Returns if the user is authenticated."""
+        return self._authenticated
+
+    @property
+    def is_anonymous(self):
+        """Returns if the user is anonymous."""
+        return False
+
+    def authenticate_user(self):
+        """Sets user _authenticate attribute to true."""
+        self._authenticated = True
+
+    def unauthenticate_user(self):
+        """Sets user _authenticate attribute to false."""
+        self._authenticated = False
+
+
+class UserStore():
+    """Interface for stores of users, keyed by user id.
+
+    Subclasses implement get, add and remove; a store shared between
+    processes only has to provide these, and save if the users it returns
+    are copies.
+    """
+
+    def new_user(self, room_id: str) -> User:
+        """Creates, stores and returns a user with an unused id."""
+        user = User(self.new_user_id())
+        user.room_id = room_id
+        self.add(user)
+        return user
+
+    def new_user_id(self) -> str:
+        """Returns an id not used by any stored user."""
+        user_id = str(randbits(63))
+        while self.get(user_id, touch=False) is not None:
+            user_id = str(randbits(63))
+
+        return user_id
+
+    def get(self, user_id: str, touch: bool = True) -> User:
+        """Returns the user with user_id, or None; touch marks them as seen."""
+        raise NotImplementedError
+
+    def add(self, user: User):
+        """Stores a user."""
+        raise NotImplementedError
+
+    def remove(self, user_id: str):
+        """Removes the user with user_id, if stored."""
+        raise NotImplementedError
+
+    def save(self, user: User):
+        """Stores changes made to a user returned by get."""
+        self.add(user)
+
+    def __len__(self) -> int:
+        raise NotImplementedError
+
+
+class MemoryUserStore(UserStore):
+    """Class storing users in process memory.
+
+    Users are kept in order of when they were last seen, so users who are
+    not authenticated and have not been seen for ttl_s seconds can be
+    dropped from the front without scanning the store. Authenticated users
+    not seen for as long are kept while keep(user) is true, if keep is
+    given, e.g. while they are seated in a room that still exists.
+    on_expire, if given, is called with each dropped user.
+    """
+
+    def __init__(self, ttl_s: float = 1800, on_expire=None, keep=None) -> None:
+        self.ttl_s = ttl_s
+        self.on_expire = on_expire
+        self.keep = keep
+        self._users = OrderedDict()
+        self._last_seen = {}
+        self._lock = Lock()
+
+    def __len__(self) -> int:
+        return len(self._users)
+
+    def get(self, user_id: str, touch: bool = True) -> User:
+        user = self._users.get(user_id)
+        if user is not None and touch:
+            with self._lock:
+                if user_id in self._users:
+                    self._users.move_to_end(user_id)
+                    self._last_seen[user_id] = monotonic()
+        return user
+
+    def add(self, user: User):
+        with self._lock:
+            self._users[user.get_id()] = user
+            self._last_seen[user.get_id()] = monotonic()
+            self._expire()
+
+    def remove(self, user_id: str):
+        with self._lock:
+            self._users.pop(user_id, None)
+            self._last_seen.pop(user_id, None)
+
+    def save(self, user: User):
+        """Does nothing: the stored user is the one that was changed."""
+
+    def _expire(self):
+        """Drops users not seen within the TTL, unless authenticated and kept; caller holds the lock."""
+        now = monotonic()
+        cutoff = now - self.ttl_s
+        for _ in range(len(self._users)):
+            user_id, user = next(iter(self._users.items()))
+            if self._last_seen[user_id] >= cutoff:
+                break
+            if user.is_authenticated and (self.keep is None or self.keep(user)):
+                self._users.move_to_end(user_id)
+                self._last_seen[user_id] = now
+            else:
+                del self._users[user_id]
+                del self._last_seen[user_id]
+                if self.on_expire:
+                    self.on_expire(user)
+
+
+class SqliteUserStore(UserStore):
+    """Class storing users in a SQLite database shared by every worker process.
+
+    get returns a fresh copy of the user, so changes must be saved. Users
+    are dropped as MemoryUserStore drops them; last seen times are only
+    written when a tenth of the TTL has passed, keeping reads cheap.
+    """
+
+    def __init__(self, path: str, ttl_s: float = 1800, on_expire=None, keep=None) -> None:
+        self.path = path
+        self.ttl_s = ttl_s
+        self.on_expire = on_expire
+        self.keep = keep
+        self._local = local()
+        self._connection().execute(
+            'CREATE TABLE IF NOT EXISTS users '
+            '(user_id TEXT PRIMARY KEY, room_id TEXT, authenticated INTEGER, last_seen REAL)'
+        )
+        self._connection().execute('CREATE INDEX IF NOT EXISTS users_last_seen ON users (last_seen)')
+
+    def _connection(self):
+        """Returns this thread's connection to the database."""
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = self._local.connection = shared.connect(self.path)
+        return connection
+
+    def __len__(self) -> int:
+        return self._connection().execute('SELECT COUNT(*) FROM users').fetchone()[0]
+
+    def get(self, user_id: str, touch: bool = True) -> User:
+        row = self._connection().execute(
+            'SELECT room_id, authenticated, last_seen FROM users WHERE user_id = ?', (user_id,)
+        ).fetchone()
+        if row is None:
+            return None
+
+        user = User(user_id)
+        user.room_id = row[0]
+        if row[1]:
+            user.authenticate_user()
+        if touch and time() - row[2] > self.ttl_s / 10:
+            self._connection().execute('UPDATE users SET last_seen = ? WHERE user_id = ?', (time(), user_id))
+        return user
+
+    def add(self, user: User):
+        self._connection().execute(
+            'INSERT OR REPLACE INTO users VALUES (?, ?, ?, ?)',
+            (user.get_id(), user.room_id, int(user.is_authenticated), time())
+        )
+        self._expire()
+
+    def remove(self, user_id: str):
+        self._connection().execute('DELETE FROM users WHERE user_id = ?', (user_id,))
+
+    def _expire(self):
+        """Drops users not seen within the TTL, unless authenticated and kept."""
+        now = time()
+        rows = self._connection().execute(
+            'SELECT user_id, room_id, authenticated FROM users WHERE last_seen < ?', (now - self.ttl_s,)
+        ).fetchall()
+        for user_id, room_id, authenticated in rows:
+            user = User(user_id)
+            user.room_id = room_id
+            if authenticated:
+                user.authenticate_user()
+                if self.keep is None or self.keep(user):
+                    self._connection().execute('UPDATE users SET last_seen = ? WHERE user_id = ?', (now, user_id))
+                    continue
+            self._connection().execute('DELETE FROM users WHERE user_id = ?', (user_id,))
+            if self.on_expire:
+                self.on_expire(user)